@@ -0,0 +1,307 @@
+from __future__ import annotations
+
+import os
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+from html import escape as _html_escape, unescape as _html_unescape
+from typing import Iterator, List, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger("answerdoc")
+
+# Ответ разбирается один раз в дерево блоков, а Telegram, PDF и озвучка только обходят его:
+# разметка трактуется одинаково во всех трёх выводах и не сканируется тремя наборами regex.
+ANSWERDOC_CACHE_MAX = int(os.getenv("ANSWERDOC_CACHE_MAX", "256"))
+
+# Инлайн: ("t" | "b" | "i" | "c" | "m", текст) — обычный, жирный, курсив, код, формула.
+# Блоки:
+#   ("h", level, inlines)   — заголовок; level 0 — «неявный» (короткая строка с двоеточием/капсом)
+#   ("p", inlines)          — абзац, переносы строк внутри сохранены
+#   ("ul" | "ol", [inlines, ...])
+#   ("code", lang, text)
+#   ("math", tex)           — выносная формула $$…$$ или \[…\]
+Inline = Tuple[str, str]
+Block = tuple
+Doc = Tuple[Block, ...]
+
+_RE_FENCE = re.compile(r"^\s{0,3}```\s*([\w+#.-]*)\s*$")
+_RE_HEADING = re.compile(r"^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$")
+_RE_BULLET = re.compile(r"^\s*(?:[-*•—]|(\d{1,3})[.)])\s+(.*)$")
+_RE_SPACES = re.compile(r"[ \t]{2,}")
+_RE_TAG = re.compile(r"<[^>]+>")
+
+# Ветки начинаются с литерала — sre отсекает их по первому символу
+_RE_INLINE = re.compile(
+    r"`(?P<c>[^`\n]+)`"
+    r"|\*\*(?P<b>.+?)\*\*"
+    r"|__(?P<b2>.+?)__"
+    r"|\\\((?P<m>.+?)\\\)"
+    r"|\*(?<!\w\*)(?!\s)(?P<i>.+?)(?<!\s)\*(?!\w)"
+    r"|_(?<!\w_)(?!\s)(?P<i2>.+?)(?<!\s)_(?!\w)",
+    re.DOTALL,
+)
+_KIND = {"c": "c", "b": "b", "b2": "b", "m": "m", "i": "i", "i2": "i"}
+
+
+def _flat(text: str) -> str:
+    # Вложенная разметка внутри жирного/курсива просто снимается
+    return "".join(s for _, s in _inlines(text)) if ("*" in text or "_" in text or "`" in text) else text
+
+
+def _text(seg: str) -> Inline:
+    # Непарные маркеры жирного остаются литералами — в выводе они не нужны
+    if "**" in seg or "__" in seg:
+        seg = seg.replace("**", "").replace("__", "")
+    return ("t", seg)
+
+
+def _inlines(text: str) -> List[Inline]:
+    if "*" not in text and "_" not in text and "`" not in text and "\\" not in text:
+        return [("t", text)]
+    out: List[Inline] = []
+    pos = 0
+    for m in _RE_INLINE.finditer(text):
+        if m.start() > pos:
+            out.append(_text(text[pos:m.start()]))
+        kind = _KIND[m.lastgroup]
+        val = m.group(m.lastgroup)
+        out.append((kind, _flat(val) if kind in ("b", "i") else val))
+        pos = m.end()
+    if pos < len(text):
+        out.append(_text(text[pos:]))
+    return out
+
+
+def _implicit_heading(line: str) -> bool:
+    s = line.strip()
+    if not s or len(s) > 90:
+        return False
+    if s.endswith(":"):
+        return True
+    return s.count(" ") < 8 and sum(map(str.isupper, s)) >= max(3, len(s) // 6)
+
+
+def parse(text: str) -> Doc:
+    lines = (text or "").replace("\r\n", "\n").replace("\r", "\n").replace("\u00a0", " ").split("\n")
+    blocks: List[Block] = []
+    para: List[str] = []
+    items: List[str] = []
+    ordered = False
+
+    def flush_para() -> None:
+        if not para:
+            return
+        body = "\n".join(para)
+        if "  " in body or "\t" in body:
+            body = _RE_SPACES.sub(" ", body)
+        body = body.strip()
+        para.clear()
+        if not body:
+            return
+        if "\n" not in body and _implicit_heading(body):
+            blocks.append(("h", 0, _inlines(body.rstrip(":"))))
+        else:
+            blocks.append(("p", _inlines(body)))
+
+    def flush_list() -> None:
+        if not items:
+            return
+        if len(items) == 1:
+            # Одиночный «пункт» — обычно просто абзац с тире
+            para.append(items[0])
+            items.clear()
+            flush_para()
+            return
+        blocks.append(("ol" if ordered else "ul", [_inlines(_RE_SPACES.sub(" ", it).strip()) for it in items]))
+        items.clear()
+
+    i, n = 0, len(lines)
+    while i < n:
+        line = lines[i]
+        stripped = line.strip()
+
+        fence = _RE_FENCE.match(line) if "```" in line else None
+        if fence:
+            flush_list()
+            flush_para()
+            j = i + 1
+            while j < n and lines[j].strip() != "```":
+                j += 1
+            blocks.append(("code", fence.group(1), "\n".join(lines[i + 1:j])))
+            i = j + 1
+            continue
+
+        if stripped.startswith(("$$", "\\[")):
+            flush_list()
+            flush_para()
+            end = "$$" if stripped.startswith("$$") else "\\]"
+            body = stripped[2:]
+            j = i
+            while not body.rstrip().endswith(end) and j + 1 < n:
+                j += 1
+                body += "\n" + lines[j]
+            body = body.rstrip()
+            if body.endswith(end):
+                body = body[: -len(end)]
+            blocks.append(("math", body.strip()))
+            i = j + 1
+            continue
+
+        if not stripped:
+            flush_list()
+            flush_para()
+            i += 1
+            continue
+
+        head = _RE_HEADING.match(line) if stripped[0] == "#" else None
+        if head:
+            flush_list()
+            flush_para()
+            blocks.append(("h", len(head.group(1)), _inlines(head.group(2))))
+            i += 1
+            continue
+
+        first = stripped[0]
+        bullet = _RE_BULLET.match(line) if (first in "-*•—" or first.isdigit()) else None
+        if bullet:
+            # Список может начаться сразу после строки абзаца («Решение:\n1. …»)
+            flush_para()
+            is_ol = bullet.group(1) is not None
+            if items and is_ol != ordered:
+                flush_list()
+            ordered = is_ol
+            items.append(bullet.group(2))
+        elif items and line[:1] in (" ", "\t"):
+            # Продолжение пункта списка с отступом
+            items[-1] += "\n" + stripped
+        else:
+            flush_list()
+            para.append(line)
+        i += 1
+
+    flush_list()
+    flush_para()
+    return tuple(blocks)
+
+
+# ---------- Кэш ----------
+
+_cache: "OrderedDict[str, Doc]" = OrderedDict()
+
+
+def get(text: str, aid: Optional[str] = None) -> Doc:
+    """Разобранный ответ из кэша: по id ответа, если он есть, иначе по хэшу текста."""
+    key = aid or hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+    doc = _cache.get(key)
+    if doc is not None:
+        _cache.move_to_end(key)
+        metrics.inc("answerdoc.hit")
+        return doc
+    metrics.inc("answerdoc.miss")
+    doc = parse(text)
+    _cache[key] = doc
+    while len(_cache) > ANSWERDOC_CACHE_MAX:
+        _cache.popitem(last=False)
+    return doc
+
+
+# ---------- Простой текст (озвучка) ----------
+
+def _plain_inlines(inl: List[Inline]) -> str:
+    return "".join(s for _, s in inl)
+
+
+def plain(doc: Doc) -> str:
+    """Текст без разметки: код выпадает, формулы остаются в исходной записи для озвучки математики."""
+    out: List[str] = []
+    for b in doc:
+        kind = b[0]
+        if kind == "h":
+            out.append(_plain_inlines(b[2]))
+        elif kind == "p":
+            out.append(_plain_inlines(b[1]))
+        elif kind in ("ul", "ol"):
+            out.append("\n".join(_plain_inlines(it) for it in b[1]))
+        elif kind == "math":
+            out.append(b[1])
+    return "\n\n".join(s for s in out if s.strip())
+
+
+# ---------- Telegram HTML ----------
+
+_TG_TAGS = {"b": ("<b>", "</b>"), "i": ("<i>", "</i>"), "c": ("<code>", "</code>")}
+
+
+def _html_inlines(inl: List[Inline]) -> str:
+    parts: List[str] = []
+    for kind, s in inl:
+        tag = _TG_TAGS.get(kind)
+        esc = _html_escape(s, quote=False)
+        parts.append(f"{tag[0]}{esc}{tag[1]}" if tag else esc)
+    return "".join(parts)
+
+
+def _html_block(b: Block) -> str:
+    kind = b[0]
+    if kind == "h":
+        return f"<b>{_html_inlines(b[2])}</b>"
+    if kind == "p":
+        return _html_inlines(b[1])
+    if kind == "ul":
+        return "\n".join(f"• {_html_inlines(it)}" for it in b[1])
+    if kind == "ol":
+        return "\n".join(f"{k}. {_html_inlines(it)}" for k, it in enumerate(b[1], 1))
+    if kind == "code":
+        cls = f' class="language-{_html_escape(b[1])}"' if b[1] else ""
+        return f"<pre><code{cls}>{_html_escape(b[2], quote=False)}</code></pre>"
+    return f"<pre>{_html_escape(b[1], quote=False)}</pre>"
+
+
+def _split_long(b: Block, limit: int) -> Iterator[str]:
+    # Блок длиннее сообщения: режем по строкам, каждую часть оформляем заново, чтобы теги не рвались
+    if b[0] in ("code", "math"):
+        text = b[2] if b[0] == "code" else b[1]
+        wrap = (lambda s: _html_block(("code", b[1], s))) if b[0] == "code" else (lambda s: _html_block(("math", s)))
+    else:
+        text = plain((b,))
+        wrap = lambda s: _html_escape(s, quote=False)  # noqa: E731
+    budget = max(200, limit - 64)
+    buf = ""
+    for line in text.split("\n"):
+        while len(line) > budget:
+            if buf:
+                yield wrap(buf)
+                buf = ""
+            yield wrap(line[:budget])
+            line = line[budget:]
+        if buf and len(buf) + 1 + len(line) > budget:
+            yield wrap(buf)
+            buf = ""
+        buf = f"{buf}\n{line}" if buf else line
+    if buf:
+        yield wrap(buf)
+
+
+def telegram_chunks(doc: Doc, limit: int = 4000) -> List[str]:
+    """HTML для parse_mode=HTML, разбитый на сообщения по границам блоков."""
+    chunks: List[str] = []
+    cur = ""
+    for b in doc:
+        html = _html_block(b)
+        pieces = [html] if len(html) <= limit else list(_split_long(b, limit))
+        for piece in pieces:
+            if cur and len(cur) + 2 + len(piece) > limit:
+                chunks.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{piece}" if cur else piece
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+def html_to_text(chunk: str) -> str:
+    """Запасной вариант, если Telegram не принял HTML: тот же кусок простым текстом."""
+    return _html_unescape(_RE_TAG.sub("", chunk))
@@ -0,0 +1,101 @@
+"""Бенчмарк near-dup индекса (dedup.NearDupIndex): память и латентность поиска на N записях.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_dedup.py --n 1000000
+
+Основная масса записей заполняется случайными сигнатурами (хэширование миллиона реальных
+текстов на чистом Python заняло бы минуты и не влияет на стоимость поиска), поверх них
+добавляются реальные вопросы, по парафразам которых и меряется поиск.
+"""
+import argparse
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import NUM_PERM, NearDupIndex, guard_of, normalize_question, signature  # noqa: E402
+
+TOPICS = [
+    "найти площадь треугольника со сторонами {a} см и {b} см и углом между ними 30 градусов",
+    "вычислить производную функции f(x) = x^{a} + {b}x на отрезке",
+    "решить уравнение {a}x + {b} = 0 и проверить ответ подстановкой",
+    "определить реакции опор балки длиной {a} м с нагрузкой {b} кН посередине",
+    "find the kinetic energy of a body with mass {a} kg moving at {b} m/s",
+    "сколько молей вещества содержится в {a} г воды при температуре {b} градусов",
+]
+PARAPHRASES = [
+    "{q}",
+    "Помоги решить: {q}",
+    "1) {q}, пожалуйста",
+    "реши задачу   {q}",
+    "Please, {q}!",
+]
+
+
+def _pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=1_000_000)
+    ap.add_argument("--real", type=int, default=2000)
+    ap.add_argument("--queries", type=int, default=5000)
+    args = ap.parse_args()
+
+    rnd = random.Random(42)
+    scope = "ru:default"
+    index = NearDupIndex(max_entries=args.n + args.real)
+
+    real = []
+    for i in range(args.real):
+        q = rnd.choice(TOPICS).format(a=rnd.randint(2, 99), b=rnd.randint(2, 99))
+        real.append(q)
+
+    t0 = time.perf_counter()
+    sig_times = []
+    for i in range(args.n):
+        sig = array("H", (rnd.getrandbits(16) for _ in range(NUM_PERM)))
+        index.add(i, sig, rnd.getrandbits(32))
+    fill_s = time.perf_counter() - t0
+
+    for i, q in enumerate(real):
+        norm = normalize_question(q)
+        t = time.perf_counter()
+        sig = signature(norm)
+        sig_times.append(time.perf_counter() - t)
+        index.add(args.n + i, sig, guard_of(norm, scope))
+
+    lat = []
+    hits = 0
+    for _ in range(args.queries):
+        i = rnd.randrange(len(real))
+        q = rnd.choice(PARAPHRASES).format(q=real[i])
+        t = time.perf_counter()
+        norm = normalize_question(q)
+        res = index.query(signature(norm), guard_of(norm, scope))
+        lat.append(time.perf_counter() - t)
+        if res and res[0] == args.n + i:
+            hits += 1
+        elif res:
+            # другой реальный вопрос с теми же числами и шаблоном — тоже корректный дубль
+            hits += int(normalize_question(real[res[0] - args.n]) == normalize_question(real[i]))
+
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"entries:              {len(index):,}")
+    print(f"fill time:            {fill_s:.1f} s ({fill_s / max(1, args.n) * 1e6:.1f} us/entry)")
+    print(f"index arrays:         {index.memory_bytes() / 2**20:.1f} MiB ({index.memory_bytes() / len(index):.0f} B/entry)")
+    print(f"process max RSS:      {rss_mb:.0f} MiB")
+    print(f"signature():          p50={statistics.median(sig_times) * 1e6:.0f} us  p99={_pct(sig_times, 0.99) * 1e6:.0f} us")
+    print(f"lookup (norm+sig+q):  p50={statistics.median(lat) * 1e6:.0f} us  p95={_pct(lat, 0.95) * 1e6:.0f} us  p99={_pct(lat, 0.99) * 1e6:.0f} us")
+    print(f"paraphrase recall:    {hits / args.queries:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Бенчмарк нормализации текста для озвучки: tts._normalize_text против прежней многопроходной версии.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_tts_normalize.py --n 300
+
+Тексты — длинные «инженерные» ответы (формулы, единицы, markdown, LaTeX) на нескольких языках.
+Прежняя реализация скопирована сюда без изменений (legacy_*), чтобы сравнение было воспроизводимым.
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts import _normalize_text  # noqa: E402
+
+# ----------------- прежняя реализация -----------------
+
+_L_RE_CODEBLOCK = re.compile(r"```.+?```", re.DOTALL)
+_L_RE_INLINE_CODE = re.compile(r"`([^`]+)`")
+_L_RE_LATEX_WRAPS = re.compile(r"(\\\[|\\\]|\\\(|\\\))")
+_L_RE_LATEX_FRAC = re.compile(r"\\frac\s*\{([^{}]+)\}\s*\{([^{}]+)\}", re.IGNORECASE)
+_L_RE_LATEX_SQRT = re.compile(r"\\sqrt\{([^{}]+)\}", re.IGNORECASE)
+_L_RE_SPACES = re.compile(r"\s{2,}")
+_L_RE_TEN_POW = re.compile(r"(\b10)\s*\^\s*\(?\s*(-?\d+)\s*\)?")
+_L_RE_LETTER_POW = re.compile(r"([a-zA-Zа-яА-Я])\s*\^\s*\(?\s*(\d+)\s*\)?", re.UNICODE)
+
+_L_RE_MD_HEADER = re.compile(r"^\s{0,3}#{1,6}\s+", re.MULTILINE)
+_L_RE_MD_BOLD_STAR = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
+_L_RE_MD_BOLD_UND = re.compile(r"__(.+?)__", re.DOTALL)
+_L_RE_MD_ITALIC_STAR = re.compile(r"(?<!\w)\*(?!\s)(.+?)(?<!\s)\*(?!\w)", re.DOTALL)
+_L_RE_MD_ITALIC_UND = re.compile(r"(?<!\w)_(?!\s)(.+?)(?<!\s)_(?!\w)", re.DOTALL)
+_L_RE_MD_BULLET = re.compile(r"^\s*[-*•]\s+", re.MULTILINE)
+
+_L_RE_MUL_STAR = re.compile(r"(?<=[0-9A-Za-zА-Яа-я\)\]])\s*\*\s*(?=[0-9A-Za-zА-Яа-я\(\[])")
+_L_RE_DIV_SLASH = re.compile(r"(?<=[0-9A-Za-zА-Яа-я\)\]])\s*/\s*(?=[0-9A-Za-zА-Яа-я\(\[])")
+
+_L_ARABIC_RE = re.compile(r"[\u0600-\u06FF]")
+_L_DEVANAGARI_RE = re.compile(r"[\u0900-\u097F]")
+_L_CYRILLIC_RE = re.compile(r"[\u0400-\u04FF]")
+
+
+def legacy_guess_lang(text: str) -> str:
+    t = text or ""
+    if _L_ARABIC_RE.search(t):
+        return "ar"
+    if _L_DEVANAGARI_RE.search(t):
+        return "hi"
+    if _L_CYRILLIC_RE.search(t):
+        return "ru"
+    tl = t.lower()
+    if any(ch in tl for ch in "ğüşöçıİ".lower()):
+        return "tr"
+    if any(ch in tl for ch in "äöüß"):
+        return "de"
+    if any(ch in tl for ch in "éèêëàâîïôùûçœ"):
+        return "fr"
+    if any(ch in tl for ch in "ñ¡¿"):
+        return "es"
+    return "en"
+
+
+def legacy_strip_markdown(t: str) -> str:
+    t = _L_RE_MD_HEADER.sub("", t)
+    t = _L_RE_MD_BULLET.sub("", t)
+    t = _L_RE_MD_BOLD_STAR.sub(r"\1", t)
+    t = _L_RE_MD_BOLD_UND.sub(r"\1", t)
+    t = _L_RE_MD_ITALIC_STAR.sub(r"\1", t)
+    t = _L_RE_MD_ITALIC_UND.sub(r"\1", t)
+    t = t.replace("**", " ").replace("__", " ")
+    return t
+
+
+def legacy_normalize_text(text: str, lang: Optional[str]) -> str:
+    t = (text or "").strip()
+    if not t:
+        return ""
+    lg = (lang or legacy_guess_lang(t)).lower()
+
+    t = _L_RE_CODEBLOCK.sub(" ", t)
+    t = _L_RE_INLINE_CODE.sub(r"\1", t)
+    t = _L_RE_LATEX_WRAPS.sub(" ", t)
+    t = legacy_strip_markdown(t)
+
+    if lg == "ru":
+        t = _L_RE_LATEX_FRAC.sub(r"(\1) делить на (\2)", t)
+        t = _L_RE_LATEX_SQRT.sub(r"квадратный корень из \1", t)
+
+        t = t.replace("·", " умножить на ")
+        t = _L_RE_MUL_STAR.sub(" умножить на ", t)
+
+        t = _L_RE_DIV_SLASH.sub(" делить на ", t)
+        t = t.replace("=", " равно ")
+        t = t.replace("≈", " примерно равно ").replace("≤", " меньше либо равно ")
+        t = t.replace("≥", " больше либо равно ").replace("≠", " не равно ")
+
+        t = re.sub(r"\bкН\b", " килоНьютон ", t, flags=re.IGNORECASE)
+        t = re.sub(r"\bН\b", " Ньютон ", t)
+        t = re.sub(r"\bДж\b", " Джоуль ", t)
+        t = re.sub(r"\bм/с\b", " метр в секунду ", t, flags=re.IGNORECASE)
+        t = re.sub(r"\bсм\b", " сантиметр ", t, flags=re.IGNORECASE)
+    else:
+        t = _L_RE_LATEX_FRAC.sub(r"(\1) / (\2)", t)
+        t = _L_RE_LATEX_SQRT.sub(r"sqrt(\1)", t)
+
+    t = _L_RE_TEN_POW.sub(r"\1^(\2)", t)
+    t = _L_RE_LETTER_POW.sub(r"\1^(\2)", t)
+    t = t.replace("\\", " ")
+
+    return _L_RE_SPACES.sub(" ", t).strip()
+
+
+# ----------------- тексты -----------------
+
+BLOCKS = {
+    "ru": [
+        "## Шаг {i}. Реакции опор\n**Дано:** l = {a} м, F = {b} кН, q = {c} кН/м.",
+        "- Сумма моментов: R_B · {a} = F · {b} + q · {a}^2 / 2 ≈ {d} кН·м",
+        "- Напряжение: \\(\\sigma = \\frac{{M}}{{W}} = \\frac{{{d}}}{{{c}}}\\) ≤ {b} МПа",
+        "Скорость v = {a} м/с, путь s = v*t = {b} м, энергия E = m*v^2/2 = {d} Дж.",
+        "Проверка: \\sqrt{{{a}}} ≈ {c}.{b}, 10^-{c} Па, площадь {a} см² ≠ {b} мм².",
+        "```python\nprint({a} * {b})\n```\nИтог: `R = {d}` *кН*, что больше {c} кН.",
+    ],
+    "en": [
+        "## Step {i}. Support reactions\n**Given:** l = {a} m, F = {b} kN, q = {c} kN/m.",
+        "- Sum of moments: R_B · {a} = F · {b} + q · {a}^2 / 2 ≈ {d} kN",
+        "- Stress: \\(\\sigma = \\frac{{M}}{{W}} = \\frac{{{d}}}{{{c}}}\\) ≤ {b} MPa",
+        "Speed v = {a} m/s, distance s = v*t = {b} m, energy E = m*v^2/2 = {d} J.",
+        "Check: \\sqrt{{{a}}} ≈ {c}.{b}, 10^-{c} Pa, area {a} cm² ≠ {b} mm².",
+        "```python\nprint({a} * {b})\n```\nResult: `R = {d}` *kN*, which is > {c} kN.",
+    ],
+    "de": [
+        "## Schritt {i}. Auflagerkräfte\n**Gegeben:** l = {a} m, F = {b} kN, Größe q = {c} kN/m.",
+        "- Momentensumme: R_B · {a} = F · {b} + q · {a}^2 / 2 ≈ {d} kN",
+        "Geschwindigkeit v = {a} m/s, Weg s = v*t = {b} m, Energie E = m*v^2/2 = {d} J.",
+    ],
+}
+
+
+# Составные единицы: нормализатор должен читать «кН/м» как «килоньютон на метр», а не «делить на м».
+# Печатаются вместе с таймингами, чтобы глазами проверить все десять языков.
+COMPOUND = {
+    "ru": "Нагрузка q = 5 кН/м, момент M = 20 кН·м, давление p = 4 кН/м², скорость v = 3 м/с, x/y.",
+    "kk": "Жүктеме q = 5 кН/м, момент M = 20 кН·м, қысым p = 4 кН/м², жылдамдық v = 3 м/с, x/y.",
+    "en": "Load q = 5 kN/m, moment M = 20 kN·m, pressure p = 4 kN/m², torque T = 2 N*m, speed v = 3 m/s, x/y.",
+    "de": "Last q = 5 kN/m, Moment M = 20 kN·m, Druck p = 4 kN/m², Drehmoment T = 2 N*m, Größe x/y.",
+    "fr": "Charge q = 5 kN/m, moment M = 20 kN·m, pression p = 4 kN/m², couple T = 2 N*m, vitesse v = 3 m/s, x/y.",
+    "es": "Carga q = 5 kN/m, momento M = 20 kN·m, presión p = 4 kN/m², par T = 2 N*m, velocidad v = 3 m/s, x/y.",
+    "tr": "Yük q = 5 kN/m, moment M = 20 kN·m, basınç p = 4 kN/m², tork T = 2 N*m, hız v = 3 m/s, x/y.",
+    "uz": "Yuk q = 5 kN/m, moment M = 20 kN·m, bosim p = 4 kN/m², tezlik v = 3 m/s, x/y.",
+    "ar": "الحمل q = 5 kN/m، العزم M = 20 kN·m، الضغط p = 4 kN/m²، السرعة v = 3 m/s، x/y.",
+    "hi": "भार q = 5 kN/m, आघूर्ण M = 20 kN·m, दाब p = 4 kN/m², वेग v = 3 m/s, x/y.",
+}
+
+
+def make_answer(rnd: random.Random, lang: str, blocks: int) -> str:
+    out = []
+    for i in range(blocks):
+        tpl = rnd.choice(BLOCKS[lang])
+        out.append(tpl.format(i=i + 1, a=rnd.randint(2, 99), b=rnd.randint(2, 99), c=rnd.randint(2, 9), d=rnd.randint(100, 9999)))
+    return "\n\n".join(out)
+
+
+def _bench(fn, texts, lang: Optional[str], repeat: int):
+    per_call = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for t in texts:
+            fn(t, lang)
+        per_call.append((time.perf_counter() - t0) / len(texts))
+    return min(per_call), statistics.median(per_call)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=300, help="ответов на язык")
+    ap.add_argument("--blocks", type=int, default=40, help="абзацев в ответе")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    rnd = random.Random(42)
+    for lang in BLOCKS:
+        texts = [make_answer(rnd, lang, args.blocks) for _ in range(args.n)]
+        avg_len = sum(map(len, texts)) / len(texts)
+        for given in (lang, None):
+            old_best, old_med = _bench(legacy_normalize_text, texts, given, args.repeat)
+            new_best, new_med = _bench(_normalize_text, texts, given, args.repeat)
+            label = f"{lang} ({'lang given' if given else 'lang guessed'})"
+            print(
+                f"{label:<22} avg {avg_len:,.0f} chars | legacy p50={old_med * 1e6:,.0f} us "
+                f"| new p50={new_med * 1e6:,.0f} us | speedup x{old_best / new_best:.2f}"
+            )
+    print("\ncompound units:")
+    for lang, text in COMPOUND.items():
+        t0 = time.perf_counter()
+        for _ in range(args.repeat * 100):
+            out = _normalize_text(text, lang)
+        per_call = (time.perf_counter() - t0) / (args.repeat * 100)
+        print(f"{lang:<3} {per_call * 1e6:,.1f} us | {text}\n    -> {out}")
+
+    sample = make_answer(random.Random(7), "ru", 3)
+    print("\nsample:\n" + sample)
+    print("\nlegacy:\n" + legacy_normalize_text(sample, "ru"))
+    print("\nnew:\n" + _normalize_text(sample, "ru"))
+
+
+if __name__ == "__main__":
+    main()
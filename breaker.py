@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import contextlib
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+import metrics
+
+log = logging.getLogger("breaker")
+
+BREAKER_WINDOW_SEC = float(os.getenv("BREAKER_WINDOW_SEC", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "8"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_SEC = float(os.getenv("BREAKER_SLOW_SEC", "30"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.6"))
+BREAKER_OPEN_SEC = float(os.getenv("BREAKER_OPEN_SEC", "30"))
+
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+
+
+class BreakerOpen(Exception):
+    def __init__(self, endpoint: str, retry_after: float) -> None:
+        super().__init__(f"{endpoint} is temporarily unavailable (retry in {int(retry_after) + 1}s)")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """closed → open по доле ошибок/медленных вызовов в скользящем окне; после паузы — half_open с одной пробой."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._events: Deque[Tuple[float, bool, bool]] = deque()
+
+    def _trim(self, now: float) -> None:
+        while self._events and now - self._events[0][0] > BREAKER_WINDOW_SEC:
+            self._events.popleft()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            log.warning("breaker %s: %s -> %s", self.name, self.state, state)
+            metrics.inc(f"breaker.{self.name}.{state}")
+        self.state = state
+        metrics.gauge(f"breaker.{self.name}.open", 0 if state == "closed" else 1)
+
+    def allow(self) -> bool:
+        """True — вызов является half-open пробой."""
+        now = time.monotonic()
+        if self.state == "open":
+            left = self.opened_at + BREAKER_OPEN_SEC - now
+            if left > 0:
+                metrics.inc(f"breaker.{self.name}.rejected")
+                raise BreakerOpen(self.name, left)
+            self._set_state("half_open")
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                metrics.inc(f"breaker.{self.name}.rejected")
+                raise BreakerOpen(self.name, 1.0)
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record(self, ok: bool, latency: float, probe: bool = False, slow: bool = False) -> None:
+        now = time.monotonic()
+        slow = slow or latency >= BREAKER_SLOW_SEC
+        if probe:
+            self.probe_in_flight = False
+            if ok and not slow:
+                self._events.clear()
+                self._set_state("closed")
+            else:
+                self.opened_at = now
+                self._set_state("open")
+            return
+
+        self._events.append((now, ok, slow))
+        self._trim(now)
+        if self.state != "closed" or len(self._events) < BREAKER_MIN_CALLS:
+            return
+        n = len(self._events)
+        errors = sum(1 for _, good, _ in self._events if not good)
+        slows = sum(1 for _, _, s in self._events if s)
+        if errors / n >= BREAKER_ERROR_RATE or slows / n >= BREAKER_SLOW_RATE:
+            self.opened_at = now
+            self._set_state("open")
+
+    def release_probe(self) -> None:
+        self.probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._trim(now)
+        n = len(self._events)
+        return {
+            "state": self.state,
+            "calls": n,
+            "error_rate": round(sum(1 for _, ok, _ in self._events if not ok) / n, 3) if n else 0.0,
+            "slow_rate": round(sum(1 for _, _, s in self._events if s) / n, 3) if n else 0.0,
+            "open_for_sec": round(max(0.0, self.opened_at + BREAKER_OPEN_SEC - now), 1) if self.state == "open" else 0.0,
+        }
+
+
+class RetryBudget:
+    """Общий бюджет повторов: каждый обычный запрос пополняет его на RETRY_BUDGET_RATIO, повтор тратит 1."""
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, cap: float = RETRY_BUDGET_MAX) -> None:
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap / 2
+
+    def on_request(self) -> None:
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            metrics.inc("retry_budget.spent")
+            return True
+        metrics.inc("retry_budget.denied")
+        return False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+retry_budget = RetryBudget()
+
+
+def get(name: str) -> CircuitBreaker:
+    br = _breakers.get(name)
+    if br is None:
+        br = _breakers[name] = CircuitBreaker(name)
+    return br
+
+
+class _Call:
+    """Хэндл вызова внутри guard: для стримов «медленность» меряется до первого байта, а не по всей генерации."""
+
+    __slots__ = ("t0", "ttfb", "lost")
+
+    def __init__(self) -> None:
+        self.t0 = time.monotonic()
+        self.ttfb: float = 0.0
+        self.lost = False
+
+    def lose(self) -> None:
+        """Вызов отменяют, потому что хедж успел раньше: это медленный отказ, а не нейтральная отмена."""
+        self.lost = True
+
+    def first_byte(self) -> None:
+        if not self.ttfb:
+            self.ttfb = time.monotonic() - self.t0
+
+    def latency(self) -> float:
+        return self.ttfb or (time.monotonic() - self.t0)
+
+
+@contextlib.asynccontextmanager
+async def guard(endpoint: str, *, retry: bool = False):
+    br = get(endpoint)
+    probe = br.allow()
+    if retry and not retry_budget.try_spend():
+        if probe:
+            br.release_probe()
+        raise BreakerOpen("retry_budget", 1.0)
+    if not retry:
+        retry_budget.on_request()
+    call = _Call()
+    recorded = False
+    try:
+        yield call
+    except asyncio.CancelledError:
+        if call.lost:
+            br.record(False, call.latency(), probe=probe, slow=True)
+            recorded = True
+        raise
+    except Exception:
+        br.record(False, call.latency(), probe=probe)
+        recorded = True
+        raise
+    else:
+        br.record(True, call.latency(), probe=probe)
+        recorded = True
+    finally:
+        if probe and not recorded:
+            br.release_probe()
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "breakers": {name: br.snapshot() for name, br in sorted(_breakers.items())},
+        "retry_budget": round(retry_budget.tokens, 2),
+    }
@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import os
+import time
+import queue
+import asyncio
+import logging
+import tempfile
+import contextlib
+import multiprocessing
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger("bulkexport")
+
+# /export: вся история или все закладки одним PDF. Записи читаются из Mongo пачками прямо во время вёрстки,
+# файл пишется на диск и отправляется оттуда — память не растёт с длиной чата.
+# Вёрстка сотен страниц — минуты CPU, поэтому каждая часть собирается в отдельном процессе
+# (как и обычный PDF в pdfpool): в потоке она делила бы GIL с циклом событий бота.
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "100"))
+EXPORT_MAX_ITEMS = int(os.getenv("EXPORT_MAX_ITEMS", "4000"))
+# Порог на часть: ~800 тыс. символов — это порядка 400 страниц
+EXPORT_PART_MAX_CHARS = int(os.getenv("EXPORT_PART_MAX_CHARS", "800000"))
+EXPORT_MAX_PARTS = int(os.getenv("EXPORT_MAX_PARTS", "4"))
+# Bot API принимает от бота документы до 50 МБ
+EXPORT_MAX_FILE_MB = float(os.getenv("EXPORT_MAX_FILE_MB", "48"))
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "1"))
+EXPORT_PROGRESS_SEC = float(os.getenv("EXPORT_PROGRESS_SEC", "3"))
+# Сколько пачек записей может ждать в канале к процессу вёрстки
+EXPORT_PIPE_BATCHES = int(os.getenv("EXPORT_PIPE_BATCHES", "4"))
+EXPORT_PART_TIMEOUT_SEC = float(os.getenv("EXPORT_PART_TIMEOUT_SEC", "900"))
+
+SOURCES = {"history": "История чата", "bookmarks": "Закладки"}
+
+Entry = Tuple[str, str, str]
+
+_sem: Optional[asyncio.Semaphore] = None
+_running: Dict[int, asyncio.Task] = {}
+
+
+def _date(ts: Any) -> str:
+    return ts.strftime("%d.%m.%Y %H:%M") if hasattr(ts, "strftime") else ""
+
+
+def _short(text: str, limit: int = 90) -> str:
+    line = " ".join((text or "").split())
+    return line if len(line) <= limit else line[: limit - 1].rstrip() + "…"
+
+
+class _Feed:
+    """Записи экспорта из async-курсора Mongo: документы истории сводятся в пары «вопрос — ответ»."""
+
+    def __init__(self, batches: Any, source: str):
+        self._batches = batches
+        self._source = source
+        self._pending: Deque[Entry] = deque()
+        self._question: Optional[Dict[str, Any]] = None
+        self.exhausted = False
+        self.docs = 0
+        self.entries = 0
+
+    def _convert(self, docs: List[Dict[str, Any]]) -> None:
+        for doc in docs:
+            text = doc.get("content") or ""
+            if self._source == "bookmarks":
+                self.entries += 1
+                self._pending.append((f"Закладка {self.entries}: {_short(text, 70)}", _date(doc.get("ts")), text))
+            elif doc.get("role") == "user":
+                self._flush_question()
+                self._question = doc
+            else:
+                q = self._question
+                self._question = None
+                qtext = (q or {}).get("content") or ""
+                heading = _short(qtext) if qtext else "Ответ"
+                body = f"Вопрос: {qtext}\n\n{text}" if len(qtext) > len(heading) else text
+                self._pending.append((heading, _date((q or doc).get("ts")), body))
+                self.entries += 1
+
+    def _flush_question(self) -> None:
+        # Вопрос без ответа (например, запрос упал) — всё равно попадает в экспорт
+        q, self._question = self._question, None
+        if q is not None and q.get("content"):
+            self._pending.append((_short(q["content"]), _date(q.get("ts")), q["content"]))
+            self.entries += 1
+
+    async def has_more(self) -> bool:
+        while not self._pending and not self.exhausted:
+            try:
+                docs = await self._batches.__anext__()
+            except StopAsyncIteration:
+                self._flush_question()
+                self.exhausted = True
+                break
+            self.docs += len(docs)
+            self._convert(docs)
+        return bool(self._pending)
+
+    def maybe_more(self) -> bool:
+        # Без обращения к курсору: для подписи «часть N» точности хватает
+        return bool(self._pending) or not self.exhausted
+
+    async def part(self, budget_chars: int):
+        """Пачки записей одной части, пока не исчерпан бюджет символов."""
+        used = 0
+        batch: List[Entry] = []
+        while used < budget_chars and await self.has_more():
+            entry = self._pending.popleft()
+            used += len(entry[0]) + len(entry[2])
+            batch.append(entry)
+            if len(batch) >= EXPORT_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _part_worker(path: str, title: str, inbox: Any, result: Any) -> None:
+    # Выполняется в отдельном процессе: записи приходят пачками, None — конец части
+    try:
+        from utils_export import pdf_stream_to_file
+
+        def entries() -> Iterator[Entry]:
+            while (batch := inbox.get()) is not None:
+                yield from batch
+
+        result.put(("ok", pdf_stream_to_file(path, entries(), title=title)))
+    except BaseException as e:
+        result.put(("error", repr(e)))
+
+
+def _send(inbox: Any, item: Any, proc: Any, deadline: float) -> None:
+    while True:
+        try:
+            inbox.put(item, timeout=1.0)
+            return
+        except queue.Full:
+            if not proc.is_alive():
+                raise RuntimeError(f"export worker exited with code {proc.exitcode}")
+            # Живой, но зависший воркер не разбирает очередь — не держим слот экспорта вечно
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"export part took longer than {EXPORT_PART_TIMEOUT_SEC:.0f}s")
+
+
+def _receive(result: Any, proc: Any, deadline: float) -> Tuple[str, Any]:
+    while True:
+        if time.monotonic() > deadline:
+            return "error", f"export part took longer than {EXPORT_PART_TIMEOUT_SEC:.0f}s"
+        try:
+            return result.get(timeout=1.0)
+        except queue.Empty:
+            if not proc.is_alive():
+                # Результат мог попасть в очередь прямо перед выходом процесса
+                with contextlib.suppress(queue.Empty):
+                    return result.get(timeout=1.0)
+                return "error", f"export worker exited with code {proc.exitcode}"
+
+
+async def _build_part(feed: _Feed, path: str, title: str) -> Optional[Dict[str, int]]:
+    if not await feed.has_more():
+        return None
+    ctx = multiprocessing.get_context("spawn")
+    inbox, result = ctx.Queue(maxsize=EXPORT_PIPE_BATCHES), ctx.Queue()
+    proc = ctx.Process(target=_part_worker, args=(path, title, inbox, result), daemon=True)
+    proc.start()
+    deadline = time.monotonic() + EXPORT_PART_TIMEOUT_SEC
+    finished = False
+    try:
+        # Блокирующие put/get ждут в потоке: сам он почти не держит GIL, вёрстка идёт в процессе
+        async for batch in feed.part(EXPORT_PART_MAX_CHARS):
+            await asyncio.to_thread(_send, inbox, batch, proc, deadline)
+        await asyncio.to_thread(_send, inbox, None, proc, deadline)
+        status, info = await asyncio.to_thread(_receive, result, proc, deadline)
+        if status != "ok":
+            raise RuntimeError(info)
+        finished = True
+        return info
+    finally:
+        if finished:
+            await asyncio.to_thread(proc.join, 5.0)
+        if proc.is_alive():
+            # Ошибка, таймаут или отмена экспорта — недособранную часть не ждём
+            proc.terminate()
+        for q in (inbox, result):
+            q.cancel_join_thread()
+            q.close()
+
+
+async def _progress(status: Any, text: str) -> None:
+    with contextlib.suppress(Exception):
+        await status.edit_text(text)
+
+
+async def run(message: Any, source: str) -> None:
+    global _sem
+    from aiogram.types import FSInputFile
+    from db import export_count, iter_export_batches
+
+    chat_id = message.chat.id
+    label = SOURCES[source]
+    total = await export_count(chat_id, source)
+    if not total:
+        await message.answer("Экспортировать пока нечего.")
+        return
+    skip = max(0, total - EXPORT_MAX_ITEMS)
+    n = total - skip
+    note = f" (последние {n} из {total})" if skip else ""
+    if skip:
+        metrics.inc("export.bulk.truncated")
+
+    status = await message.answer(f"📄 Готовлю PDF «{label}»{note}…")
+    if _sem is None:
+        _sem = asyncio.Semaphore(EXPORT_CONCURRENCY)
+    t0 = time.monotonic()
+    batches = iter_export_batches(chat_id, source, EXPORT_BATCH, skip)
+    feed = _Feed(batches, source)
+    parts = pages = 0
+    try:
+        async with _sem:
+            while parts < EXPORT_MAX_PARTS:
+                fd, path = tempfile.mkstemp(prefix="export_", suffix=".pdf")
+                os.close(fd)
+                try:
+                    job = asyncio.ensure_future(_build_part(feed, path, label))
+                    try:
+                        while not job.done():
+                            await asyncio.wait({job}, timeout=EXPORT_PROGRESS_SEC)
+                            await _progress(status, f"📄 Готовлю PDF «{label}»{note}: {feed.docs}/{n}…")
+                    except asyncio.CancelledError:
+                        job.cancel()
+                        raise
+                    info = job.result()
+                    if info is None:
+                        break
+                    parts += 1
+                    pages += info["pages"]
+                    if os.path.getsize(path) > EXPORT_MAX_FILE_MB * 1024 * 1024:
+                        metrics.inc("export.bulk.too_large")
+                        await message.answer(f"Часть {parts} получилась больше {EXPORT_MAX_FILE_MB:.0f} МБ — Telegram её не примет.")
+                        break
+                    more = feed.maybe_more()
+                    caption = f"📄 {label}" + (f", часть {parts}" if parts > 1 or more else "")
+                    await message.answer_document(
+                        FSInputFile(path, filename=f"{source}_{parts}.pdf"), caption=caption
+                    )
+                finally:
+                    with contextlib.suppress(OSError):
+                        os.unlink(path)
+            else:
+                if await feed.has_more():
+                    await message.answer(
+                        f"Достигнут предел в {EXPORT_MAX_PARTS} PDF — более поздние записи не вошли."
+                    )
+    except Exception as e:
+        metrics.inc("export.bulk.failed")
+        log.warning("bulk export failed for %s: %s", chat_id, e)
+        await _progress(status, f"Не удалось собрать PDF: {e}")
+        return
+    finally:
+        with contextlib.suppress(Exception):
+            await batches.aclose()
+
+    metrics.observe("export.bulk.sec", time.monotonic() - t0)
+    metrics.observe("export.bulk.pages", pages)
+    metrics.inc("export.bulk.parts", parts)
+    metrics.inc("export.bulk.docs", feed.docs)
+    await _progress(status, f"✅ Готово: записей {feed.entries}, страниц {pages}, файлов {parts}.")
+
+
+def _finished(chat_id: int, task: asyncio.Task) -> None:
+    if _running.get(chat_id) is task:
+        _running.pop(chat_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("bulk export task crashed: %s", task.exception())
+
+
+def start(message: Any, source: str) -> bool:
+    """Запускает экспорт в фоне; False — у этого чата экспорт уже идёт."""
+    chat_id = message.chat.id
+    cur = _running.get(chat_id)
+    if cur is not None and not cur.done():
+        metrics.inc("export.bulk.busy")
+        return False
+    task = asyncio.create_task(run(message, source))
+    task.add_done_callback(lambda t: _finished(chat_id, t))
+    _running[chat_id] = task
+    return True
@@ -1,8 +1,11 @@
 import os
+import logging
+import secrets
 import datetime as dt
 from typing import Optional, Literal, Tuple, List, Any, Dict
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,6 +17,12 @@ if not MONGODB_URI:
     raise RuntimeError("MONGODB_URI is not set in .env")
 
 MAX_TURNS = int(os.getenv("MAX_TURNS", "30"))
+# Реестр ответов хранит полный текст — старые записи удаляет TTL-индекс
+ANSWERS_TTL_DAYS = int(os.getenv("ANSWERS_TTL_DAYS", "30"))
+QUEUE_TTL_DAYS = int(os.getenv("QUEUE_TTL_DAYS", "14"))
+USAGE_TTL_DAYS = int(os.getenv("USAGE_TTL_DAYS", "180"))
+
+log = logging.getLogger("db")
 
 client = AsyncIOMotorClient(MONGODB_URI, tz_aware=True, tzinfo=dt.timezone.utc)
 db = client[MONGODB_DB]
@@ -21,6 +30,12 @@ users = db["users"]
 history = db["history"]
 bookmarks = db["bookmarks"]
 payments = db["payments"]
+qa_cache = db["qa_cache"]
+recall_index = db["recall_index"]
+usage = db["usage"]
+answers = db["answers"]
+webhook_inbox = db["webhook_inbox"]
+outbox = db["outbox"]
 
 Plan = Literal["free", "lite", "pro"]
 
@@ -459,10 +474,47 @@ async def get_history(chat_id: int, max_turns: Optional[int] = None) -> List[Dic
     return items
 
 
+async def get_last_assistant(chat_id: int) -> Optional[str]:
+    doc = await history.find_one(
+        {"chat_id": chat_id, "role": "assistant"}, sort=[("ts", -1)], projection={"content": 1}
+    )
+    return None if doc is None else (doc.get("content") or "")
+
+
 async def clear_history(chat_id: int) -> None:
     await history.delete_many({"chat_id": chat_id})
 
 
+async def iter_answers_since(chat_id: int, after: Optional[dt.datetime] = None, limit: int = 2000):
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if after is not None:
+        query["ts"] = {"$gt": after}
+    for coll, q in ((history, dict(query, role="assistant")), (bookmarks, query)):
+        cursor = coll.find(q, {"content": 1, "ts": 1, "_id": 0}).sort("ts", -1).limit(int(limit))
+        docs = [doc async for doc in cursor]
+        for doc in reversed(docs):
+            if doc.get("content"):
+                yield doc["content"], _to_aware_utc(doc.get("ts"))
+
+
+async def recall_snapshot_get(chat_id: int) -> Optional[bytes]:
+    doc = await recall_index.find_one({"_id": int(chat_id)}, {"blob": 1})
+    blob = (doc or {}).get("blob")
+    return bytes(blob) if blob is not None else None
+
+
+async def recall_snapshot_put(chat_id: int, blob: bytes, upto: Optional[dt.datetime]) -> None:
+    await recall_index.update_one(
+        {"_id": int(chat_id)},
+        {"$set": {"blob": blob, "upto": upto, "updated_at": _now_utc()}},
+        upsert=True,
+    )
+
+
+async def recall_snapshot_drop(chat_id: int) -> None:
+    await recall_index.delete_one({"_id": int(chat_id)})
+
+
 async def remember_bookmark(chat_id: int, content: str) -> None:
     if not content:
         return
@@ -490,6 +542,199 @@ async def get_last_bookmark(chat_id: int) -> Optional[str]:
     return (doc or {}).get("content")
 
 
+def _export_coll(source: Literal["history", "bookmarks"]):
+    return bookmarks if source == "bookmarks" else history
+
+
+async def export_count(chat_id: int, source: Literal["history", "bookmarks"]) -> int:
+    return await _export_coll(source).count_documents({"chat_id": chat_id})
+
+
+async def iter_export_batches(
+    chat_id: int,
+    source: Literal["history", "bookmarks"],
+    batch_size: int = 100,
+    skip: int = 0,
+):
+    """Записи чата от старых к новым пачками по batch_size — курсор не держит всю историю в памяти."""
+    cursor = (
+        _export_coll(source)
+        .find({"chat_id": chat_id}, {"role": 1, "content": 1, "ts": 1, "_id": 0})
+        .sort("ts", 1)
+        .skip(int(skip))
+        .batch_size(int(batch_size))
+    )
+    batch: List[Dict[str, Any]] = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def qa_cache_put(
+    key: int,
+    question: str,
+    answer: str,
+    sig: bytes,
+    guard: int,
+    scope: str,
+) -> None:
+    now = _now_utc()
+    await qa_cache.update_one(
+        {"_id": int(key)},
+        {
+            # ok — признак качества: снимается, если ответ перегенерировали или на него пожаловались
+            "$setOnInsert": {"_id": int(key), "created_at": now, "hits": 0, "ok": True},
+            "$set": {"q": question, "a": answer, "sig": sig, "guard": int(guard), "scope": scope, "updated_at": now},
+        },
+        upsert=True,
+    )
+
+
+async def qa_cache_get(key: int) -> Optional[Dict[str, Any]]:
+    # Записи без флага ok (до его появления) и помеченные плохими не выдаются
+    return await qa_cache.find_one_and_update(
+        {"_id": int(key), "ok": True},
+        {"$inc": {"hits": 1}},
+        projection={"a": 1, "q": 1},
+    )
+
+
+async def qa_cache_flag(key: int, reason: str) -> None:
+    await qa_cache.update_one(
+        {"_id": int(key)},
+        {"$set": {"ok": False, "flag": reason, "flagged_at": _now_utc()}},
+    )
+
+
+async def qa_cache_replace_flagged(key: int, answer: str) -> None:
+    await qa_cache.update_one(
+        {"_id": int(key), "ok": {"$ne": True}},
+        {"$set": {"a": answer, "ok": True, "updated_at": _now_utc()}, "$unset": {"flag": "", "flagged_at": ""}},
+    )
+
+
+async def qa_cache_iter_signatures(limit: int = 200000):
+    cursor = (
+        qa_cache.find({}, {"sig": 1, "guard": 1})
+        .sort("updated_at", -1)
+        .limit(int(limit))
+        .batch_size(5000)
+    )
+    async for doc in cursor:
+        if doc.get("sig") is not None:
+            yield doc["_id"], bytes(doc["sig"]), int(doc.get("guard") or 0)
+
+
+# ---------- Индексы ----------
+
+async def _ensure_index(coll, keys, **kwargs: Any) -> None:
+    try:
+        await coll.create_index(keys, **kwargs)
+    except Exception as e:
+        ttl = kwargs.get("expireAfterSeconds")
+        if ttl is not None and len(keys) == 1 and getattr(e, "code", None) in {85, 86}:
+            # Индекс на поле уже есть без TTL или с другим сроком — меняем срок на месте, не пересоздавая
+            try:
+                await db.command("collMod", coll.name, index={"keyPattern": dict(keys), "expireAfterSeconds": ttl})
+                return
+            except Exception as e2:
+                e = e2
+        # Остальные индексы это не должно блокировать
+        log.warning("index %s on %s not ensured: %s", keys, coll.name, e)
+
+
+async def ensure_indexes() -> None:
+    """Индексы под горячие запросы. create_index идемпотентен — вызывается при каждом старте."""
+    await _ensure_index(history, [("chat_id", 1), ("role", 1), ("ts", -1)])
+    # get_history и /export сортируют записи чата по времени — без индекса это сортировка в памяти
+    await _ensure_index(history, [("chat_id", 1), ("ts", 1)])
+    await _ensure_index(bookmarks, [("chat_id", 1), ("ts", 1)])
+    await _ensure_index(answers, [("ts", 1)], expireAfterSeconds=ANSWERS_TTL_DAYS * 86400)
+    await _ensure_index(qa_cache, [("updated_at", -1)])
+    # Часовые бакеты учёта нужны отчётам за последние дни, хранить их вечно незачем
+    await _ensure_index(usage, [("bucket", 1)], expireAfterSeconds=USAGE_TTL_DAYS * 86400)
+    await queue_ensure_indexes()
+
+
+# Реестр выданных ответов: короткий id уходит в callback_data кнопок,
+# к записи привязываются производные артефакты (pdf, quiz, voice)
+
+async def answer_create(chat_id: int, text: str, kind: str = "text") -> str:
+    aid = secrets.token_urlsafe(8)
+    await answers.insert_one(
+        {"_id": aid, "chat_id": chat_id, "kind": kind, "text": text, "artefacts": {}, "ts": _now_utc()}
+    )
+    return aid
+
+
+async def answer_get(aid: str, chat_id: int) -> Optional[Dict[str, Any]]:
+    return await answers.find_one({"_id": aid, "chat_id": chat_id})
+
+
+async def answer_set_artefact(aid: str, name: str, value: Any) -> None:
+    await answers.update_one({"_id": aid}, {"$set": {f"artefacts.{name}": value}})
+
+
+async def answer_clear_artefact(aid: str, name: str) -> None:
+    await answers.update_one({"_id": aid}, {"$unset": {f"artefacts.{name}": ""}})
+
+
+async def usage_insert_many(docs: List[Dict[str, Any]]) -> None:
+    if docs:
+        await usage.insert_many(docs, ordered=False)
+
+
+def _usage_since(days: int) -> dt.datetime:
+    start = _now_utc() - dt.timedelta(days=max(1, int(days)) - 1)
+    return start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def usage_aggregate_daily(days: int = 7) -> List[Dict[str, Any]]:
+    pipeline = [
+        {"$match": {"bucket": {"$gte": _usage_since(days)}}},
+        {
+            "$group": {
+                "_id": {
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$bucket"}},
+                    "plan": "$plan",
+                    "model": "$model",
+                },
+                "calls": {"$sum": "$calls"},
+                "prompt_tokens": {"$sum": "$prompt_tokens"},
+                "completion_tokens": {"$sum": "$completion_tokens"},
+                "chars": {"$sum": "$chars"},
+            }
+        },
+    ]
+    out: List[Dict[str, Any]] = []
+    async for doc in usage.aggregate(pipeline):
+        row = dict(doc["_id"])
+        row.update({k: doc.get(k, 0) for k in ("calls", "prompt_tokens", "completion_tokens", "chars")})
+        out.append(row)
+    return out
+
+
+async def usage_distinct_chats(days: int = 7) -> Dict[Tuple[str, str], int]:
+    pipeline = [
+        {"$match": {"bucket": {"$gte": _usage_since(days)}}},
+        {
+            "$group": {
+                "_id": {
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$bucket"}},
+                    "plan": "$plan",
+                    "chat_id": "$chat_id",
+                }
+            }
+        },
+        {"$group": {"_id": {"day": "$_id.day", "plan": "$_id.plan"}, "n": {"$sum": 1}}},
+    ]
+    return {(doc["_id"]["day"], doc["_id"]["plan"]): int(doc["n"]) async for doc in usage.aggregate(pipeline)}
+
+
 async def payment_create(
     pay_id: str,
     chat_id: int,
@@ -559,6 +804,84 @@ async def payment_find_by_external_id(external_id: str) -> Optional[Dict[str, An
 REF_REWARD_BATCH = int(os.getenv("REF_BONUS_THRESHOLD", "6"))
 
 
+# ---------- Очереди вебхуков и уведомлений ----------
+# webhook_inbox — сырые события платёжки, outbox — сообщения пользователям. Обе — очереди с арендой:
+# документ забирает один обработчик до due_at; если тот упал, по истечении аренды событие заберёт следующий.
+
+async def queue_ensure_indexes() -> None:
+    for coll in (webhook_inbox, outbox):
+        await _ensure_index(coll, [("status", 1), ("due_at", 1)])
+        # Обработанные события (done/rejected/failed) удаляются через QUEUE_TTL_DAYS; у ждущих finished_at нет
+        await _ensure_index(coll, [("finished_at", 1)], expireAfterSeconds=QUEUE_TTL_DAYS * 86400)
+
+
+async def _queue_put(coll, key: str, doc: Dict[str, Any]) -> bool:
+    now = _now_utc()
+    res = await coll.update_one(
+        {"_id": str(key)},
+        {"$setOnInsert": {**doc, "_id": str(key), "status": "new", "attempts": 0, "received_at": now, "due_at": now}},
+        upsert=True,
+    )
+    return bool(getattr(res, "upserted_id", None))
+
+
+async def _queue_claim(coll, lease_sec: float) -> Optional[Dict[str, Any]]:
+    now = _now_utc()
+    return await coll.find_one_and_update(
+        {"status": {"$in": ["new", "processing"]}, "due_at": {"$lte": now}},
+        {"$set": {"status": "processing", "due_at": now + dt.timedelta(seconds=lease_sec)}, "$inc": {"attempts": 1}},
+        sort=[("due_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _queue_finish(coll, key: str, status: str, error: Optional[str] = None) -> None:
+    await coll.update_one(
+        {"_id": str(key)},
+        {"$set": {"status": status, "error": error, "finished_at": _now_utc()}},
+    )
+
+
+async def _queue_retry(coll, key: str, delay_sec: float, error: str) -> None:
+    await coll.update_one(
+        {"_id": str(key)},
+        {"$set": {"status": "new", "error": error, "due_at": _now_utc() + dt.timedelta(seconds=delay_sec)}},
+    )
+
+
+async def inbox_put(key: str, provider: str, payload: Dict[str, Any]) -> bool:
+    """False — такое событие уже принято (повтор от провайдера)."""
+    return await _queue_put(webhook_inbox, key, {"provider": str(provider), "payload": payload})
+
+
+async def inbox_claim(lease_sec: float) -> Optional[Dict[str, Any]]:
+    return await _queue_claim(webhook_inbox, lease_sec)
+
+
+async def inbox_finish(key: str, status: str, error: Optional[str] = None) -> None:
+    await _queue_finish(webhook_inbox, key, status, error)
+
+
+async def inbox_retry(key: str, delay_sec: float, error: str) -> None:
+    await _queue_retry(webhook_inbox, key, delay_sec, error)
+
+
+async def outbox_put(key: str, chat_id: int, text: str) -> bool:
+    return await _queue_put(outbox, key, {"chat_id": int(chat_id), "text": str(text)})
+
+
+async def outbox_claim(lease_sec: float) -> Optional[Dict[str, Any]]:
+    return await _queue_claim(outbox, lease_sec)
+
+
+async def outbox_finish(key: str, status: str, error: Optional[str] = None) -> None:
+    await _queue_finish(outbox, key, status, error)
+
+
+async def outbox_retry(key: str, delay_sec: float, error: str) -> None:
+    await _queue_retry(outbox, key, delay_sec, error)
+
+
 async def extend_pro_months(chat_id: int, months: int = 1) -> dt.datetime:
     doc = await ensure_user(chat_id)
     now = _now_utc()
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import os
+import re
+import asyncio
+import random
+import logging
+import hashlib
+import zlib
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple, Iterable
+
+log = logging.getLogger("dedup")
+
+DEDUP_ENABLED = (os.getenv("DEDUP_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+DEDUP_MIN_QUESTION_CHARS = int(os.getenv("DEDUP_MIN_QUESTION_CHARS", "25"))
+DEDUP_MIN_ANSWER_CHARS = int(os.getenv("DEDUP_MIN_ANSWER_CHARS", "200"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "1000000"))
+DEDUP_WARM_LIMIT = int(os.getenv("DEDUP_WARM_LIMIT", "200000"))
+# Повтор того же вопроса тем же чатом в этом окне — знак, что прошлый ответ не устроил
+DEDUP_REASK_WINDOW_SEC = float(os.getenv("DEDUP_REASK_WINDOW_SEC", "900"))
+
+SHINGLE_SIZE = 5
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+_MERSENNE = (1 << 61) - 1
+_MASK16 = 0xFFFF
+_MASK32 = 0xFFFFFFFF
+
+_rng = random.Random(0x5EED)
+_PERM_A = [_rng.randrange(1, _MERSENNE) for _ in range(NUM_PERM)]
+_PERM_B = [_rng.randrange(0, _MERSENNE) for _ in range(NUM_PERM)]
+_PERMS = list(zip(_PERM_A, _PERM_B))
+
+
+# --- Нормализация текста вопроса ---
+
+_RE_FILLERS = re.compile(
+    r"\b(?:"
+    r"пожалуйста|плиз|pls|please|"
+    r"помоги(?:те)?(?:\s+мне)?(?:\s+(?:решить|с|разобраться(?:\s+с)?))?|"
+    r"подскажи(?:те)?|объясни(?:те)?(?:\s+мне)?|"
+    r"реши(?:те)?(?:\s+(?:задачу|задачи|пример|уравнение))?|"
+    r"решить(?:\s+(?:задачу|задачи|пример|уравнение))?|"
+    r"can\s+you|could\s+you|help\s+me(?:\s+(?:to\s+)?solve)?|solve(?:\s+(?:this|the))?(?:\s+(?:problem|task|equation))?"
+    r")\b",
+    re.IGNORECASE,
+)
+_RE_NUMBERING = re.compile(r"^\s*(?:№\s*\d+|\d{1,3}\s*[.)]|[a-zа-я]\s*\))\s*", re.IGNORECASE)
+_RE_NUMBERS = re.compile(r"\d+(?:[.,]\d+)?")
+_RE_NON_WORD = re.compile(r"[^\w+\-*/=^<>()]+", re.UNICODE)
+_RE_SPACES = re.compile(r"\s+")
+
+
+# Вопрос ссылается на предыдущий диалог — ответ на него зависит от чужого контекста
+_RE_CONTEXT_REF = re.compile(
+    r"^\s*(?:а|и|and|but|so)\s|"
+    r"\b(?:а если|а что если|а теперь|а почему|а как|предыдущ\w*|прошл\w*|выше|ниже|"
+    r"ещ[её] раз|то же самое|тот же|та же|то же|продолж\w*|дальше|подробнее|как раньше|"
+    r"what if|what about|previous|above|same one|the same|continue|again|more detail\w*)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(text: str) -> str:
+    t = (text or "").lower().replace("ё", "е")
+    t = _RE_NUMBERING.sub("", t)
+    t = _RE_FILLERS.sub(" ", t)
+    t = _RE_NON_WORD.sub(" ", t)
+    return _RE_SPACES.sub(" ", t).strip()
+
+
+def _shingle_hashes(norm: str) -> List[int]:
+    if not norm:
+        return []
+    if len(norm) <= SHINGLE_SIZE:
+        return [zlib.crc32(norm.encode("utf-8"))]
+    return list({zlib.crc32(norm[i:i + SHINGLE_SIZE].encode("utf-8")) for i in range(len(norm) - SHINGLE_SIZE + 1)})
+
+
+def signature(norm: str) -> array:
+    # b-bit MinHash: храним младшие 16 бит минимума каждой перестановки
+    hs = _shingle_hashes(norm)
+    if not hs:
+        return array("H", [0] * NUM_PERM)
+    return array("H", [min((a * h + b) % _MERSENNE for h in hs) & _MASK16 for a, b in _PERMS])
+
+
+def guard_of(norm: str, scope: str) -> int:
+    # Числа в условии должны совпадать точно: «2x+3=5» и «2x+3=7» — разные задачи
+    nums = ",".join(_RE_NUMBERS.findall(norm))
+    return zlib.crc32(f"{scope}|{nums}".encode("utf-8"))
+
+
+def question_key(norm: str, scope: str) -> int:
+    digest = hashlib.blake2b(f"{scope}|{norm}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def _band_keys(sig: array) -> List[int]:
+    out: List[int] = []
+    for b in range(BANDS):
+        h = 0x811C9DC5
+        for v in sig[b * ROWS:(b + 1) * ROWS]:
+            h = ((h ^ v) * 0x01000193) & _MASK32
+        out.append(h)
+    return out
+
+
+class NearDupIndex:
+    """MinHash/LSH-индекс с array-хранилищем: сигнатуры, guard и внешние ключи лежат плоскими массивами,
+    бакеты каждой полосы — отсортированный array('Q') из (band_key << 32 | id) плюс небольшой «хвост» свежих вставок."""
+
+    def __init__(self, max_entries: int = DEDUP_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._sigs = array("H")
+        self._guards = array("I")
+        self._keys = array("q")
+        self._main: List[array] = [array("Q") for _ in range(BANDS)]
+        self._tail: List[Dict[int, List[int]]] = [{} for _ in range(BANDS)]
+        self._tail_size = 0
+        self._full_logged = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: int, sig: array, guard: int) -> bool:
+        idx = len(self._keys)
+        if idx >= self.max_entries:
+            if not self._full_logged:
+                log.warning("near-dup index is full (%s entries), new questions are not indexed", idx)
+                self._full_logged = True
+            return False
+        self._sigs.extend(sig)
+        self._guards.append(guard & _MASK32)
+        self._keys.append(key)
+        for b, bk in enumerate(_band_keys(sig)):
+            self._tail[b].setdefault(bk, []).append(idx)
+        self._tail_size += 1
+        if self._tail_size >= max(1024, len(self._keys) // 4):
+            self._compact()
+        return True
+
+    def _compact(self) -> None:
+        for b in range(BANDS):
+            fresh = [(bk << 32) | i for bk, ids in self._tail[b].items() for i in ids]
+            fresh.sort()
+            # main и fresh уже отсортированы — timsort сольёт их за линейное время
+            self._main[b] = array("Q", sorted(self._main[b].tolist() + fresh))
+            self._tail[b] = {}
+        self._tail_size = 0
+
+    def _candidates(self, sig: array) -> Iterable[int]:
+        seen = set()
+        for b, bk in enumerate(_band_keys(sig)):
+            main = self._main[b]
+            lo = bk << 32
+            pos = bisect_left(main, lo)
+            while pos < len(main) and (main[pos] >> 32) == bk:
+                i = main[pos] & _MASK32
+                if i not in seen:
+                    seen.add(i)
+                    yield i
+                pos += 1
+            for i in self._tail[b].get(bk, ()):
+                if i not in seen:
+                    seen.add(i)
+                    yield i
+
+    def similarity(self, idx: int, sig: array) -> float:
+        base = idx * NUM_PERM
+        own = self._sigs[base:base + NUM_PERM]
+        return sum(1 for x, y in zip(own, sig) if x == y) / NUM_PERM
+
+    def query(self, sig: array, guard: int, threshold: float = DEDUP_THRESHOLD) -> Optional[Tuple[int, float]]:
+        guard &= _MASK32
+        best: Optional[Tuple[int, float]] = None
+        for i in self._candidates(sig):
+            if self._guards[i] != guard:
+                continue
+            s = self.similarity(i, sig)
+            if s >= threshold and (best is None or s > best[1]):
+                best = (self._keys[i], s)
+        return best
+
+    def memory_bytes(self) -> int:
+        total = 0
+        for arr in (self._sigs, self._guards, self._keys, *self._main):
+            total += arr.buffer_info()[1] * arr.itemsize
+        return total
+
+
+# --- Связка с Mongo ---
+
+_index = NearDupIndex()
+_loaded = False
+_load_lock = asyncio.Lock()
+_load_failed_at = 0.0
+# После неудачного прогрева (Mongo недоступна) пробуем снова не чаще раза в это время
+DEDUP_WARM_RETRY_SEC = float(os.getenv("DEDUP_WARM_RETRY_SEC", "60"))
+
+
+async def _ensure_loaded() -> None:
+    global _loaded, _index, _load_failed_at
+    if _loaded:
+        return
+    # Первые запросы ждут один общий прогрев, а не видят наполовину заполненный индекс
+    async with _load_lock:
+        if _loaded or time.monotonic() - _load_failed_at < DEDUP_WARM_RETRY_SEC:
+            return
+        from db import qa_cache_iter_signatures
+
+        # Грузим в новый индекс и подменяем только после успеха: упавший прогрев не оставляет полуготовых данных
+        fresh = NearDupIndex()
+        try:
+            async for key, sig_bytes, guard in qa_cache_iter_signatures(limit=DEDUP_WARM_LIMIT):
+                sig = array("H")
+                sig.frombytes(sig_bytes)
+                if len(sig) == NUM_PERM:
+                    fresh.add(int(key), sig, int(guard))
+        except Exception as e:
+            _load_failed_at = time.monotonic()
+            log.warning("near-dup warmup failed, will retry in %.0fs: %s", DEDUP_WARM_RETRY_SEC, e)
+            return
+        _index = fresh
+        _loaded = True
+    log.info("near-dup index warmed up: %s entries", len(fresh))
+
+
+def self_contained(question: str, history: Optional[List[Dict[str, str]]]) -> bool:
+    """Ответ можно переиспользовать, только если вопрос понятен без предыдущих реплик чата."""
+    if not history:
+        return True
+    return not _RE_CONTEXT_REF.search((question or "").replace("ё", "е"))
+
+
+# chat_id -> (ключ вопроса, время) последнего выданного или сохранённого ответа
+_recent: Dict[int, Tuple[int, float]] = {}
+
+
+def _touch(chat_id: int, key: int) -> None:
+    _recent[chat_id] = (key, time.monotonic())
+    if len(_recent) > 50000:
+        cutoff = time.monotonic() - DEDUP_REASK_WINDOW_SEC
+        for cid in [c for c, (_, ts) in _recent.items() if ts < cutoff]:
+            _recent.pop(cid, None)
+
+
+def _reasked(chat_id: int, key: int) -> bool:
+    prev = _recent.get(chat_id)
+    return prev is not None and prev[0] == key and time.monotonic() - prev[1] < DEDUP_REASK_WINDOW_SEC
+
+
+def _scope(lang: Optional[str], mode: Optional[str]) -> str:
+    return f"{lang or ''}:{mode or ''}"
+
+
+async def find_answer(
+    question: str,
+    lang: Optional[str],
+    mode: Optional[str],
+    chat_id: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> Optional[Tuple[str, float, int]]:
+    """Готовый ответ на почти такой же вопрос: (ответ, сходство, ключ записи)."""
+    if not DEDUP_ENABLED or not self_contained(question, history):
+        return None
+    norm = normalize_question(question)
+    if len(norm) < DEDUP_MIN_QUESTION_CHARS:
+        return None
+    await _ensure_loaded()
+    scope = _scope(lang, mode)
+    hit = _index.query(signature(norm), guard_of(norm, scope))
+    if not hit:
+        return None
+    key, sim = hit
+    from db import qa_cache_get, qa_cache_flag
+
+    if _reasked(chat_id, key):
+        # Пользователь переспросил сразу после ответа — считаем это перегенерацией
+        _recent.pop(chat_id, None)
+        await qa_cache_flag(key, "regenerated")
+        return None
+    doc = await qa_cache_get(key)
+    answer = (doc or {}).get("a")
+    if not answer:
+        return None
+    _touch(chat_id, key)
+    return answer, sim, key
+
+
+async def report(chat_id: int, key: int) -> None:
+    """Пользователь отметил выданный готовый ответ как неподходящий — больше его не предлагаем."""
+    from db import qa_cache_flag
+
+    if _recent.get(chat_id, (None,))[0] == key:
+        _recent.pop(chat_id, None)
+    await qa_cache_flag(key, "reported")
+
+
+async def remember_answer(
+    question: str,
+    answer: str,
+    lang: Optional[str],
+    mode: Optional[str],
+    chat_id: int,
+    history: Optional[List[Dict[str, str]]] = None,
+) -> None:
+    if not DEDUP_ENABLED or not self_contained(question, history):
+        return
+    norm = normalize_question(question)
+    if len(norm) < DEDUP_MIN_QUESTION_CHARS or len((answer or "").strip()) < DEDUP_MIN_ANSWER_CHARS:
+        return
+    await _ensure_loaded()
+    scope = _scope(lang, mode)
+    sig = signature(norm)
+    guard = guard_of(norm, scope)
+    from db import qa_cache_put, qa_cache_replace_flagged
+
+    same = _index.query(sig, guard, threshold=1.0)
+    if same:
+        # Прежний ответ помечен плохим (или сохранён до появления флага) — заменяем свежим
+        await qa_cache_replace_flagged(same[0], answer)
+        _touch(chat_id, same[0])
+        return
+    key = question_key(norm, scope)
+
+    await qa_cache_put(key, question=norm, answer=answer, sig=sig.tobytes(), guard=guard, scope=scope)
+    _index.add(key, sig, guard)
+    _touch(chat_id, key)
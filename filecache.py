@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Optional
+
+import metrics
+
+log = logging.getLogger("filecache")
+
+# Кэш уже загруженных в Telegram файлов (голосовые, PDF): ключ — хэш содержимого и параметров генерации,
+# значение — file_id первой загрузки. Повторная отправка по file_id не требует ни синтеза, ни загрузки.
+FILE_CACHE_ENABLED = (os.getenv("FILE_CACHE_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+FILE_CACHE_MAX_ENTRIES = int(os.getenv("FILE_CACHE_MAX_ENTRIES", "20000"))
+
+_entries: "OrderedDict[str, str]" = OrderedDict()
+
+
+def key(kind: str, *parts: Any) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(kind.encode("utf-8"))
+    for part in parts:
+        h.update(b"\x1f")
+        h.update(repr(part).encode("utf-8"))
+    return f"{kind}:{h.hexdigest()}"
+
+
+def _kind(k: str) -> str:
+    return k.split(":", 1)[0]
+
+
+def _hit_rate(kind: str) -> None:
+    hits = metrics.counter(f"filecache.{kind}.hit")
+    total = hits + metrics.counter(f"filecache.{kind}.miss")
+    if total:
+        metrics.gauge(f"filecache.{kind}.hit_rate", round(hits / total, 4))
+
+
+def get(k: str) -> Optional[str]:
+    if not FILE_CACHE_ENABLED:
+        return None
+    kind = _kind(k)
+    file_id = _entries.get(k)
+    if file_id is None:
+        metrics.inc(f"filecache.{kind}.miss")
+    else:
+        _entries.move_to_end(k)
+        metrics.inc(f"filecache.{kind}.hit")
+    _hit_rate(kind)
+    return file_id
+
+
+def put(k: str, file_id: Optional[str]) -> None:
+    if not FILE_CACHE_ENABLED or not file_id:
+        return
+    _entries[k] = file_id
+    _entries.move_to_end(k)
+    while len(_entries) > FILE_CACHE_MAX_ENTRIES:
+        _entries.popitem(last=False)
+        metrics.inc("filecache.evicted")
+    metrics.gauge("filecache.entries", len(_entries))
+
+
+def forget(k: str) -> None:
+    """file_id перестал приниматься Telegram — убираем, следующий запрос сгенерирует файл заново."""
+    if _entries.pop(k, None) is not None:
+        metrics.inc(f"filecache.{_kind(k)}.stale")
+        metrics.gauge("filecache.entries", len(_entries))
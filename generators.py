@@ -1,14 +1,26 @@
 import os
-import base64
 import json
 import re
-from typing import AsyncIterator, List, Dict, Any, Literal, Tuple, Optional
+import asyncio
+import logging
+import contextlib
+from typing import AsyncIterator, List, Dict, Any, Literal, Tuple, Optional, Union
 
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+import metrics
+import breaker
+import usage
+import routing
+import loadctl
+import imageprep
+from recall import RECALL_TAIL_ITEMS
+
 load_dotenv()
 
+log = logging.getLogger("generators")
+
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise RuntimeError("OPENAI_API_KEY is not set")
@@ -19,6 +31,20 @@ VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", TEXT_MODEL)
 
 client = AsyncOpenAI(api_key=api_key, base_url=base_url or None)
 
+# TTFT SLA: если первый токен не пришёл за TTFT_DEADLINE_MS, параллельно запускаем
+# «страхующий» запрос (можно на другую модель/провайдера) и оставляем того, кто ответит первым.
+TTFT_DEADLINE_MS = int(os.getenv("TTFT_DEADLINE_MS", "6000"))
+FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL") or None
+FALLBACK_BASE_URL = os.getenv("OPENAI_FALLBACK_BASE_URL") or None
+
+STREAM_USAGE = (os.getenv("OPENAI_STREAM_USAGE") or "true").lower() in {"1", "true", "yes", "y"}
+
+fallback_client = (
+    AsyncOpenAI(api_key=os.getenv("OPENAI_FALLBACK_API_KEY") or api_key, base_url=FALLBACK_BASE_URL)
+    if FALLBACK_BASE_URL
+    else client
+)
+
 Lang = Literal["ru", "en", "uz", "kk", "de", "fr", "es", "tr", "ar", "hi"]
 DEFAULT_LANG: Lang = "ru"
 
@@ -580,6 +606,8 @@ def _compact_history(history: List[Dict[str, str]], max_items: int = 12) -> List
 def _prompt_pack(lang: Lang) -> Dict[str, str]:
     return PROMPTS.get(lang) or PROMPTS[DEFAULT_LANG]
 
+RECALL_HEADER = "Relevant excerpts from this user's earlier answers (use them only if the question refers back to them):"
+
 def _build_messages(
     user_text: str,
     history: List[Dict[str, str]],
@@ -587,6 +615,8 @@ def _build_messages(
     lang: Optional[str] = None,
     template: AnswerTemplate = "default",
     teacher_mode: bool = False,
+    recall: Optional[List[str]] = None,
+    max_history: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
     L = _norm_lang(lang)
     P = _prompt_pack(L)
@@ -607,47 +637,214 @@ def _build_messages(
     if teacher_mode:
         messages.append({"role": "system", "content": P["teacher_mode"]})
 
+    if recall:
+        excerpts = "\n---\n".join(recall)
+        messages.append({"role": "system", "content": f"{RECALL_HEADER}\n---\n{excerpts}"})
+
     if history:
-        messages.extend(_compact_history(history))
+        # Хвост истории укорачивается, только когда выдержки действительно подставлены
+        tail = RECALL_TAIL_ITEMS if recall else 12
+        if max_history is not None:
+            tail = min(tail, max_history)
+        messages.extend(_compact_history(history, max_items=tail))
     messages.append({"role": "user", "content": user_text})
     return messages
 
-async def _chat_create(**kwargs: Any):
-    return await client.chat.completions.create(**kwargs)
+async def _chat_create(
+    client_: Optional[AsyncOpenAI] = None,
+    *,
+    endpoint: str = "text",
+    retry: bool = False,
+    **kwargs: Any,
+):
+    # Стримы учитываются в _pump_stream целиком (слот и брейкер), а не только на время открытия
+    if kwargs.get("stream"):
+        return await (client_ or client).chat.completions.create(**kwargs)
+    async with loadctl.slot(usage.current_plan()):
+        async with breaker.guard(endpoint, retry=retry):
+            resp = await (client_ or client).chat.completions.create(**kwargs)
+    usage.record_openai(kwargs.get("model", ""), getattr(resp, "usage", None))
+    return resp
+
+def _delta_text(chunk: Any) -> Optional[str]:
+    if not getattr(chunk, "choices", None):
+        return None
+    delta = getattr(chunk.choices[0], "delta", None)
+    return getattr(delta, "content", None) if delta is not None else None
+
+def _approx_tokens(messages: List[Dict[str, Any]]) -> int:
+    chars = 0
+    for m in messages:
+        c = m.get("content")
+        chars += len(c) if isinstance(c, str) else 0
+    return chars // 4
+
+async def _pump_stream(
+    tag: str,
+    client_: AsyncOpenAI,
+    kwargs: Dict[str, Any],
+    queue: "asyncio.Queue[Tuple[str, Optional[str], Optional[BaseException]]]",
+    *,
+    endpoint: str = "text",
+    retry: bool = False,
+    handles: Optional[Dict[str, Any]] = None,
+) -> None:
+    try:
+        async with loadctl.slot(usage.current_plan()):
+            # Исход стрима записывается в брейкер один раз, когда он закончился. Отмена — не ошибка,
+            # кроме случая, когда основной стрим проиграл TTFT-хеджу (stream_chat помечает его call.lose())
+            async with breaker.guard(endpoint, retry=retry) as call:
+                if handles is not None:
+                    handles[tag] = call
+                stream = await _chat_create(client_, endpoint=endpoint, **kwargs)
+                try:
+                    async for chunk in stream:
+                        content = _delta_text(chunk)
+                        if content:
+                            call.first_byte()
+                            await queue.put((tag, content, None))
+                        u = getattr(chunk, "usage", None)
+                        if u is not None:
+                            usage.record_openai(kwargs.get("model", ""), u)
+                finally:
+                    with contextlib.suppress(Exception):
+                        await stream.close()
+        await queue.put((tag, None, None))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put((tag, None, e))
 
 async def stream_chat(
     messages: List[Dict[str, Any]],
     *,
     temperature: float = 0.4,
     priority: bool = False,
+    model: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    endpoint: str = "text",
+    response_format: Optional[Dict[str, Any]] = None,
 ) -> AsyncIterator[str]:
+    model = model or TEXT_MODEL
     kwargs: Dict[str, Any] = {
-        "model": TEXT_MODEL,
+        "model": model,
         "messages": messages,
         "temperature": temperature,
         "stream": True,
     }
+    if max_tokens:
+        kwargs[routing.MAX_TOKENS_PARAM] = max_tokens
+    if response_format:
+        kwargs["response_format"] = response_format
+    if STREAM_USAGE:
+        kwargs["stream_options"] = {"include_usage": True}
     if priority:
         kwargs["extra_headers"] = {"X-Queue": "priority", "X-Tier": "pro"}
 
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Tuple[str, Optional[str], Optional[BaseException]]]" = asyncio.Queue()
+    tasks: Dict[str, asyncio.Task] = {}
+    started_at = loop.time()
+    winner: Optional[str] = None
+    hedged = False
+    emitted = False
+    last_error: Optional[BaseException] = None
+    handles: Dict[str, Any] = {}
+
+    def start(tag: str, client_: AsyncOpenAI, kw: Dict[str, Any], endpoint: str, retry: bool = False) -> None:
+        tasks[tag] = asyncio.create_task(
+            _pump_stream(tag, client_, kw, queue, endpoint=endpoint, retry=retry, handles=handles)
+        )
+        metrics.inc(f"llm.stream.started.{tag}")
+
+    def start_hedge(reason: str) -> None:
+        nonlocal hedged
+        hedged = True
+        # Запасная модель может не уметь картинки — для vision хеджируем той же моделью
+        hedge_model = (FALLBACK_MODEL if endpoint == "text" else None) or model
+        hedge_kwargs = dict(kwargs, model=hedge_model)
+        hedge_endpoint = f"{endpoint}_fallback" if FALLBACK_BASE_URL else endpoint
+        start("hedge", fallback_client, hedge_kwargs, hedge_endpoint, retry=True)
+        metrics.inc(f"llm.hedge.started.{reason}")
+        log.info("hedging stream (%s) with model=%s", reason, hedge_kwargs["model"])
+
+    async def cancel(tag: str) -> None:
+        t = tasks.pop(tag, None)
+        if t is None:
+            return
+        t.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await t
+        metrics.inc("llm.hedge.wasted_tokens_est", _approx_tokens(messages))
+
+    start("primary", client, kwargs, endpoint)
     try:
-        stream = await _chat_create(**kwargs)
-        async for chunk in stream:
-            if not getattr(chunk, "choices", None):
+        while tasks or not queue.empty():
+            timeout: Optional[float] = None
+            if winner is None and not hedged and TTFT_DEADLINE_MS > 0:
+                timeout = max(0.0, started_at + TTFT_DEADLINE_MS / 1000 - loop.time())
+            try:
+                tag, content, err = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                start_hedge("ttft")
                 continue
-            delta = getattr(chunk.choices[0], "delta", None)
-            content = getattr(delta, "content", None) if delta is not None else None
-            if content:
-                yield content
+
+            if winner is not None and tag != winner:
+                if content:
+                    metrics.inc("llm.hedge.wasted_tokens_est", len(content) // 4)
+                continue
+
+            if content is None:
+                tasks.pop(tag, None)
+                if err is not None:
+                    if isinstance(err, loadctl.Overloaded):
+                        # Очередь FREE переполнена — хедж и повтор только усилили бы перегруз
+                        raise err
+                    last_error = err
+                    metrics.inc(f"llm.stream.error.{tag}")
+                if emitted:
+                    if err is not None:
+                        # Часть ответа уже у пользователя — повтор задублировал бы текст
+                        raise err
+                    return
+                if err is None and not tasks:
+                    return
+                if winner is None and not hedged and not tasks:
+                    start_hedge("error")
+                continue
+
+            if winner is None:
+                winner = tag
+                ttft = loop.time() - started_at
+                metrics.observe("llm.ttft_sec", ttft)
+                metrics.inc(f"llm.stream.first_token.{tag}")
+                if hedged:
+                    metrics.inc(f"llm.hedge.won.{tag}")
+                    if tag == "hedge" and "primary" in handles:
+                        # Основной эндпоинт стабильно медленнее дедлайна — это должно доходить до брейкера
+                        handles["primary"].lose()
+                for other in [t for t in tasks if t != tag]:
+                    await cancel(other)
+
+            emitted = True
+            yield content
+    finally:
+        for t in tasks.values():
+            t.cancel()
+
+    if emitted:
         return
-    except Exception:
-        pass
 
-    resp = await _chat_create(
-        model=TEXT_MODEL,
-        messages=messages,
-        temperature=temperature,
-    )
+    # Ни один стрим не выдал ни одного токена — один раз пробуем обычный запрос
+    if last_error is not None:
+        log.warning("streaming failed before first token: %s", last_error)
+    metrics.inc("llm.stream.fallback_nonstream")
+    fallback_kwargs: Dict[str, Any] = {"model": model, "messages": messages, "temperature": temperature}
+    if max_tokens:
+        fallback_kwargs[routing.MAX_TOKENS_PARAM] = max_tokens
+    if response_format:
+        fallback_kwargs["response_format"] = response_format
+    resp = await _chat_create(endpoint=endpoint, retry=True, **fallback_kwargs)
     text = (resp.choices[0].message.content or "").strip()
     if not text:
         return
@@ -662,17 +859,43 @@ async def stream_response_text(
     template: AnswerTemplate = "default",
     teacher_mode: bool = False,
     priority: bool = False,
+    recall: Optional[List[str]] = None,
+    plan: Optional[str] = None,
+    route_text: Optional[str] = None,
 ) -> AsyncIterator[str]:
-    temp = 0.18 if _needs_engineering_mode(user_text) else 0.45
+    engineering = _needs_engineering_mode(user_text)
+    temp = 0.18 if engineering else 0.45
+    route = routing.decide(
+        route_text or user_text,
+        plan=plan or ("pro" if priority else None),
+        engineering=engineering,
+        teacher=teacher_mode,
+        template=template,
+    )
+    route, max_history = loadctl.degrade(route, plan)
     messages = _build_messages(
         user_text,
         history,
         lang=lang,
         template=template,
         teacher_mode=teacher_mode,
+        recall=recall,
+        max_history=max_history,
     )
-    async for delta in stream_chat(messages, temperature=temp, priority=priority):
-        yield delta
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    ttft: Optional[float] = None
+    chars = 0
+    try:
+        async for delta in stream_chat(
+            messages, temperature=temp, priority=priority, model=route.model, max_tokens=route.max_tokens
+        ):
+            if ttft is None:
+                ttft = loop.time() - t0
+            chars += len(delta)
+            yield delta
+    finally:
+        routing.report(route, plan, ttft, loop.time() - t0, chars)
 
 async def generate_text(
     user_text: str,
@@ -683,28 +906,45 @@ async def generate_text(
     teacher_mode: bool = False,
     temperature: Optional[float] = None,
     priority: bool = False,
+    plan: Optional[str] = None,
 ) -> str:
+    engineering = _needs_engineering_mode(user_text)
     if temperature is None:
-        temperature = 0.18 if _needs_engineering_mode(user_text) else 0.45
+        temperature = 0.18 if engineering else 0.45
 
+    route = routing.decide(
+        user_text,
+        plan=plan or ("pro" if priority else None),
+        engineering=engineering,
+        teacher=teacher_mode,
+        template=template,
+    )
+    route, max_history = loadctl.degrade(route, plan)
     messages = _build_messages(
         user_text,
         history,
         lang=lang,
         template=template,
         teacher_mode=teacher_mode,
+        max_history=max_history,
     )
 
     kwargs: Dict[str, Any] = {
-        "model": TEXT_MODEL,
+        "model": route.model,
         "messages": messages,
         "temperature": temperature,
     }
+    if route.max_tokens:
+        kwargs[routing.MAX_TOKENS_PARAM] = route.max_tokens
     if priority:
         kwargs["extra_headers"] = {"X-Queue": "priority", "X-Tier": "pro"}
 
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
     resp = await _chat_create(**kwargs)
-    return (resp.choices[0].message.content or "").strip()
+    text = (resp.choices[0].message.content or "").strip()
+    routing.report(route, plan, None, loop.time() - t0, len(text))
+    return text
 
 async def teacher_explain(
     user_text: str,
@@ -769,12 +1009,81 @@ def _safe_load_json(text: str) -> Dict[str, Any]:
         except Exception:
             return {}
 
-async def quiz_from_answer(
+QUIZ_JSON_MODE = (os.getenv("QUIZ_JSON_MODE") or "true").lower() in {"1", "true", "yes", "y"}
+
+class _QuizItemScanner:
+    """Инкрементальный разбор JSON: отдаёт каждый объект-элемент массива, как только он закрылся.
+    Строки и экранирование учитываются, поэтому фигурные скобки внутри текста вопросов не мешают."""
+
+    def __init__(self) -> None:
+        self.stack: List[str] = []
+        self.in_str = False
+        self.escape = False
+        self.item_start: Optional[int] = None
+        self.text = ""
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        base = len(self.text)
+        self.text += chunk
+        for i, ch in enumerate(chunk, base):
+            if self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+                continue
+            if ch == '"':
+                self.in_str = True
+            elif ch in "{[":
+                if ch == "{" and self.stack and self.stack[-1] == "[":
+                    self.item_start = i
+                self.stack.append(ch)
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if ch == "}" and self.item_start is not None and self.stack and self.stack[-1] == "[":
+                    obj = _loads_tolerant(self.text[self.item_start:i + 1])
+                    self.item_start = None
+                    if obj is not None:
+                        out.append(obj)
+        return out
+
+def _loads_tolerant(s: str) -> Optional[Dict[str, Any]]:
+    try:
+        obj = json.loads(s)
+    except Exception:
+        try:
+            obj = json.loads(re.sub(r",\s*([}\]])", r"\1", "".join(ch for ch in s if ord(ch) >= 32)))
+        except Exception:
+            return None
+    return obj if isinstance(obj, dict) else None
+
+def _fix_quiz_item(item: Any) -> Optional[Dict[str, Any]]:
+    if not isinstance(item, dict):
+        return None
+    qtext = str(item.get("q", "")).strip()
+    opts = list(item.get("options") or [])
+    opts = [str(x).strip() for x in opts][:4]
+    while len(opts) < 4:
+        opts.append("—")
+    corr = str(item.get("correct", "A")).strip().upper()[:1]
+    if corr not in {"A", "B", "C", "D"}:
+        corr = "A"
+    why = str(item.get("why", "")).strip()
+    if not qtext:
+        return None
+    return {"q": qtext, "options": opts, "correct": corr, "why": why}
+
+async def stream_quiz_from_answer(
     answer_text: str,
     *,
     lang: Optional[str] = None,
     n_questions: int = 4,
-) -> Tuple[str, Dict[str, Any]]:
+) -> AsyncIterator[Dict[str, Any]]:
+    """Стримит вопросы мини-теста по одному, по мере того как модель закрывает очередной JSON-объект."""
     L = _norm_lang(lang)
     P = _prompt_pack(L)
 
@@ -783,63 +1092,155 @@ async def quiz_from_answer(
         + "\n\n=== SOURCE ===\n"
         + (answer_text or "")
     )
+    messages = [
+        {"role": "system", "content": P["quiz_system"]},
+        {"role": "system", "content": P["language_rule"]},
+        {"role": "user", "content": user},
+    ]
 
-    resp = await _chat_create(
-        model=TEXT_MODEL,
-        messages=[
-            {"role": "system", "content": P["quiz_system"]},
-            {"role": "system", "content": P["language_rule"]},
-            {"role": "user", "content": user},
-        ],
+    scanner = _QuizItemScanner()
+    emitted = 0
+    async for delta in stream_chat(
+        messages,
         temperature=0.2,
-    )
-    raw = (resp.choices[0].message.content or "").strip()
+        endpoint="quiz",
+        response_format={"type": "json_object"} if QUIZ_JSON_MODE else None,
+    ):
+        for obj in scanner.feed(delta):
+            item = _fix_quiz_item(obj)
+            if item is not None and emitted < n_questions:
+                emitted += 1
+                yield item
 
-    data = _safe_load_json(raw)
-    questions = data.get("questions") or []
-    fixed: List[Dict[str, Any]] = []
-
-    for item in questions:
-        if not isinstance(item, dict):
-            continue
-        qtext = str(item.get("q", "")).strip()
-        opts = list(item.get("options") or [])
-        opts = [str(x).strip() for x in opts][:4]
-        while len(opts) < 4:
-            opts.append("—")
-        corr = str(item.get("correct", "A")).strip().upper()[:1]
-        if corr not in {"A", "B", "C", "D"}:
-            corr = "A"
-        why = str(item.get("why", "")).strip()
-        if qtext:
-            fixed.append({"q": qtext, "options": opts, "correct": corr, "why": why})
-
-    payload = {"questions": fixed}
+    if not emitted:
+        # Модель ответила не по формату (например, без массива) — пробуем разобрать целиком
+        for obj in (_safe_load_json(scanner.text).get("questions") or [])[:n_questions]:
+            item = _fix_quiz_item(obj)
+            if item is not None:
+                yield item
 
+def quiz_markdown(items: List[Dict[str, Any]], *, lang: Optional[str] = None) -> str:
+    P = _prompt_pack(_norm_lang(lang))
     ABCD = ["A", "B", "C", "D"]
     lines: List[str] = [P["mini_test_title"]]
-    total = len(fixed)
+    total = len(items)
 
-    for i, q in enumerate(fixed, 1):
+    for i, q in enumerate(items, 1):
         lines.append(f"\n{i}/{total}: {q['q']}")
         for j, label in enumerate(ABCD):
             lines.append(f"{label}) {q['options'][j]}")
 
-    return "\n".join(lines).strip(), payload
+    return "\n".join(lines).strip()
 
-async def solve_from_image(
-    image_bytes: bytes,
-    hint: str,
-    history: List[Dict[str, str]],
+async def quiz_from_answer(
+    answer_text: str,
     *,
     lang: Optional[str] = None,
-) -> str:
+    n_questions: int = 4,
+) -> Tuple[str, Dict[str, Any]]:
+    fixed = [q async for q in stream_quiz_from_answer(answer_text, lang=lang, n_questions=n_questions)]
+    return quiz_markdown(fixed, lang=lang), {"questions": fixed}
+
+ALBUM_NOTE = "The images are consecutive pages/parts of ONE problem, in order. Treat them together."
+
+# В конце ответа модель переписывает условие в служебный блок: он уходит в историю вместо картинки,
+# чтобы уточняющие вопросы шли обычным текстовым запросом. Блок идёт после решения, чтобы не задерживать
+# первые токены на экране
+TRANSCRIPT_OPEN = "<<<TASK"
+TRANSCRIPT_CLOSE = "TASK>>>"
+TRANSCRIPT_MAX_CHARS = int(os.getenv("VISION_TRANSCRIPT_MAX_CHARS", "1500"))
+TRANSCRIPT_NOTE = (
+    "After the solution, as the very last part of the reply, restate the recognised problem compactly "
+    "(given data, conditions, what to find, formulas as text) inside a block exactly like:\n"
+    f"{TRANSCRIPT_OPEN}\n...\n{TRANSCRIPT_CLOSE}\n"
+    "Never mention or refer to this block."
+)
+
+def _extract_transcript(text: str) -> Tuple[str, str]:
+    t = text or ""
+    start = t.find(TRANSCRIPT_OPEN)
+    if start < 0:
+        return "", t
+    end = t.find(TRANSCRIPT_CLOSE, start)
+    # Незакрытый блок (обрыв по лимиту токенов) — условие всё равно годится, а показывать его не нужно
+    body = t[start + len(TRANSCRIPT_OPEN):end if end >= 0 else len(t)]
+    rest = t[end + len(TRANSCRIPT_CLOSE):] if end >= 0 else ""
+    return body.strip()[:TRANSCRIPT_MAX_CHARS], (t[:start].rstrip() + "\n\n" + rest.lstrip()).strip()
+
+def _marker_prefix(text: str, marker: str) -> int:
+    # Длина хвоста text, который может оказаться началом marker, — его придерживаем до следующей дельты
+    for n in range(min(len(text), len(marker) - 1), 0, -1):
+        if marker.startswith(text[-n:]):
+            return n
+    return 0
+
+async def _strip_transcript(deltas: AsyncIterator[str], meta: Optional[Dict[str, str]]) -> AsyncIterator[str]:
+    """Пропускает решение сразу, вырезая блок условия; придерживаются только символы, похожие на начало маркера."""
+    pending = ""
+    block: Optional[str] = None
+    emitted = False
+    after_block = False
+    async for delta in deltas:
+        if block is None:
+            pending += delta
+            if after_block:
+                # Текст после блока: отрезаем ведущие переводы строк и отделяем его от решения абзацем
+                pending = pending.lstrip()
+                if not pending:
+                    continue
+                pending = ("\n\n" if emitted else "") + pending
+                after_block = False
+            start = pending.find(TRANSCRIPT_OPEN)
+            if start < 0:
+                keep = _marker_prefix(pending, TRANSCRIPT_OPEN)
+                out, pending = pending[:len(pending) - keep], pending[len(pending) - keep:]
+                if out:
+                    emitted = True
+                    yield out
+                continue
+            if pending[:start].strip():
+                emitted = True
+                yield pending[:start].rstrip()
+            block, pending = pending[start + len(TRANSCRIPT_OPEN):], ""
+        else:
+            block += delta
+        end = block.find(TRANSCRIPT_CLOSE)
+        if end >= 0:
+            if meta is not None:
+                meta["transcript"] = block[:end].strip()[:TRANSCRIPT_MAX_CHARS]
+            # После блока модель обычно уже ничего не пишет; если пишет — продолжаем как обычный текст
+            pending, block, after_block = block[end + len(TRANSCRIPT_CLOSE):], None, True
+        elif len(block) > TRANSCRIPT_MAX_CHARS * 2:
+            # Слишком длинно для условия — видимо, маркер попал в сам ответ; отдаём как есть
+            yield TRANSCRIPT_OPEN + block
+            block = None
+    if block is not None:
+        if meta is not None and block.strip():
+            meta["transcript"] = block.strip()[:TRANSCRIPT_MAX_CHARS]
+    elif pending.strip():
+        yield pending
+
+async def _vision_messages(
+    images: Union[bytes, List[bytes]],
+    hint: str,
+    history: List[Dict[str, str]],
+    lang: Optional[str],
+) -> List[Dict[str, Any]]:
     L = _norm_lang(lang)
     P = _prompt_pack(L)
 
-    data_url = "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode("utf-8")
+    if isinstance(images, (bytes, bytearray)):
+        images = [images]
+    prepared = await asyncio.gather(*(imageprep.prepare(b) for b in images))
+    image_parts = [
+        {"type": "image_url", "image_url": {"url": imageprep.data_url(data, mime)}} for data, mime in prepared
+    ]
+    del prepared
     text_hint = (hint or P["image_hint_default"]).strip()
     extra = P["image_extra_eng"]
+    if len(image_parts) > 1:
+        extra = f"{extra}\n{ALBUM_NOTE}"
+    extra = f"{extra}\n\n{TRANSCRIPT_NOTE}"
 
     messages: List[Dict[str, Any]] = [
         {"role": "system", "content": P["system_school"]},
@@ -856,14 +1257,42 @@ async def solve_from_image(
             "role": "user",
             "content": [
                 {"type": "text", "text": f"{text_hint}\n\n{extra}"},
-                {"type": "image_url", "image_url": {"url": data_url}},
+                *image_parts,
             ],
         }
     )
+    return messages
 
+async def solve_from_image(
+    image_bytes: Union[bytes, List[bytes]],
+    hint: str,
+    history: List[Dict[str, str]],
+    *,
+    lang: Optional[str] = None,
+    meta: Optional[Dict[str, str]] = None,
+) -> str:
     resp = await _chat_create(
+        endpoint="vision",
         model=VISION_MODEL,
-        messages=messages,
+        messages=await _vision_messages(image_bytes, hint, history, lang),
         temperature=0.18,
     )
-    return (resp.choices[0].message.content or "").strip()
+    transcript, answer = _extract_transcript(resp.choices[0].message.content or "")
+    if meta is not None and transcript:
+        meta["transcript"] = transcript
+    return answer.strip()
+
+async def stream_solve_from_image(
+    image_bytes: Union[bytes, List[bytes]],
+    hint: str,
+    history: List[Dict[str, str]],
+    *,
+    lang: Optional[str] = None,
+    priority: bool = False,
+    meta: Optional[Dict[str, str]] = None,
+) -> AsyncIterator[str]:
+    """meta["transcript"] получает распознанное условие, если модель вернула служебный блок."""
+    messages = await _vision_messages(image_bytes, hint, history, lang)
+    stream = stream_chat(messages, temperature=0.18, priority=priority, model=VISION_MODEL, endpoint="vision")
+    async for delta in _strip_transcript(stream, meta):
+        yield delta
@@ -1,10 +1,11 @@
 import os
 import json
+import html
 import asyncio
 import time
 import uuid
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from urllib.parse import quote_plus
 
 from aiogram import Router, F
@@ -23,7 +24,7 @@ from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 from aiogram.enums import ChatAction, ParseMode
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from generators import stream_response_text, solve_from_image, quiz_from_answer
+from generators import stream_response_text, stream_solve_from_image, stream_quiz_from_answer
 from db import (
     ensure_user, can_use, inc_usage, get_status_text,
     get_all_chat_ids, drop_chat, set_optin,
@@ -36,12 +37,29 @@ from db import (
     find_user_by_ref_code, set_referrer_once,
     apply_promocode_access,
     payment_create, payment_set_status,
+    get_last_assistant, answer_create, answer_get, answer_set_artefact, answer_clear_artefact,
 )
 
 from wata_client import WataClient
 
-from utils_export import pdf_from_answer_text
-from tts import tts_voice_ogg, split_for_tts
+from utils_export import PdfConfig
+import pdfpool
+import answerdoc
+import bulkexport
+from dedup import (
+    find_answer as dedup_find_answer,
+    remember_answer as dedup_remember_answer,
+    report as dedup_report,
+)
+from i18n.strings import t as i18n_t
+import recall
+import filecache
+import usage
+import loadctl
+import visioncache
+import quizspec
+from breaker import BreakerOpen
+from tts import tts_voice_ogg, split_for_tts, SpeechSegmenter, voice_cache_parts
 
 router = Router()
 
@@ -65,6 +83,9 @@ REF_BONUS_THRESHOLD = int(os.getenv("REF_BONUS_THRESHOLD", "6"))
 
 TTS_ENABLED_DEFAULT_PRO = False
 TTS_CHUNK_LIMIT = 2500
+TTS_FIRST_CHUNK_LIMIT = int(os.getenv("TTS_FIRST_CHUNK_LIMIT", "400"))
+TTS_PARALLEL = int(os.getenv("TTS_PARALLEL", "3"))
+QUIZ_QUESTIONS = 4
 
 
 def build_external_id(chat_id: int, plan: str) -> str:
@@ -129,6 +150,32 @@ LANGUAGE_HINTS: Dict[str, str] = {
     "hi": "Always respond to the user only in Hindi unless they explicitly ask for another language.",
 }
 
+BUSY_REPLIES: Dict[str, str] = {
+    "ru": "⏳ Сервис сейчас перегружен. Попробуйте ещё раз через минуту — запрос не списан.",
+    "en": "⏳ The service is overloaded right now. Please try again in a minute — this request was not charged.",
+    "uz": "⏳ Xizmat hozir band. Bir daqiqadan so‘ng qayta urinib ko‘ring — so‘rov hisobdan yechilmadi.",
+    "kk": "⏳ Қызмет қазір бос емес. Бір минуттан кейін қайталап көріңіз — сұраныс есептен шегерілмеді.",
+    "de": "⏳ Der Dienst ist gerade überlastet. Bitte versuche es in einer Minute erneut — die Anfrage wurde nicht angerechnet.",
+    "fr": "⏳ Le service est surchargé pour le moment. Réessayez dans une minute — cette demande n’a pas été décomptée.",
+    "es": "⏳ El servicio está saturado ahora mismo. Inténtalo de nuevo en un minuto: esta solicitud no se ha descontado.",
+    "tr": "⏳ Hizmet şu anda yoğun. Lütfen bir dakika sonra tekrar deneyin — bu istek hakkınızdan düşülmedi.",
+    "ar": "⏳ الخدمة مشغولة حاليًا. يرجى المحاولة مرة أخرى بعد دقيقة — لم يتم احتساب هذا الطلب.",
+    "hi": "⏳ सेवा अभी व्यस्त है। कृपया एक मिनट बाद फिर कोशिश करें — यह अनुरोध गिना नहीं गया।",
+}
+
+OVERLOAD_REPLIES: Dict[str, str] = {
+    "ru": "⏳ Сейчас пиковая нагрузка на бесплатный тариф. Попробуйте через ~{eta} с — запрос не списан. В LITE/PRO очереди нет.",
+    "en": "⏳ The free plan is under peak load right now. Please try again in ~{eta} s — this request was not charged. LITE/PRO have no queue.",
+    "uz": "⏳ Hozir bepul tarifda yuklama yuqori. ~{eta} soniyadan so‘ng urinib ko‘ring — so‘rov hisobdan yechilmadi. LITE/PRO’da navbat yo‘q.",
+    "kk": "⏳ Қазір тегін тарифте жүктеме жоғары. ~{eta} секундтан кейін қайталаңыз — сұраныс есептен шегерілмеді. LITE/PRO-да кезек жоқ.",
+    "de": "⏳ Der kostenlose Tarif ist gerade stark ausgelastet. Bitte versuche es in ~{eta} s erneut — die Anfrage wurde nicht angerechnet. LITE/PRO ohne Warteschlange.",
+    "fr": "⏳ L’offre gratuite est en pic de charge. Réessayez dans ~{eta} s — cette demande n’a pas été décomptée. LITE/PRO sans file d’attente.",
+    "es": "⏳ El plan gratuito tiene mucha carga ahora. Inténtalo de nuevo en ~{eta} s: esta solicitud no se ha descontado. LITE/PRO sin cola.",
+    "tr": "⏳ Ücretsiz planda şu an yoğunluk var. ~{eta} sn sonra tekrar deneyin — bu istek hakkınızdan düşülmedi. LITE/PRO’da sıra yok.",
+    "ar": "⏳ الخطة المجانية تحت ضغط كبير الآن. حاول مرة أخرى بعد ~{eta} ث — لم يتم احتساب هذا الطلب. لا يوجد انتظار في LITE/PRO.",
+    "hi": "⏳ मुफ़्त प्लान पर अभी भारी लोड है। ~{eta} सेकंड बाद फिर कोशिश करें — यह अनुरोध गिना नहीं गया। LITE/PRO में कोई कतार नहीं।",
+}
+
 DEFAULT_LANG = "ru"
 
 LANG_SELECT_KB = ReplyKeyboardMarkup(
@@ -153,6 +200,17 @@ async def get_user_lang(chat_id: int) -> str:
     return DEFAULT_LANG
 
 
+async def busy_text(chat_id: int, err: Optional[BaseException] = None) -> str:
+    try:
+        lang = await get_user_lang(chat_id)
+    except Exception:
+        lang = DEFAULT_LANG
+    if isinstance(err, loadctl.Overloaded):
+        tpl = OVERLOAD_REPLIES.get(lang) or OVERLOAD_REPLIES[DEFAULT_LANG]
+        return tpl.format(eta=int(err.retry_after))
+    return BUSY_REPLIES.get(lang) or BUSY_REPLIES[DEFAULT_LANG]
+
+
 async def ensure_language_selected(message: Message) -> Optional[str]:
     """
     Проверяем, выбран ли язык. Если нет — просим выбрать и НЕ продолжаем обработку.
@@ -377,6 +435,11 @@ async def _plan_flags(chat_id: int) -> Tuple[bool, bool, bool]:
     return ("план: free" in t, "план: lite" in t, "план: pro" in t)
 
 
+async def _plan_name(chat_id: int) -> str:
+    free, lite, pro = await _plan_flags(chat_id)
+    return "pro" if pro else "lite" if lite else "free" if free else "unknown"
+
+
 def plans_kb(show_back: bool = False) -> InlineKeyboardMarkup:
     row = [
         InlineKeyboardButton(text=f"🪙 LITE {LITE_PRICE} ₽", callback_data="pay_lite"),
@@ -394,15 +457,19 @@ def available_btn_kb() -> InlineKeyboardMarkup:
     )
 
 
-def answer_actions_kb(is_pro: bool) -> InlineKeyboardMarkup:
+def answer_actions_kb(is_pro: bool, aid: Optional[str] = None, reused: Optional[int] = None) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = [[]]
+    suffix = f":{aid}" if aid else ""
     if is_pro:
-        rows[0].append(InlineKeyboardButton(text="🎙 Озвучить", callback_data="tts_say"))
-        rows[0].append(InlineKeyboardButton(text="📄 PDF", callback_data="export_pdf"))
-        rows[0].append(InlineKeyboardButton(text="🧠 Проверить себя", callback_data="quiz_make"))
+        rows[0].append(InlineKeyboardButton(text="🎙 Озвучить", callback_data=f"tts_say{suffix}"))
+        rows[0].append(InlineKeyboardButton(text="📄 PDF", callback_data=f"export_pdf{suffix}"))
+        rows[0].append(InlineKeyboardButton(text="🧠 Проверить себя", callback_data=f"quiz_make{suffix}"))
     else:
         rows[0].append(InlineKeyboardButton(text="🔒 PDF (PRO)", callback_data="need_pro_pdf"))
         rows[0].append(InlineKeyboardButton(text="🔒 Проверить себя (PRO)", callback_data="need_pro_quiz"))
+    if reused is not None:
+        # Выдан готовый разбор из кэша похожих вопросов — даём пометить его как неподходящий
+        rows.append([InlineKeyboardButton(text="👎 Не то — решить заново", callback_data=f"dedup_bad:{reused}")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
@@ -455,7 +522,7 @@ MODE_KB = ReplyKeyboardMarkup(
 
 _last_send_ts: Dict[int, float] = {}
 _next_allowed_by_chat: Dict[int, float] = {}
-_export_lock: Dict[int, float] = {}
+_pdf_exports: set = set()
 QUIZ_STATE: Dict[int, Dict] = {}
 
 
@@ -470,11 +537,30 @@ async def _is_free(chat_id: int) -> bool:
 
 
 async def _last_assistant_text(chat_id: int) -> Optional[str]:
-    hist = await get_history(chat_id)
-    for item in reversed(hist):
-        if item.get("role") == "assistant":
-            return item.get("content") or ""
-    return None
+    return await get_last_assistant(chat_id)
+
+
+async def _register_answer(chat_id: int, text: str, kind: str) -> Optional[str]:
+    if not (text or "").strip():
+        return None
+    try:
+        return await answer_create(chat_id, text, kind)
+    except Exception:
+        return None
+
+
+async def _answer_for_call(call: CallbackQuery) -> Tuple[Optional[str], Optional[str], Dict[str, Any]]:
+    """(aid, текст, артефакты) для кнопки под ответом; старые кнопки без id работают по последнему ответу."""
+    chat_id = call.message.chat.id
+    _, _, aid = (call.data or "").partition(":")
+    if aid:
+        try:
+            doc = await answer_get(aid, chat_id)
+        except Exception:
+            doc = None
+        if doc is not None:
+            return aid, doc.get("text") or "", doc.get("artefacts") or {}
+    return None, await _last_assistant_text(chat_id), {}
 
 
 def _ref_link_from_code(code: str) -> str:
@@ -540,18 +626,25 @@ async def safe_send(message: Message, text: str, **kwargs):
         raise
 
 
-async def safe_edit(message: Message, message_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+async def safe_edit(
+    message: Message,
+    message_id: int,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    parse_mode: Optional[str] = None,
+) -> bool:
     try:
         await message.bot.edit_message_text(
             chat_id=message.chat.id,
             message_id=message_id,
             text=text,
-            reply_markup=reply_markup
+            reply_markup=reply_markup,
+            parse_mode=parse_mode,
         )
     except TelegramBadRequest as e:
         low = str(e).lower()
         if "message is not modified" in low:
-            return
+            return True
         if "too many requests" in low or "flood control exceeded" in low:
             await asyncio.sleep(1)
             try:
@@ -559,10 +652,14 @@ async def safe_edit(message: Message, message_id: int, text: str, reply_markup:
                     chat_id=message.chat.id,
                     message_id=message_id,
                     text=text,
-                    reply_markup=reply_markup
+                    reply_markup=reply_markup,
+                    parse_mode=parse_mode,
                 )
             except Exception:
-                pass
+                return False
+            return True
+        return False
+    return True
 
 
 async def safe_delete(msg):
@@ -604,6 +701,74 @@ async def send_long_text(message: Message, text: str):
         )
 
 
+def _start_typing(message: Message) -> asyncio.Task:
+    async def typing_loop():
+        while True:
+            try:
+                await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+            except Exception:
+                pass
+            await asyncio.sleep(4)
+
+    return asyncio.create_task(typing_loop())
+
+
+async def _stream_to_draft(message: Message, draft: Message, deltas: AsyncIterator[str]) -> str:
+    """Копит дельты стрима и раз в MIN_EDIT_INTERVAL обновляет черновик; возвращает весь текст."""
+    accumulated = ""
+    last_edit = 0.0
+    async for delta in deltas:
+        accumulated += delta
+        t = asyncio.get_event_loop().time()
+        if t - last_edit >= MIN_EDIT_INTERVAL:
+            await safe_edit(message, draft.message_id, accumulated or "…")
+            last_edit = t
+    return accumulated
+
+
+async def _tee_to_voice(deltas: AsyncIterator[str], parts: "asyncio.Queue[Optional[str]]") -> AsyncIterator[str]:
+    """Пропускает дельты дальше и параллельно отдаёт в очередь озвучки готовые куски текста."""
+    seg = SpeechSegmenter(first_chars=TTS_FIRST_CHUNK_LIMIT, max_chars=TTS_CHUNK_LIMIT)
+    async for delta in deltas:
+        for piece in seg.feed(delta):
+            parts.put_nowait(piece)
+        yield delta
+    for piece in seg.flush():
+        parts.put_nowait(piece)
+    parts.put_nowait(None)
+
+
+async def _finish_draft(
+    message: Message,
+    draft: Message,
+    text: str,
+    is_pro: bool,
+    with_actions: bool = True,
+    aid: Optional[str] = None,
+    head: str = "",
+    reused: Optional[int] = None,
+):
+    """Итоговый ответ: дерево answerdoc → HTML, нарезанный по границам блоков. head — служебная шапка над ответом."""
+    kb = answer_actions_kb(is_pro, aid, reused) if with_actions else None
+    head_html = html.escape(head, quote=False)
+    chunks = answerdoc.telegram_chunks(answerdoc.get(text, aid), MAX_TG_LEN - len(head_html)) or [html.escape(text)]
+    chunks[0] = head_html + chunks[0]
+    if len(chunks) == 1:
+        if not await safe_edit(message, draft.message_id, chunks[0], reply_markup=kb, parse_mode=ParseMode.HTML):
+            await safe_edit(message, draft.message_id, f"{head}{text}"[:MAX_TG_LEN], reply_markup=kb)
+        return
+    await safe_delete(draft)
+    last_kb = main_kb_for_plan(await _is_free(message.chat.id))
+    for i, chunk in enumerate(chunks):
+        markup = last_kb if i == len(chunks) - 1 else None
+        try:
+            await message.answer(chunk, reply_markup=markup, parse_mode=ParseMode.HTML)
+        except TelegramBadRequest:
+            await message.answer(answerdoc.html_to_text(chunk), reply_markup=markup)
+    if kb is not None:
+        await message.answer("Действия с ответом:", reply_markup=kb)
+
+
 async def show_subscriptions(message: Message):
     text = await get_status_text(message.chat.id)
     low = text.lower()
@@ -723,6 +888,10 @@ async def cmd_status(message: Message):
 @router.message(Command("reset"))
 async def cmd_reset(message: Message):
     await clear_history(message.chat.id)
+    try:
+        await recall.forget(message.chat.id)
+    except Exception:
+        pass
     await message.answer("🧹 Контекст очищен", reply_markup=main_kb_for_plan(await _is_free(message.chat.id)))
 
 
@@ -861,6 +1030,17 @@ async def cmd_forget(message: Message):
     await message.answer("🗑 Удалил последнюю закладку." if ok else "Закладок не найдено.")
 
 
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    if not await _is_pro(message.chat.id):
+        return await message.answer("Экспорт PDF доступен только в PRO.")
+    parts = (message.text or "").split(maxsplit=1)
+    arg = parts[1].strip().lower() if len(parts) > 1 else ""
+    source = "bookmarks" if arg in {"bookmarks", "закладки", "b"} else "history"
+    if not bulkexport.start(message, source):
+        await message.answer("Экспорт уже идёт — пришлю файл, как только он будет готов.")
+
+
 @router.message(Command("explain"))
 async def cmd_explain(message: Message, state: FSMContext):
     if not await _is_pro(message.chat.id):
@@ -1162,6 +1342,19 @@ async def admin_logout(message: Message):
         await message.answer("Вы не в админ-режиме.", reply_markup=main_kb_for_plan(await _is_free(message.chat.id)))
 
 
+@router.message(Command("usage"))
+async def cmd_usage(message: Message):
+    if not is_admin(message.from_user.id):
+        return await message.answer("⛔ Доступно только админам.")
+    parts = (message.text or "").split()
+    try:
+        days = max(1, min(90, int(parts[1]))) if len(parts) > 1 else 7
+    except ValueError:
+        days = 7
+    await usage.flush()
+    await send_long_text(message, await usage.plan_cost_report(days))
+
+
 @router.message(Command("unsubscribe"))
 async def cmd_unsub(message: Message):
     await set_optin(message.chat.id, False)
@@ -1500,8 +1693,20 @@ async def generate_answer(message: Message, state: FSMContext):
         await message.answer(msg, reply_markup=plans_kb(show_back=True))
         return
 
+    quizspec.cancel(chat_id)
     is_pro = await _is_pro(chat_id)
-    if is_pro and await is_teacher_mode(chat_id):
+    plan = await _plan_name(chat_id)
+    usage.bind(chat_id, plan, "text")
+    if plan == "free":
+        try:
+            loadctl.check_free()
+        except loadctl.Overloaded as e:
+            await message.answer(await busy_text(chat_id, e))
+            return
+    question = user_text
+    teacher = is_pro and await is_teacher_mode(chat_id)
+    dedup_mode = (await get_current_mode(chat_id)) + (":teacher" if teacher else "")
+    if teacher:
         user_text = (
             "Объясни как опытный учитель: короткое введение, пошаговое решение, "
             "где часто ошибаются, мини-проверка на 2–3 вопроса в конце.\n\nВопрос: "
@@ -1513,36 +1718,48 @@ async def generate_answer(message: Message, state: FSMContext):
     await state.set_state("generating")
     await message.bot.send_chat_action(chat_id, ChatAction.TYPING)
     draft = await safe_send(message, "Думаю…")
-    typing_alive = True
-
-    async def typing_loop():
-        while typing_alive:
-            try:
-                await message.bot.send_chat_action(chat_id, ChatAction.TYPING)
-            except Exception:
-                pass
-            await asyncio.sleep(4)
-
-    typing_task = asyncio.create_task(typing_loop())
+    typing_task = _start_typing(message)
     accumulated = ""
-    last_edit = 0.0
+    voice_task: Optional[asyncio.Task] = None
     try:
         history_msgs = await get_history(chat_id)
-        async for delta in stream_response_text(user_text, history_msgs, priority=is_pro, teacher_mode=False):
-            accumulated += delta
-            t = asyncio.get_event_loop().time()
-            if t - last_edit >= MIN_EDIT_INTERVAL:
-                await safe_edit(message, draft.message_id, accumulated or "…")
-                last_edit = t
-
-        final_text = (f"⚡ PRO-приоритет\n{accumulated}" if is_pro else accumulated) if accumulated else ""
-        if final_text:
-            if len(final_text) > MAX_TG_LEN:
-                await safe_delete(draft)
-                await send_long_text(message, final_text)
-                await message.answer("Действия с ответом:", reply_markup=answer_actions_kb(is_pro))
-            else:
-                await safe_edit(message, draft.message_id, final_text, reply_markup=answer_actions_kb(is_pro))
+        served = None
+        try:
+            served = await dedup_find_answer(question, lang, dedup_mode, chat_id, history_msgs)
+        except Exception:
+            served = None
+
+        if served:
+            accumulated = served[0]
+        else:
+            try:
+                snippets: Optional[List[str]] = await recall.search(chat_id, question, history_msgs)
+            except Exception:
+                snippets = None
+            deltas = stream_response_text(
+                user_text,
+                history_msgs,
+                priority=is_pro,
+                teacher_mode=False,
+                recall=snippets,
+                plan=plan,
+                route_text=question,
+            )
+            if is_pro and (await get_voice_settings(chat_id)).get("auto"):
+                # Авто-озвучка PRO: первые абзацы уходят в TTS, пока ответ ещё генерируется
+                voice_parts: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+                voice_task = asyncio.create_task(_voice_sender(message, voice_parts))
+                deltas = _tee_to_voice(deltas, voice_parts)
+            accumulated = await _stream_to_draft(message, draft, deltas)
+
+        head = "⚡ PRO-приоритет\n" if is_pro else ""
+        if served:
+            head = f"{i18n_t(lang, 'dedup_served')}\n\n{head}"
+        if accumulated:
+            aid = await _register_answer(chat_id, accumulated, "text")
+            await _finish_draft(
+                message, draft, accumulated, is_pro, aid=aid, head=head, reused=served[2] if served else None
+            )
         else:
             await safe_edit(message, draft.message_id, "Пустой ответ 😕")
 
@@ -1550,24 +1767,64 @@ async def generate_answer(message: Message, state: FSMContext):
         await add_history(chat_id, "assistant", accumulated or "")
         await inc_usage(chat_id, "text")
 
-        if is_pro:
+        if not served and accumulated:
+            try:
+                await dedup_remember_answer(question, accumulated, lang, dedup_mode, chat_id, history_msgs)
+                await recall.note(chat_id, accumulated)
+            except Exception:
+                pass
+
+        if is_pro and accumulated:
+            quizspec.schedule(chat_id, accumulated, n_questions=QUIZ_QUESTIONS)
+
+        if voice_task is not None:
+            await voice_task
+        elif is_pro:
             vs = await get_voice_settings(chat_id)
             if vs.get("auto") and accumulated:
-                await _send_tts_for_text(message, accumulated)
+                await _send_tts_for_text(message, accumulated, aid)
 
+    except BreakerOpen as e:
+        await safe_edit(message, draft.message_id, await busy_text(chat_id, e))
     except Exception as e:
         await safe_edit(message, draft.message_id, f"❌ Ошибка: {e}")
     finally:
-        typing_alive = False
         typing_task.cancel()
+        if voice_task is not None and not voice_task.done():
+            voice_task.cancel()
         await state.clear()
 
 
 # ----------------- ФОТО -----------------
 
+ALBUM_WINDOW_SEC = float(os.getenv("ALBUM_WINDOW_SEC", "1.2"))
+ALBUM_MAX_PHOTOS = 10
+_albums: Dict[str, List[Message]] = {}
+
+
+async def _download_photo(bot, size) -> bytes:
+    file = await bot.get_file(size.file_id)
+    buf = BytesIO()
+    await bot.download_file(file.file_path, buf)
+    return buf.getvalue()
+
+
 @router.message(F.photo)
 async def on_photo(message: Message, state: FSMContext):
     chat_id = message.chat.id
+    # Альбом приходит отдельными сообщениями: первое ждёт остальные и обрабатывает всю пачку разом
+    group = message.media_group_id
+    if group:
+        pending = _albums.get(group)
+        if pending is not None:
+            pending.append(message)
+            return
+        _albums[group] = [message]
+        await asyncio.sleep(ALBUM_WINDOW_SEC)
+        batch = sorted(_albums.pop(group, [message]), key=lambda m: m.message_id)[:ALBUM_MAX_PHOTOS]
+    else:
+        batch = [message]
+
     user_db_id = await ensure_user(chat_id)
     lang = await ensure_language_selected(message)
     if lang is None:
@@ -1586,72 +1843,108 @@ async def on_photo(message: Message, state: FSMContext):
         await message.answer(msg, reply_markup=plans_kb(show_back=True))
         return
 
+    quizspec.cancel(chat_id)
+    plan = await _plan_name(chat_id)
+    usage.bind(chat_id, plan, "vision")
+    if plan == "free":
+        try:
+            loadctl.check_free()
+        except loadctl.Overloaded as e:
+            await message.answer(await busy_text(chat_id, e))
+            return
     await state.set_state("generating")
     await message.bot.send_chat_action(chat_id, ChatAction.TYPING)
-    draft = await safe_send(message, "Распознаю задачу с фото…")
+    draft = await safe_send(
+        message, "Распознаю задачу с фото…" if len(batch) == 1 else f"Распознаю задачу с {len(batch)} фото…"
+    )
+    typing_task = _start_typing(message)
     try:
-        largest = message.photo[-1]
-        file = await message.bot.get_file(largest.file_id)
-        buf = BytesIO()
-        await message.bot.download_file(file.file_path, buf)
-        image_bytes = buf.getvalue()
-
-        teacher_hint = ""
-        if await _is_pro(chat_id) and await is_teacher_mode(chat_id):
-            teacher_hint = "Объясняй как учитель: короткое введение, пошагово, типичные ошибки, в конце мини-проверка (2–3 вопроса). "
-
-        base_hint = teacher_hint + "Распознай условие и реши задачу. Покажи формулы, вычисления и итог."
-        hint_text = await apply_mode_to_text(chat_id, base_hint)
-
-        answer = await solve_from_image(
-            image_bytes,
-            hint=hint_text,
-            history=await get_history(chat_id)
-        )
-
         is_pro = await _is_pro(chat_id)
-        final_text = f"⚡ PRO-приоритет\n{answer}" if (is_pro and answer) else (answer or "Не удалось распознать задачу.")
-        if len(final_text) > MAX_TG_LEN:
-            await safe_delete(draft)
-            await send_long_text(message, final_text)
-            if answer:
-                await message.answer("Действия с ответом:", reply_markup=answer_actions_kb(is_pro))
+        teacher = is_pro and await is_teacher_mode(chat_id)
+        scope = f"{lang}:{await get_current_mode(chat_id)}" + (":teacher" if teacher else "")
+        cached, probe = None, None
+        if len(batch) == 1:
+            cached, probe = await visioncache.probe(message.bot, message.photo, scope)
+
+        meta: Dict[str, str] = {}
+        if cached:
+            answer, meta["transcript"] = cached
         else:
-            await safe_edit(
-                message, draft.message_id, final_text,
-                reply_markup=answer_actions_kb(is_pro and bool(answer))
+            images = list(await asyncio.gather(*(_download_photo(message.bot, m.photo[-1]) for m in batch)))
+
+            teacher_hint = ""
+            if teacher:
+                teacher_hint = "Объясняй как учитель: короткое введение, пошагово, типичные ошибки, в конце мини-проверка (2–3 вопроса). "
+
+            base_hint = teacher_hint + "Распознай условие и реши задачу. Покажи формулы, вычисления и итог."
+            hint_text = await apply_mode_to_text(chat_id, base_hint)
+
+            answer = await _stream_to_draft(
+                message,
+                draft,
+                stream_solve_from_image(
+                    images,
+                    hint=hint_text,
+                    history=await get_history(chat_id),
+                    priority=is_pro,
+                    meta=meta,
+                ),
             )
+            answer = answer.strip()
+
+        head = "⚡ PRO-приоритет\n" if (is_pro and answer) else ""
+        if cached:
+            head = f"{i18n_t(lang, 'photo_cache_served')}\n\n{head}"
+        aid = await _register_answer(chat_id, answer, "photo")
+        await _finish_draft(
+            message, draft, answer or "Не удалось распознать задачу.", is_pro and bool(answer), aid=aid, head=head
+        )
+        # Кнопка квиза уже показана — готовим его сразу, не дожидаясь записи истории и озвучки
+        if is_pro and answer:
+            quizspec.schedule(chat_id, answer, n_questions=QUIZ_QUESTIONS)
 
-        await add_history(chat_id, "user", "[Фото задачи]")
+        transcript = meta.get("transcript") or ""
+        await add_history(chat_id, "user", f"[Фото задачи]\n{transcript}" if transcript else "[Фото задачи]")
         await add_history(chat_id, "assistant", answer or "")
         await inc_usage(chat_id, "photo")
+        if answer and not cached:
+            if probe is not None:
+                visioncache.remember(probe, answer, transcript)
+            try:
+                await recall.note(chat_id, answer)
+            except Exception:
+                pass
 
         if is_pro:
             vs = await get_voice_settings(chat_id)
             if vs.get("auto") and answer:
-                await _send_tts_for_text(message, answer)
+                await _send_tts_for_text(message, answer, aid)
 
+    except BreakerOpen as e:
+        await safe_edit(message, draft.message_id, await busy_text(chat_id, e))
     except Exception as e:
         await safe_edit(message, draft.message_id, f"❌ Ошибка по фото: {e}")
     finally:
+        typing_task.cancel()
         await state.clear()
 
 
 # ----------------- TTS / PDF / QUIZ -----------------
 
-@router.callback_query(F.data == "tts_say")
+@router.callback_query((F.data == "tts_say") | F.data.startswith("tts_say:"))
 async def cb_tts_say(call: CallbackQuery):
     chat_id = call.message.chat.id
     if not await _is_pro(chat_id):
         await call.answer("Доступно только в PRO", show_alert=True)
         return
-    text = await _last_assistant_text(chat_id)
+    aid, text, _ = await _answer_for_call(call)
     if not text:
         await call.answer("Нет текста для озвучки", show_alert=True)
         return
     await call.answer("Озвучиваю…", show_alert=False)
+    usage.bind(chat_id, "pro", "tts")
     try:
-        await _send_tts_for_text(call.message, text)
+        await _send_tts_for_text(call.message, text, aid)
     except Exception as e:
         try:
             await call.message.answer(f"❌ Ошибка озвучки: {e}")
@@ -1659,39 +1952,70 @@ async def cb_tts_say(call: CallbackQuery):
             pass
 
 
-@router.callback_query(F.data == "export_pdf")
+@router.callback_query((F.data == "export_pdf") | F.data.startswith("export_pdf:"))
 async def cb_export_pdf(call: CallbackQuery):
     chat_id = call.message.chat.id
     if not await _is_pro(chat_id):
         return await call.answer("Экспорт PDF доступен только в PRO.", show_alert=True)
-    now = time.monotonic()
-    if _export_lock.get(chat_id, 0.0) > now:
-        return await call.answer("Уже экспортирую…", show_alert=False)
-    _export_lock[chat_id] = now + 6.0
-    answer = await _last_assistant_text(chat_id)
+    aid, answer, artefacts = await _answer_for_call(call)
     if not answer:
-        _export_lock.pop(chat_id, None)
         return await call.answer("Нет текста для экспорта", show_alert=True)
+    title, author = "Разбор задачи", "Учебный помощник"
+    ck = filecache.key("pdf", answer, title, author, PdfConfig())
+    # Повторное нажатие на тот же ответ, пока PDF собирается, ничего не запускает
+    job = (chat_id, ck)
+    if job in _pdf_exports:
+        return await call.answer("Уже экспортирую…", show_alert=False)
+    _pdf_exports.add(job)
+    # Клавиатуру возвращаем ровно ту, что была (с кнопкой «Не то», если разбор из кэша)
+    markup = call.message.reply_markup
     try:
         await call.message.edit_reply_markup(reply_markup=None)
     except Exception:
         pass
     try:
-        pdf = pdf_from_answer_text(answer, title="Разбор задачи", author="Учебный помощник")
-        bi = BufferedInputFile(pdf.getvalue(), filename="razbor.pdf")
-        await call.message.answer_document(document=bi, caption="📄 Экспортировано в PDF")
+        file_id = artefacts.get("pdf") or filecache.get(ck)
+        sent_cached = False
+        if file_id:
+            # Такой PDF уже отправляли — Telegram отдаст файл по file_id без повторной отрисовки и загрузки
+            try:
+                await call.message.answer_document(document=file_id, caption="📄 Экспортировано в PDF")
+                sent_cached = True
+            except TelegramBadRequest:
+                # file_id больше не принимается — забываем его везде и собираем PDF заново
+                filecache.forget(ck)
+                if aid and artefacts.get("pdf"):
+                    try:
+                        await answer_clear_artefact(aid, "pdf")
+                    except Exception:
+                        pass
+        if not sent_cached:
+            pdf = await pdfpool.render(ck, answerdoc.get(answer, aid), title, author)
+            bi = BufferedInputFile(pdf, filename="razbor.pdf")
+            sent = await call.message.answer_document(document=bi, caption="📄 Экспортировано в PDF")
+            if sent.document:
+                filecache.put(ck, sent.document.file_id)
+                if aid:
+                    await answer_set_artefact(aid, "pdf", sent.document.file_id)
         await call.answer()
     except Exception as e:
         await call.answer(f"Ошибка экспорта: {e}", show_alert=True)
     finally:
-        _export_lock.pop(chat_id, None)
+        _pdf_exports.discard(job)
         try:
-            is_pro = await _is_pro(chat_id)
-            await call.message.edit_reply_markup(reply_markup=answer_actions_kb(is_pro))
+            await call.message.edit_reply_markup(reply_markup=markup)
         except Exception:
             pass
 
 
+def _quiz_question_text(state: dict, i: int, first: bool = False) -> str:
+    q = state["items"][i]
+    head = "🧠 Мини-тест\n\n" if first else ""
+    # Пока тест генерируется, итоговое число вопросов неизвестно — модель может вернуть меньше запрошенного
+    num = f"{i + 1}/{state['total']}" if state.get("done", True) else f"{i + 1}"
+    return f"{head}Вопрос {num}:\n{q.get('q', '')}"
+
+
 def _quiz_kb(qi: dict, q_index: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     options = (qi.get("options") or [])[:4]
@@ -1706,26 +2030,63 @@ def _quiz_kb(qi: dict, q_index: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-@router.callback_query(F.data == "quiz_make")
+async def _save_quiz_artefact(aid: str, items: List[Dict[str, Any]]) -> None:
+    try:
+        await answer_set_artefact(aid, "quiz", items)
+    except Exception:
+        pass
+
+
+@router.callback_query((F.data == "quiz_make") | F.data.startswith("quiz_make:"))
 async def cb_quiz_make(call: CallbackQuery):
     chat_id = call.message.chat.id
     if not await _is_pro(chat_id):
         return await call.answer("Мини-тест доступен только в PRO.", show_alert=True)
-    answer = await _last_assistant_text(chat_id)
+    aid, answer, artefacts = await _answer_for_call(call)
     if not answer or len(answer) < 40:
         return await call.answer("Сначала получи разбор/ответ, потом сделаю тест.", show_alert=True)
     await call.answer("Готовлю мини-тест…", show_alert=False)
+    usage.bind(chat_id, "pro", "quiz")
+    ready = artefacts.get("quiz") or await quizspec.take(chat_id, answer)
+    if ready:
+        state = {"idx": 0, "items": list(ready), "total": len(ready), "done": True, "pending": None}
+        QUIZ_STATE[chat_id] = state
+        if aid and not artefacts.get("quiz"):
+            await _save_quiz_artefact(aid, state["items"])
+        return await call.message.answer(_quiz_question_text(state, 0, first=True), reply_markup=_quiz_kb(ready[0], 0))
+    # Вопросы приходят по одному: первый показываем сразу, следующие дописываются в state по мере генерации
+    state = {"idx": 0, "items": [], "total": QUIZ_QUESTIONS, "done": False, "pending": None}
+    QUIZ_STATE[chat_id] = state
+    error_text: Optional[str] = None
     try:
-        md, data = await quiz_from_answer(answer, n_questions=4)
-        items = (data or {}).get("questions") or []
-        if not items:
-            return await call.message.answer(f"🧠 Мини-тест\n\n{md}")
-        QUIZ_STATE[chat_id] = {"idx": 0, "items": items}
-        q0 = items[0]
-        text = f"🧠 Мини-тест\n\nВопрос 1/{len(items)}:\n{q0.get('q', '')}"
-        await call.message.answer(text, reply_markup=_quiz_kb(q0, 0))
+        async for item in stream_quiz_from_answer(answer, n_questions=QUIZ_QUESTIONS):
+            if QUIZ_STATE.get(chat_id) is not state:
+                return
+            state["items"].append(item)
+            i = len(state["items"]) - 1
+            if i == 0:
+                await call.message.answer(_quiz_question_text(state, 0, first=True), reply_markup=_quiz_kb(item, 0))
+            elif state["pending"] == i:
+                state["pending"] = None
+                await call.message.answer(_quiz_question_text(state, i), reply_markup=_quiz_kb(item, i))
+    except BreakerOpen as e:
+        error_text = await busy_text(chat_id, e)
     except Exception as e:
-        await call.message.answer(f"❌ Не удалось построить тест: {e}")
+        error_text = f"❌ Не удалось построить тест: {e}"
+
+    # Если часть вопросов уже у пользователя, ошибку не показываем — тест просто короче
+    state["done"] = True
+    state["total"] = len(state["items"])
+    if aid and state["items"] and error_text is None:
+        await _save_quiz_artefact(aid, state["items"])
+    if QUIZ_STATE.get(chat_id) is not state:
+        return
+    if not state["items"]:
+        QUIZ_STATE.pop(chat_id, None)
+        await call.message.answer(error_text or "🧠 Мини-тест\n\nНе получилось составить вопросы по этому ответу.")
+    elif state["pending"] is not None:
+        QUIZ_STATE.pop(chat_id, None)
+        await call.message.answer("Готово! Хочешь ещё раз — жми «🧠 Проверить себя».")
 
 
 @router.callback_query(F.data.startswith("quiz_answer:"))
@@ -1752,10 +2113,11 @@ async def cb_quiz_answer(call: CallbackQuery):
         if next_idx < len(items):
             state["idx"] = next_idx
             qn = items[next_idx]
-            await call.message.answer(
-                f"Вопрос {next_idx + 1}/{len(items)}:\n{qn.get('q', '')}",
-                reply_markup=_quiz_kb(qn, next_idx)
-            )
+            await call.message.answer(_quiz_question_text(state, next_idx), reply_markup=_quiz_kb(qn, next_idx))
+        elif not state.get("done", True):
+            # Следующий вопрос ещё генерируется — его отправит cb_quiz_make, как только он будет готов
+            state["idx"] = next_idx
+            state["pending"] = next_idx
         else:
             QUIZ_STATE.pop(chat_id, None)
             await call.message.answer("Готово! Хочешь ещё раз — жми «🧠 Проверить себя».")
@@ -1763,27 +2125,123 @@ async def cb_quiz_answer(call: CallbackQuery):
         await call.answer("Ошибка обработки ответа.", show_alert=True)
 
 
+@router.callback_query(F.data.startswith("dedup_bad:"))
+async def cb_dedup_bad(call: CallbackQuery):
+    try:
+        key = int(call.data.split(":", 1)[1])
+    except ValueError:
+        await call.answer()
+        return
+    try:
+        await dedup_report(call.message.chat.id, key)
+    except Exception:
+        pass
+    lang = await get_user_lang(call.message.chat.id)
+    await call.answer(i18n_t(lang, "dedup_reported"), show_alert=True)
+    markup = call.message.reply_markup
+    if markup is not None:
+        rows = [r for r in markup.inline_keyboard if not any((b.callback_data or "").startswith("dedup_bad:") for b in r)]
+        try:
+            await call.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+        except Exception:
+            pass
+
+
 @router.callback_query(F.data.in_(("need_pro_pdf", "need_pro_quiz")))
 async def cb_need_pro(call: CallbackQuery):
     await call.answer("Функция доступна только в PRO.", show_alert=True)
     await call.message.answer("Оформите PRO, чтобы открыть PDF и мини-тест:", reply_markup=plans_kb(show_back=False))
 
 
-async def _send_tts_for_text(message: Message, text: str):
-    chunks = split_for_tts(text, max_chars=TTS_CHUNK_LIMIT)
+async def _send_tts_for_text(message: Message, text: str, aid: Optional[str] = None):
+    # Разметку снимает общий разбор ответа — тот же, что уже построен для Telegram и PDF
+    speech = answerdoc.plain(answerdoc.get(text, aid))
+    chunks = split_for_tts(speech, max_chars=TTS_CHUNK_LIMIT, first_max_chars=TTS_FIRST_CHUNK_LIMIT)
+    parts: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    for chunk in chunks:
+        parts.put_nowait(chunk)
+    parts.put_nowait(None)
+    await _voice_sender(message, parts, total=len(chunks), plain=True)
+
+
+async def _voice_sender(
+    message: Message,
+    parts: "asyncio.Queue[Optional[str]]",
+    total: Optional[int] = None,
+    plain: bool = False,
+):
+    """Куски из очереди (None — конец) синтезируются параллельно, а отправляются строго по порядку.
+
+    plain=True — куски уже без разметки (answerdoc.plain).
+    """
     try:
         vs = await get_voice_settings(message.chat.id)
     except Exception:
         vs = {"name": None, "speed": None}
     voice_name = (vs or {}).get("name")
     voice_speed = (vs or {}).get("speed")
-    for idx, chunk in enumerate(chunks, 1):
-        try:
-            voice_bio = await tts_voice_ogg(chunk, voice=voice_name, speed=voice_speed)
-            file = BufferedInputFile(voice_bio.getvalue(), filename=voice_bio.name or "voice.ogg")
-            cap = f"🎙 Озвучка ({idx}/{len(chunks)})" if len(chunks) > 1 else "🎙 Озвучка"
-            await message.answer_voice(voice=file, caption=cap)
-            await asyncio.sleep(0.3)
-        except Exception as e:
-            await message.answer(f"❌ Не удалось озвучить часть {idx}: {e}")
-            break
\ No newline at end of file
+    # Язык интерфейса — подсказка нормализатору, чтобы не угадывать язык по каждому куску
+    try:
+        lang = await get_user_lang(message.chat.id)
+    except Exception:
+        lang = None
+    sem = asyncio.Semaphore(TTS_PARALLEL)
+    jobs: "asyncio.Queue[Optional[asyncio.Task]]" = asyncio.Queue()
+    started: List[asyncio.Task] = []
+
+    async def synth(chunk: str, use_cache: bool = True):
+        ck = filecache.key("voice", *voice_cache_parts(chunk, voice_name, voice_speed, lang=lang, plain=plain))
+        cached = filecache.get(ck) if use_cache else None
+        if cached:
+            return chunk, ck, cached
+        meta: Dict[str, str] = {}
+        async with sem:
+            voice_bio = await tts_voice_ogg(
+                chunk, voice=voice_name, speed=voice_speed, lang=lang, plain=plain, meta=meta
+            )
+        # Звук от запасной модели кладём под её ключ: основной ключ не должен отдавать его потом
+        ck = filecache.key(
+            "voice", *voice_cache_parts(chunk, voice_name, voice_speed, lang=lang, plain=plain, model=meta.get("model"))
+        )
+        return chunk, ck, BufferedInputFile(voice_bio.getvalue(), filename=voice_bio.name or "voice.ogg")
+
+    async def dispatch():
+        while (chunk := await parts.get()) is not None:
+            job = asyncio.create_task(synth(chunk))
+            started.append(job)
+            jobs.put_nowait(job)
+        jobs.put_nowait(None)
+
+    dispatcher = asyncio.create_task(dispatch())
+    idx = 0
+    try:
+        while (job := await jobs.get()) is not None:
+            idx += 1
+            try:
+                chunk, ck, voice = await job
+                if total is None:
+                    cap = f"🎙 Озвучка ({idx})"
+                else:
+                    cap = f"🎙 Озвучка ({idx}/{total})" if total > 1 else "🎙 Озвучка"
+                try:
+                    sent = await message.answer_voice(voice=voice, caption=cap)
+                except TelegramBadRequest:
+                    if not isinstance(voice, str):
+                        raise
+                    # Устаревший file_id из кэша — синтезируем кусок заново, остальная озвучка не прерывается
+                    filecache.forget(ck)
+                    _, ck, voice = await synth(chunk, use_cache=False)
+                    sent = await message.answer_voice(voice=voice, caption=cap)
+                if not isinstance(voice, str) and sent.voice:
+                    filecache.put(ck, sent.voice.file_id)
+            except BreakerOpen as e:
+                await message.answer(await busy_text(message.chat.id, e))
+                return
+            except Exception as e:
+                await message.answer(f"❌ Не удалось озвучить часть {idx}: {e}")
+                break
+    finally:
+        dispatcher.cancel()
+        for job in started:
+            job.cancel()
+        await asyncio.gather(dispatcher, *started, return_exceptions=True)
\ No newline at end of file
@@ -1286,6 +1286,42 @@ _STRINGS: dict[str, dict[str, str]] = {
         "ar": "❌ تم إلغاء الاشتراك. إعادة: /subscribe",
         "hi": "❌ अनसब्सक्राइब। फिर से: /subscribe",
     },
+    "dedup_served": {
+        "ru": "♻️ Похожий вопрос уже разбирали — вот готовый разбор:",
+        "en": "♻️ A similar question has been solved before — here is the ready solution:",
+        "uz": "♻️ Shunga o‘xshash savol avval yechilgan — mana tayyor yechim:",
+        "kk": "♻️ Ұқсас сұрақ бұрын талданған — міне дайын шешім:",
+        "de": "♻️ Eine ähnliche Frage wurde schon gelöst — hier ist die fertige Lösung:",
+        "fr": "♻️ Une question similaire a déjà été traitée — voici la solution :",
+        "es": "♻️ Ya se resolvió una pregunta parecida — aquí tienes la solución:",
+        "tr": "♻️ Benzer bir soru daha önce çözüldü — işte hazır çözüm:",
+        "ar": "♻️ سبق حل سؤال مشابه — إليك الحل الجاهز:",
+        "hi": "♻️ ऐसा ही प्रश्न पहले हल हो चुका है — यह रहा तैयार हल:",
+    },
+    "photo_cache_served": {
+        "ru": "♻️ Это фото уже разбирали — вот готовый разбор:",
+        "en": "♻️ This photo has been solved before — here is the ready solution:",
+        "uz": "♻️ Bu rasm avval yechilgan — mana tayyor yechim:",
+        "kk": "♻️ Бұл фото бұрын талданған — міне дайын шешім:",
+        "de": "♻️ Dieses Foto wurde schon gelöst — hier ist die fertige Lösung:",
+        "fr": "♻️ Cette photo a déjà été traitée — voici la solution :",
+        "es": "♻️ Esta foto ya se resolvió — aquí tienes la solución:",
+        "tr": "♻️ Bu fotoğraf daha önce çözüldü — işte hazır çözüm:",
+        "ar": "♻️ سبق حل هذه الصورة — إليك الحل الجاهز:",
+        "hi": "♻️ यह फ़ोटो पहले हल हो चुकी है — यह रहा तैयार हल:",
+    },
+    "dedup_reported": {
+        "ru": "Спасибо! Этот разбор больше не будет предлагаться. Отправьте вопрос ещё раз — решу заново.",
+        "en": "Thanks! This solution won’t be offered again. Send the question once more and I’ll solve it from scratch.",
+        "uz": "Rahmat! Bu yechim boshqa taklif qilinmaydi. Savolni yana yuboring — qaytadan yechaman.",
+        "kk": "Рақмет! Бұл шешім енді ұсынылмайды. Сұрақты қайта жіберіңіз — жаңадан шешемін.",
+        "de": "Danke! Diese Lösung wird nicht mehr angeboten. Sende die Frage noch einmal — ich löse sie neu.",
+        "fr": "Merci ! Cette solution ne sera plus proposée. Renvoyez la question et je la résoudrai à nouveau.",
+        "es": "¡Gracias! Esta solución ya no se ofrecerá. Envía la pregunta otra vez y la resolveré de nuevo.",
+        "tr": "Teşekkürler! Bu çözüm artık önerilmeyecek. Soruyu tekrar gönderin, baştan çözeyim.",
+        "ar": "شكرًا! لن يُقترح هذا الحل مرة أخرى. أرسل السؤال مجددًا وسأحله من جديد.",
+        "hi": "धन्यवाद! यह हल अब नहीं दिया जाएगा। प्रश्न फिर से भेजें — मैं नए सिरे से हल करूँगा।",
+    },
     "admin_count_text": {
         "ru": "Подписчиков (в базе): {n}",
         "en": "Subscribers (in DB): {n}",
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import binascii
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Union
+
+import metrics
+
+log = logging.getLogger("imageprep")
+
+try:
+    from PIL import Image, ImageChops, ImageOps, ImageStat
+except ImportError:  # Pillow не установлен — отправляем как есть, только с верным mime
+    Image = ImageChops = ImageOps = ImageStat = None  # type: ignore[assignment]
+
+IMAGEPREP_ENABLED = (os.getenv("IMAGEPREP_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+IMAGEPREP_WORKERS = int(os.getenv("IMAGEPREP_WORKERS", "2"))
+# Vision-модели в режиме high detail сами вписывают картинку в 2048×2048 и ужимают короткую сторону до 768:
+# всё, что больше, только удлиняет загрузку.
+IMAGEPREP_MAX_SIDE = int(os.getenv("IMAGEPREP_MAX_SIDE", "2048"))
+IMAGEPREP_SHORT_SIDE = int(os.getenv("IMAGEPREP_SHORT_SIDE", "768"))
+IMAGEPREP_JPEG_QUALITY = int(os.getenv("IMAGEPREP_JPEG_QUALITY", "82"))
+IMAGEPREP_GRAY_SPREAD = float(os.getenv("IMAGEPREP_GRAY_SPREAD", "12"))
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def sniff_mime(data: Buffer) -> str:
+    head = bytes(data[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+def _looks_like_text(img) -> bool:
+    # Фото тетради/листа почти бесцветное: каналы RGB на миниатюре почти совпадают
+    r, g, b = img.convert("RGB").resize((64, 64)).split()
+    spread = ImageStat.Stat(ImageChops.difference(r, g)).mean[0] + ImageStat.Stat(ImageChops.difference(g, b)).mean[0]
+    return spread < IMAGEPREP_GRAY_SPREAD
+
+
+def _prepare_sync(data: Buffer) -> Tuple[bytes, str]:
+    mime = sniff_mime(data)
+    if Image is None or not IMAGEPREP_ENABLED:
+        return bytes(data), mime
+
+    img = Image.open(BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    w, h = img.size
+    scale = min(1.0, IMAGEPREP_MAX_SIDE / max(w, h), IMAGEPREP_SHORT_SIDE / max(1, min(w, h)))
+    if scale < 1.0:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+
+    if _looks_like_text(img):
+        img = ImageOps.autocontrast(img.convert("L"), cutoff=1)
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    out = BytesIO()
+    # Сохраняем без exif — заодно убираем геометку и прочие метаданные
+    img.save(out, format="JPEG", quality=IMAGEPREP_JPEG_QUALITY, optimize=True)
+    # Уменьшать было нечего, а пережатие не дало выигрыша (маленький палитровый PNG, уже сжатый JPEG) —
+    # отдаём оригинал с его mime: vision-модели принимают и PNG, и WebP, и GIF
+    if scale >= 1.0 and out.tell() >= len(data):
+        return bytes(data), mime
+    return out.getvalue(), "image/jpeg"
+
+
+async def prepare(data: Buffer) -> Tuple[bytes, str]:
+    """Ориентация, уменьшение, ч/б с контрастом для «тетрадных» фото и пережатие в JPEG — в пуле потоков."""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=IMAGEPREP_WORKERS, thread_name_prefix="imageprep")
+    t0 = time.monotonic()
+    try:
+        out, mime = await asyncio.get_running_loop().run_in_executor(_pool, _prepare_sync, data)
+    except Exception as e:
+        log.warning("image preprocessing failed, sending original: %s", e)
+        metrics.inc("imageprep.failed")
+        return bytes(data), sniff_mime(data)
+    metrics.observe("imageprep.sec", time.monotonic() - t0)
+    saved = len(data) - len(out)
+    metrics.inc("imageprep.bytes_in", len(data))
+    metrics.inc("imageprep.bytes_saved", max(0, saved))
+    metrics.observe("imageprep.saved_bytes", saved)
+    return out, mime
+
+
+def data_url(data: Buffer, mime: str) -> str:
+    # b2a_base64 читает memoryview без копии; дальше одна склейка и одно декодирование
+    b64 = binascii.b2a_base64(memoryview(data), newline=False)
+    return b"".join((b"data:", mime.encode("ascii"), b";base64,", b64)).decode("ascii")
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import os
+import math
+import time
+import asyncio
+import logging
+import contextlib
+from collections import deque
+from dataclasses import replace
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import metrics
+import breaker
+
+log = logging.getLogger("loadctl")
+
+# Контроллер нагрузки: при перегрузе деградирует только FREE-запросы, PRO/LITE идут как обычно.
+# Уровни: 1 — меньше max_tokens, 2 — модель поменьше, 3 — короче история, 4 — «попробуйте позже» с ETA.
+LOAD_ENABLED = (os.getenv("LOAD_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+LOAD_MAX_INFLIGHT = int(os.getenv("LOAD_MAX_INFLIGHT", "40"))
+LOAD_WAIT_TARGET_SEC = float(os.getenv("LOAD_WAIT_TARGET_SEC", "3"))
+LOAD_MAX_WAIT_SEC = float(os.getenv("LOAD_MAX_WAIT_SEC", "20"))
+LOAD_ERROR_RATE = float(os.getenv("LOAD_ERROR_RATE", "0.3"))
+LOAD_WINDOW_SEC = float(os.getenv("LOAD_WINDOW_SEC", "30"))
+LOAD_HYSTERESIS = float(os.getenv("LOAD_HYSTERESIS", "0.8"))
+LOAD_MIN_HOLD_SEC = float(os.getenv("LOAD_MIN_HOLD_SEC", "15"))
+LOAD_LEVEL_THRESHOLDS: Tuple[float, ...] = tuple(
+    float(x) for x in (os.getenv("LOAD_LEVEL_THRESHOLDS") or "0.6,0.8,0.95,1.1").split(",")
+)
+LOAD_TOKENS_FACTOR = float(os.getenv("LOAD_TOKENS_FACTOR", "0.6"))
+LOAD_DEGRADED_MODEL = os.getenv("LOAD_DEGRADED_MODEL") or None
+LOAD_DEGRADED_HISTORY = int(os.getenv("LOAD_DEGRADED_HISTORY", "4"))
+
+MAX_LEVEL = len(LOAD_LEVEL_THRESHOLDS)
+
+
+class Overloaded(breaker.BreakerOpen):
+    def __init__(self, eta: float) -> None:
+        super().__init__("free_tier", eta)
+
+
+_in_flight = 0
+_waiters: Deque[asyncio.Future] = deque()
+_waits: Deque[Tuple[float, float]] = deque()
+_durations: Deque[float] = deque(maxlen=256)
+_level = 0
+_level_changed_at = 0.0
+
+
+def _recent_wait_p90(now: float) -> float:
+    while _waits and now - _waits[0][0] > LOAD_WINDOW_SEC:
+        _waits.popleft()
+    if not _waits:
+        return 0.0
+    xs = sorted(w for _, w in _waits)
+    return xs[min(len(xs) - 1, int(len(xs) * 0.9))]
+
+
+def pressure() -> float:
+    now = time.monotonic()
+    snap = breaker.get("text").snapshot()
+    err = snap["error_rate"] if snap["calls"] >= breaker.BREAKER_MIN_CALLS else 0.0
+    return max(
+        _in_flight / max(1, LOAD_MAX_INFLIGHT),
+        _recent_wait_p90(now) / max(0.001, LOAD_WAIT_TARGET_SEC),
+        err / max(0.001, LOAD_ERROR_RATE),
+    )
+
+
+def level() -> int:
+    """Текущий уровень деградации; вверх — сразу, вниз — по одному шагу с гистерезисом и выдержкой."""
+    global _level, _level_changed_at
+    if not LOAD_ENABLED:
+        return 0
+    p = pressure()
+    target = sum(1 for th in LOAD_LEVEL_THRESHOLDS if p >= th)
+    now = time.monotonic()
+    new = _level
+    if target > _level:
+        new = target
+    elif (
+        _level > 0
+        and p < LOAD_LEVEL_THRESHOLDS[_level - 1] * LOAD_HYSTERESIS
+        and now - _level_changed_at >= LOAD_MIN_HOLD_SEC
+    ):
+        new = _level - 1
+    if new != _level:
+        log.warning("free-tier degrade level %s -> %s (pressure=%.2f, in_flight=%s)", _level, new, p, _in_flight)
+        _level, _level_changed_at = new, now
+    metrics.gauge("load.degrade_level", _level)
+    metrics.gauge("load.pressure", round(p, 3))
+    return _level
+
+
+def eta_sec() -> int:
+    xs = sorted(_durations)
+    typical = xs[len(xs) // 2] if xs else 10.0
+    eta = typical * (1 + len(_waiters) / max(1, LOAD_MAX_INFLIGHT)) + LOAD_MIN_HOLD_SEC
+    return int(min(300, max(15, math.ceil(eta / 5) * 5)))
+
+
+def check_free() -> None:
+    if level() >= MAX_LEVEL:
+        metrics.inc("load.rejected")
+        raise Overloaded(eta_sec())
+
+
+def degrade(route: Any, plan: Optional[str]) -> Tuple[Any, Optional[int]]:
+    """Применяет уровень деградации к маршруту FREE-запроса; возвращает (маршрут, лимит истории)."""
+    if (plan or "").lower() != "free":
+        return route, None
+    lvl = level()
+    if lvl <= 0:
+        return route, None
+    from routing import ROUTING_TABLE
+
+    metrics.inc(f"load.degraded.level{lvl}")
+    # Маршрутизация выключена (лимита нет) — урезаем от бюджета standard
+    budget = route.max_tokens or int(ROUTING_TABLE["standard"]["max_tokens"])
+    route = replace(
+        route,
+        max_tokens=max(256, int(budget * LOAD_TOKENS_FACTOR)),
+        reasons=tuple(route.reasons) + (f"load{lvl}",),
+    )
+    if lvl >= 2:
+        route = replace(route, model=LOAD_DEGRADED_MODEL or str(ROUTING_TABLE["fast"]["model"]))
+    return route, (LOAD_DEGRADED_HISTORY if lvl >= 3 else None)
+
+
+def _wake_one() -> None:
+    while _waiters:
+        fut = _waiters.popleft()
+        if not fut.done():
+            fut.set_result(None)
+            return
+
+
+@contextlib.asynccontextmanager
+async def slot(plan: Optional[str]):
+    """Учёт одного LLM-вызова. FREE при заполненных слотах ждёт в очереди, платные проходят сразу."""
+    global _in_flight
+    t0 = time.monotonic()
+    if LOAD_ENABLED and (plan or "").lower() == "free":
+        loop = asyncio.get_running_loop()
+        while _in_flight >= LOAD_MAX_INFLIGHT:
+            fut = loop.create_future()
+            _waiters.append(fut)
+            left = LOAD_MAX_WAIT_SEC - (time.monotonic() - t0)
+            try:
+                if left <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(fut, left)
+            except asyncio.TimeoutError:
+                metrics.inc("load.queue_timeout")
+                _waits.append((time.monotonic(), time.monotonic() - t0))
+                raise Overloaded(eta_sec())
+            finally:
+                with contextlib.suppress(ValueError):
+                    _waiters.remove(fut)
+        wait = time.monotonic() - t0
+        _waits.append((time.monotonic(), wait))
+        metrics.observe("load.queue_wait_sec", wait)
+
+    _in_flight += 1
+    metrics.gauge("load.in_flight", _in_flight)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _in_flight -= 1
+        _durations.append(time.monotonic() - started)
+        metrics.gauge("load.in_flight", _in_flight)
+        _wake_one()
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "degrade_level": level(),
+        "pressure": round(pressure(), 3),
+        "in_flight": _in_flight,
+        "queued": len(_waiters),
+    }
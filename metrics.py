@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Any, Deque, Dict
+
+# Простые in-process метрики: счётчики, gauge и скользящее окно замеров (латентности и т.п.).
+# Снимок отдаётся через /status в webhooks.py.
+
+SAMPLE_WINDOW = 512
+
+_started_at = time.time()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_samples: Dict[str, Deque[float]] = {}
+
+
+def inc(name: str, value: float = 1.0) -> None:
+    _counters[name] = _counters.get(name, 0.0) + value
+
+
+def gauge(name: str, value: float) -> None:
+    _gauges[name] = float(value)
+
+
+def observe(name: str, value: float) -> None:
+    q = _samples.get(name)
+    if q is None:
+        q = _samples[name] = deque(maxlen=SAMPLE_WINDOW)
+    q.append(float(value))
+
+
+def counter(name: str) -> float:
+    return _counters.get(name, 0.0)
+
+
+def _summary(values: Deque[float]) -> Dict[str, float]:
+    xs = sorted(values)
+    n = len(xs)
+    return {
+        "n": n,
+        "avg": round(sum(xs) / n, 4),
+        "p50": round(xs[n // 2], 4),
+        "p95": round(xs[min(n - 1, int(n * 0.95))], 4),
+        "max": round(xs[-1], 4),
+    }
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "uptime_sec": int(time.time() - _started_at),
+        "counters": dict(sorted(_counters.items())),
+        "gauges": dict(sorted(_gauges.items())),
+        "samples": {k: _summary(v) for k, v in sorted(_samples.items()) if v},
+    }
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+import contextlib
+import datetime as dt
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import metrics
+
+log = logging.getLogger("payinbox")
+
+# Вебхук платёжки только проверяет подпись и кладёт событие в webhook_inbox — ответ уходит сразу.
+# Подписку начисляет фоновый обработчик, уведомление пользователю идёт через outbox из процесса бота.
+# Очереди живут в Mongo, поэтому веб-сервер и бот могут быть разными процессами.
+PAYINBOX_POLL_SEC = float(os.getenv("PAYINBOX_POLL_SEC", "2"))
+PAYINBOX_LEASE_SEC = float(os.getenv("PAYINBOX_LEASE_SEC", "60"))
+PAYINBOX_MAX_ATTEMPTS = int(os.getenv("PAYINBOX_MAX_ATTEMPTS", "8"))
+PAYINBOX_RETRY_BASE_SEC = float(os.getenv("PAYINBOX_RETRY_BASE_SEC", "5"))
+
+
+class Reject(Exception):
+    """Событие некорректно или адресат недоступен — повтор не поможет."""
+
+
+_inbox_wake: Optional[asyncio.Event] = None
+_outbox_wake: Optional[asyncio.Event] = None
+
+Doc = Dict[str, Any]
+
+
+def _backoff(attempts: int) -> float:
+    return min(600.0, PAYINBOX_RETRY_BASE_SEC * 2 ** max(0, attempts - 1))
+
+
+async def accept(key: str, provider: str, payload: Dict[str, Any]) -> bool:
+    """Сохраняет событие; False — дубль (провайдер повторил доставку)."""
+    from db import inbox_put
+
+    new = await inbox_put(key, provider, payload)
+    metrics.inc("payinbox.accepted" if new else "payinbox.duplicate")
+    if new and _inbox_wake is not None:
+        _inbox_wake.set()
+    return new
+
+
+async def notify(key: str, chat_id: int, text: str) -> None:
+    """Ставит сообщение в outbox; один и тот же key отправляется не больше одного раза."""
+    from db import outbox_put
+
+    if await outbox_put(key, chat_id, text) and _outbox_wake is not None:
+        _outbox_wake.set()
+
+
+async def _drain(
+    name: str,
+    claim: Callable[[float], Awaitable[Optional[Doc]]],
+    handle: Callable[[Doc], Awaitable[None]],
+    finish: Callable[..., Awaitable[None]],
+    retry: Callable[[str, float, str], Awaitable[None]],
+) -> None:
+    while (doc := await claim(PAYINBOX_LEASE_SEC)) is not None:
+        key, attempts = doc["_id"], int(doc.get("attempts") or 1)
+        try:
+            await handle(doc)
+        except Reject as e:
+            metrics.inc(f"{name}.rejected")
+            log.warning("%s %s rejected: %s", name, key, e)
+            await finish(key, "rejected", str(e))
+        except Exception as e:
+            if attempts >= PAYINBOX_MAX_ATTEMPTS:
+                metrics.inc(f"{name}.failed")
+                log.error("%s %s failed after %d attempts: %r", name, key, attempts, e)
+                await finish(key, "failed", repr(e))
+            else:
+                metrics.inc(f"{name}.retry")
+                log.warning("%s %s attempt %d failed: %r", name, key, attempts, e)
+                await retry(key, _backoff(attempts), repr(e))
+        else:
+            metrics.inc(f"{name}.done")
+            await finish(key, "done")
+
+
+async def _loop(name: str, wake: asyncio.Event, claim, handle, finish, retry) -> None:
+    while True:
+        try:
+            await _drain(name, claim, handle, finish, retry)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Mongo недоступна — подождём и попробуем снова, события никуда не денутся
+            log.warning("%s loop error: %s", name, e)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(wake.wait(), PAYINBOX_POLL_SEC)
+        wake.clear()
+
+
+async def _apply(doc: Doc) -> None:
+    received = doc.get("received_at")
+    if isinstance(received, dt.datetime):
+        metrics.observe("payinbox.lag_sec", (dt.datetime.now(dt.timezone.utc) - received).total_seconds())
+    if doc.get("provider") != "wata":
+        raise Reject(f"unknown provider {doc.get('provider')!r}")
+    from webhooks import apply_wata_event
+
+    await apply_wata_event(doc.get("payload") or {})
+
+
+async def run_inbox() -> None:
+    """Фоновый обработчик webhook_inbox: начисляет подписки. Безопасно запускать в нескольких процессах."""
+    global _inbox_wake
+    from db import inbox_claim, inbox_finish, inbox_retry, queue_ensure_indexes
+
+    _inbox_wake = asyncio.Event()
+    try:
+        await queue_ensure_indexes()
+    except Exception as e:
+        log.warning("queue indexes not ensured: %s", e)
+    await _loop("payinbox", _inbox_wake, inbox_claim, _apply, inbox_finish, inbox_retry)
+
+
+async def run_outbox(bot: Any) -> None:
+    """Доставка уведомлений из outbox — в процессе, где есть бот."""
+    global _outbox_wake
+    from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+    from db import outbox_claim, outbox_finish, outbox_retry
+
+    async def send(doc: Doc) -> None:
+        try:
+            await bot.send_message(int(doc["chat_id"]), doc["text"])
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чата нет
+            raise Reject(str(e))
+
+    _outbox_wake = asyncio.Event()
+    await _loop("outbox", _outbox_wake, outbox_claim, send, outbox_finish, outbox_retry)
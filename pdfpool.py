@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+import metrics
+
+log = logging.getLogger("pdfpool")
+
+# Вёрстка ReportLab — сотни мс CPU на длинный ответ; держим её в отдельных процессах,
+# где шрифты и стили уже зарегистрированы при старте.
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", "2"))
+# Больше заданий, чем процессов, не отправляем: лишние ждут на семафоре, а не в очереди пула,
+# и PDF_TIMEOUT_SEC меряет только сам рендер
+PDF_MAX_CONCURRENCY = max(1, min(int(os.getenv("PDF_MAX_CONCURRENCY", str(PDF_POOL_WORKERS))), PDF_POOL_WORKERS))
+PDF_TIMEOUT_SEC = float(os.getenv("PDF_TIMEOUT_SEC", "45"))
+
+
+class PdfBusy(RuntimeError):
+    pass
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_sem: Optional[asyncio.Semaphore] = None
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _warm_worker() -> None:
+    # Исключение из initializer ломает весь пул, поэтому здесь только логируем
+    try:
+        import utils_export
+
+        utils_export.warm()
+    except Exception as e:  # без шрифтов рендер упадёт с понятной ошибкой уже в задаче
+        log.warning("pdf worker warm-up failed: %s", e)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _render_sync(parsed: tuple, title: str, author: str) -> tuple:
+    from utils_export import pdf_from_answer_doc
+
+    t0 = time.perf_counter()
+    data = pdf_from_answer_doc(parsed, title=title, author=author).getvalue()
+    return data, time.perf_counter() - t0
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_worker,
+        )
+    return _pool
+
+
+def start() -> None:
+    """Поднимает и прогревает все процессы пула заранее, чтобы первый экспорт не ждал импорт ReportLab."""
+    pool = _get_pool()
+    for _ in range(PDF_POOL_WORKERS):
+        pool.submit(_ping)
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _discard(pool: ProcessPoolExecutor, terminate: bool = False) -> None:
+    # Сбрасываем глобальный пул, только если это всё ещё он: другой запрос мог уже создать новый
+    global _pool
+    if _pool is pool:
+        _pool = None
+    if terminate:
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _render(parsed: tuple, title: str, author: str) -> bytes:
+    global _sem
+    if _sem is None:
+        _sem = asyncio.Semaphore(PDF_MAX_CONCURRENCY)
+    t0 = time.monotonic()
+    metrics.gauge("pdf.queue_depth", len(_inflight))
+    async with _sem:
+        pool = _get_pool()
+        fut = asyncio.get_running_loop().run_in_executor(pool, _render_sync, parsed, title, author)
+        try:
+            data, work = await asyncio.wait_for(fut, PDF_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            metrics.inc("pdf.timeout")
+            log.warning("pdf render timed out after %.0fs, recycling pool", PDF_TIMEOUT_SEC)
+            # Зависший рендер нельзя отменить по одному — пересоздаём пул целиком
+            _discard(pool, terminate=True)
+            raise PdfBusy("PDF не успел собраться, попробуйте ещё раз")
+        except BrokenProcessPool:
+            metrics.inc("pdf.pool_broken")
+            _discard(pool)
+            raise PdfBusy("PDF-воркер перезапускается, попробуйте ещё раз")
+    metrics.observe("pdf.render_sec", work)
+    metrics.observe("pdf.wait_sec", max(0.0, time.monotonic() - t0 - work))
+    return data
+
+
+async def render(key: str, parsed: tuple, title: str, author: str) -> bytes:
+    """Одинаковые задания (тот же key) не рендерятся дважды: второй запрос ждёт первый.
+
+    В процесс уходит уже разобранный ответ (answerdoc), а не сырой текст.
+    """
+    fut = _inflight.get(key)
+    if fut is not None:
+        metrics.inc("pdf.joined")
+        return await asyncio.shield(fut)
+    fut = asyncio.ensure_future(_render(parsed, title, author))
+    _inflight[key] = fut
+    fut.add_done_callback(lambda f: _done(key, f))
+    return await asyncio.shield(fut)
+
+
+def _done(key: str, fut: asyncio.Future) -> None:
+    if _inflight.get(key) is fut:
+        _inflight.pop(key, None)
+    if not fut.cancelled():
+        fut.exception()  # все ожидавшие могли уйти по отмене — не оставляем «never retrieved»
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+import loadctl
+import usage
+
+log = logging.getLogger("quizspec")
+
+# Спекулятивная генерация мини-теста для PRO-ответов: к нажатию «🧠 Проверить себя» тест уже готов.
+# hit/miss/joined/wasted/cancelled в метриках показывают, окупается ли это.
+QUIZ_SPECULATE = (os.getenv("QUIZ_SPECULATE") or "false").lower() in {"1", "true", "yes", "y"}
+QUIZ_SPECULATE_TTL_SEC = float(os.getenv("QUIZ_SPECULATE_TTL_SEC", "900"))
+QUIZ_SPECULATE_DELAY_SEC = float(os.getenv("QUIZ_SPECULATE_DELAY_SEC", "2"))
+QUIZ_SPECULATE_CONCURRENCY = int(os.getenv("QUIZ_SPECULATE_CONCURRENCY", "2"))
+QUIZ_SPECULATE_MAX_ENTRIES = int(os.getenv("QUIZ_SPECULATE_MAX_ENTRIES", "500"))
+QUIZ_SPECULATE_JOIN_SEC = float(os.getenv("QUIZ_SPECULATE_JOIN_SEC", "20"))
+
+_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]], bool]]" = OrderedDict()
+_tasks: Dict[int, Tuple[str, asyncio.Task]] = {}
+_sem: Optional[asyncio.Semaphore] = None
+
+
+def answer_key(answer: str) -> str:
+    return hashlib.blake2b((answer or "").strip().encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _drop(key: str) -> None:
+    _, _, used = _cache.pop(key)
+    if not used:
+        metrics.inc("quizspec.wasted")
+
+
+def _expire(now: float) -> None:
+    for key in [k for k, (exp, _, _) in _cache.items() if exp <= now]:
+        _drop(key)
+    while len(_cache) > QUIZ_SPECULATE_MAX_ENTRIES:
+        _drop(next(iter(_cache)))
+    metrics.gauge("quizspec.entries", len(_cache))
+
+
+async def _run(chat_id: int, key: str, answer: str, n_questions: int) -> None:
+    global _sem
+    from generators import stream_quiz_from_answer
+
+    await asyncio.sleep(QUIZ_SPECULATE_DELAY_SEC)
+    if _sem is None:
+        _sem = asyncio.Semaphore(QUIZ_SPECULATE_CONCURRENCY)
+    async with _sem:
+        # Низкий приоритет: при любой деградации не добавляем нагрузки
+        if loadctl.level() > 0:
+            metrics.inc("quizspec.skipped_load")
+            return
+        usage.bind(chat_id, "pro", "quiz_spec")
+        items = [q async for q in stream_quiz_from_answer(answer, n_questions=n_questions)]
+    if items:
+        _cache[key] = (time.monotonic() + QUIZ_SPECULATE_TTL_SEC, items, False)
+        metrics.inc("quizspec.generated")
+        _expire(time.monotonic())
+
+
+def _finished(chat_id: int, task: asyncio.Task) -> None:
+    cur = _tasks.get(chat_id)
+    if cur is not None and cur[1] is task:
+        _tasks.pop(chat_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        log.info("speculative quiz failed: %s", task.exception())
+        metrics.inc("quizspec.failed")
+
+
+def schedule(chat_id: int, answer: str, n_questions: int = 4) -> None:
+    if not QUIZ_SPECULATE or not (answer or "").strip():
+        return
+    cancel(chat_id)
+    key = answer_key(answer)
+    if key in _cache:
+        return
+    task = asyncio.create_task(_run(chat_id, key, answer, n_questions))
+    task.add_done_callback(lambda t: _finished(chat_id, t))
+    _tasks[chat_id] = (key, task)
+    metrics.inc("quizspec.scheduled")
+
+
+def cancel(chat_id: int) -> None:
+    """Пользователь спросил что-то новое — недоделанный тест к прошлому ответу больше не нужен."""
+    cur = _tasks.pop(chat_id, None)
+    if cur is not None and not cur[1].done():
+        cur[1].cancel()
+        metrics.inc("quizspec.cancelled")
+
+
+async def take(chat_id: int, answer: str) -> Optional[List[Dict[str, Any]]]:
+    if not QUIZ_SPECULATE:
+        return None
+    key = answer_key(answer)
+    cur = _tasks.get(chat_id)
+    if cur is not None and cur[0] == key and not cur[1].done():
+        # Генерация уже идёт — дождаться её выгоднее, чем запускать вторую
+        metrics.inc("quizspec.joined")
+        await asyncio.wait({cur[1]}, timeout=QUIZ_SPECULATE_JOIN_SEC)
+    _expire(time.monotonic())
+    hit = _cache.get(key)
+    if hit is None:
+        metrics.inc("quizspec.miss")
+        return None
+    exp, items, _ = hit
+    _cache[key] = (exp, items, True)
+    _cache.move_to_end(key)
+    metrics.inc("quizspec.hit")
+    return items
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import math
+import zlib
+import logging
+import datetime as dt
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger("recall")
+
+RECALL_ENABLED = (os.getenv("RECALL_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", "3"))
+RECALL_MIN_SCORE = float(os.getenv("RECALL_MIN_SCORE", "0.8"))
+RECALL_SNIPPET_CHARS = int(os.getenv("RECALL_SNIPPET_CHARS", "600"))
+RECALL_TAIL_ITEMS = int(os.getenv("RECALL_TAIL_ITEMS", "6"))
+RECALL_MAX_DOCS = int(os.getenv("RECALL_MAX_DOCS", "2000"))
+RECALL_CACHE_CHATS = int(os.getenv("RECALL_CACHE_CHATS", "500"))
+RECALL_SAVE_EVERY = int(os.getenv("RECALL_SAVE_EVERY", "5"))
+
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_STEM_LEN = 6
+
+_RE_TOKEN = re.compile(r"\w{2,}", re.UNICODE)
+_RE_PARAS = re.compile(r"\n\s*\n")
+
+
+def tokenize(text: str) -> List[str]:
+    # Грубый «стемминг» обрезкой: для русских словоформ работает заметно лучше, чем ничего
+    return [w[:_STEM_LEN] for w in _RE_TOKEN.findall((text or "").lower().replace("ё", "е"))]
+
+
+def _tf(tokens: List[str]) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for w in tokens:
+        out[w] = out.get(w, 0) + 1
+    return out
+
+
+class ChatIndex:
+    """BM25 по ответам и закладкам одного чата; документы добавляются по одному."""
+
+    def __init__(self) -> None:
+        self.texts: List[str] = []
+        self.lens: List[int] = []
+        self.tfs: List[Dict[str, int]] = []
+        self.postings: Dict[str, List[int]] = {}
+        self.total_len = 0
+        self.seen: set = set()
+        self.upto: Optional[dt.datetime] = None
+        self.dirty = 0
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, text: str, ts: Optional[dt.datetime] = None, tf: Optional[Dict[str, int]] = None) -> None:
+        text = (text or "").strip()
+        if not text:
+            return
+        key = zlib.crc32(text.encode("utf-8"))
+        if key in self.seen:
+            return
+        if tf is None:
+            tf = _tf(tokenize(text))
+        n = sum(tf.values())
+        if not n:
+            return
+        idx = len(self.texts)
+        self.seen.add(key)
+        self.texts.append(text)
+        self.tfs.append(tf)
+        self.lens.append(n)
+        self.total_len += n
+        for w in tf:
+            self.postings.setdefault(w, []).append(idx)
+        if ts is not None and (self.upto is None or ts > self.upto):
+            self.upto = ts
+        self.dirty += 1
+        if len(self.texts) > RECALL_MAX_DOCS:
+            # Вытесняем сразу пачку (10% лимита): перестройка постингов случается раз на много добавлений,
+            # а не на каждый новый ответ длинного чата
+            overflow = len(self.texts) - RECALL_MAX_DOCS
+            self._drop_oldest(max(overflow, RECALL_MAX_DOCS // 10))
+
+    def _drop_oldest(self, n: int) -> None:
+        self.texts = self.texts[n:]
+        self.tfs = self.tfs[n:]
+        self.lens = self.lens[n:]
+        self.total_len = sum(self.lens)
+        self.seen = {zlib.crc32(t.encode("utf-8")) for t in self.texts}
+        postings: Dict[str, List[int]] = {}
+        for i, tf in enumerate(self.tfs):
+            for w in tf:
+                postings.setdefault(w, []).append(i)
+        self.postings = postings
+
+    def search(self, query: str, k: int, skip: Optional[set] = None) -> List[Tuple[float, int]]:
+        q = set(tokenize(query))
+        if not q or not self.texts:
+            return []
+        N = len(self.texts)
+        avgdl = self.total_len / N
+        scores: Dict[int, float] = {}
+        for w in q:
+            docs = self.postings.get(w)
+            if not docs:
+                continue
+            idf = math.log(1 + (N - len(docs) + 0.5) / (len(docs) + 0.5))
+            for i in docs:
+                f = self.tfs[i][w]
+                denom = f + _BM25_K1 * (1 - _BM25_B + _BM25_B * self.lens[i] / avgdl)
+                scores[i] = scores.get(i, 0.0) + idf * f * (_BM25_K1 + 1) / denom
+        ranked = sorted(((s, i) for i, s in scores.items() if not skip or hash(self.texts[i]) not in skip), reverse=True)
+        return ranked[:k]
+
+    def dumps(self) -> bytes:
+        payload = {
+            "upto": self.upto.isoformat() if self.upto else None,
+            "docs": self.texts,
+        }
+        return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+    @classmethod
+    def loads(cls, blob: bytes) -> "ChatIndex":
+        data = json.loads(zlib.decompress(blob).decode("utf-8"))
+        idx = cls()
+        for text in data.get("docs") or []:
+            idx.add(text)
+        upto = data.get("upto")
+        idx.upto = dt.datetime.fromisoformat(upto) if upto else None
+        idx.dirty = 0
+        return idx
+
+
+def best_passage(text: str, query: str, limit: int = RECALL_SNIPPET_CHARS) -> str:
+    if len(text) <= limit:
+        return text
+    q = set(tokenize(query))
+    paras = [p.strip() for p in _RE_PARAS.split(text) if p.strip()]
+    if not paras:
+        return text[:limit]
+    best = max(range(len(paras)), key=lambda i: sum(1 for w in tokenize(paras[i]) if w in q))
+    out = paras[best]
+    j = best + 1
+    while j < len(paras) and len(out) + len(paras[j]) + 2 <= limit:
+        out += "\n\n" + paras[j]
+        j += 1
+    return out[:limit]
+
+
+# --- Кэш индексов по чатам ---
+
+_indexes: "OrderedDict[int, ChatIndex]" = OrderedDict()
+
+
+async def _save(chat_id: int, idx: ChatIndex) -> None:
+    from db import recall_snapshot_put
+
+    try:
+        await recall_snapshot_put(chat_id, idx.dumps(), idx.upto)
+        idx.dirty = 0
+    except Exception as e:
+        log.warning("recall snapshot save failed for %s: %s", chat_id, e)
+
+
+async def _get_index(chat_id: int) -> ChatIndex:
+    idx = _indexes.get(chat_id)
+    if idx is not None:
+        _indexes.move_to_end(chat_id)
+        return idx
+
+    from db import recall_snapshot_get, iter_answers_since
+
+    idx = ChatIndex()
+    try:
+        blob = await recall_snapshot_get(chat_id)
+        if blob:
+            idx = ChatIndex.loads(blob)
+    except Exception as e:
+        log.warning("recall snapshot load failed for %s: %s", chat_id, e)
+        idx = ChatIndex()
+
+    async for content, ts in iter_answers_since(chat_id, idx.upto):
+        idx.add(content, ts)
+
+    _indexes[chat_id] = idx
+    while len(_indexes) > RECALL_CACHE_CHATS:
+        _indexes.popitem(last=False)
+    if idx.dirty:
+        await _save(chat_id, idx)
+    return idx
+
+
+async def search(chat_id: int, query: str, recent: Optional[List[Dict[str, str]]] = None) -> List[str]:
+    if not RECALL_ENABLED:
+        return []
+    idx = await _get_index(chat_id)
+    # То, что и так уйдёт в промпт хвостом истории, повторно не подмешиваем
+    skip = {hash((m.get("content") or "").strip()) for m in (recent or [])[-RECALL_TAIL_ITEMS:]}
+    hits = idx.search(query, RECALL_TOP_K, skip=skip)
+    return [best_passage(idx.texts[i], query) for score, i in hits if score >= RECALL_MIN_SCORE]
+
+
+async def note(chat_id: int, text: str) -> None:
+    if not RECALL_ENABLED:
+        return
+    idx = _indexes.get(chat_id)
+    if idx is None:
+        return
+    idx.add(text, dt.datetime.now(dt.timezone.utc))
+    if idx.dirty >= RECALL_SAVE_EVERY:
+        await _save(chat_id, idx)
+
+
+async def forget(chat_id: int) -> None:
+    _indexes.pop(chat_id, None)
+    from db import recall_snapshot_drop
+
+    await recall_snapshot_drop(chat_id)
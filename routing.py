@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger("routing")
+
+ROUTING_ENABLED = (os.getenv("ROUTING_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+# gpt-5/o-модели принимают только max_completion_tokens; для старых совместимых API — max_tokens
+MAX_TOKENS_PARAM = os.getenv("ROUTING_MAX_TOKENS_PARAM", "max_completion_tokens")
+
+_BASE_MODEL = os.getenv("OPENAI_MODEL", "gpt-5.1")
+
+TIERS: Tuple[str, ...] = ("fast", "standard", "heavy")
+
+# Таблица уровней: модель и бюджет ответа. Переопределяется целиком или частично через ROUTING_TABLE (JSON),
+# например: ROUTING_TABLE='{"fast": {"max_tokens": 500}, "heavy": {"model": "gpt-5.1"}}'.
+# У reasoning-моделей (gpt-5.x, o-серия) max_completion_tokens включает и скрытые токены рассуждений,
+# поэтому бюджеты заметно больше длины видимого ответа; 0 — без ограничения.
+ROUTING_TABLE: Dict[str, Dict[str, object]] = {
+    "fast": {"model": os.getenv("OPENAI_FAST_MODEL") or _BASE_MODEL, "max_tokens": 4000},
+    "standard": {"model": _BASE_MODEL, "max_tokens": 8000},
+    "heavy": {"model": os.getenv("OPENAI_HEAVY_MODEL") or _BASE_MODEL, "max_tokens": 16000},
+}
+try:
+    for _tier, _over in (json.loads(os.getenv("ROUTING_TABLE") or "{}") or {}).items():
+        if _tier in ROUTING_TABLE and isinstance(_over, dict):
+            ROUTING_TABLE[_tier].update(_over)
+except Exception as e:
+    log.warning("bad ROUTING_TABLE, using defaults: %s", e)
+
+# Потолок уровня по тарифу
+PLAN_MAX_TIER: Dict[str, str] = {
+    "free": os.getenv("ROUTING_FREE_MAX_TIER", "standard"),
+    "lite": os.getenv("ROUTING_LITE_MAX_TIER", "heavy"),
+    "pro": "heavy",
+}
+
+FAST_MAX_CHARS = int(os.getenv("ROUTING_FAST_MAX_CHARS", "140"))
+HEAVY_MIN_CHARS = int(os.getenv("ROUTING_HEAVY_MIN_CHARS", "700"))
+
+_RE_FORMULA = re.compile(
+    r"(?:\d\s*[+\-*/^=<>×÷]\s*[\w(]|[\w)]\s*[+\-*/^=<>×÷]\s*\d|[a-z]\s*=\s*[-(a-z]|\\frac|\\sqrt|√|∫|∑|∂|≤|≥|≠|"
+    r"\b(?:sin|cos|tg|tan|ctg|log|ln|lim)\s*\(?)",
+    re.IGNORECASE,
+)
+_RE_SIMPLE = re.compile(
+    r"^\s*(?:что\s+так(?:ое|ой|ая)|кто\s+так(?:ой|ая)|когда|где|сколько|как\s+переводится|переведи|"
+    r"что\s+значит|дай\s+определение|what\s+is|who\s+(?:is|was)|when|where|define|translate|"
+    r"was\s+ist|wer\s+ist|qu['’]est-ce\s+que|qui\s+est|qué\s+es|quién\s+es|nedir|kimdir)\b",
+    re.IGNORECASE,
+)
+_RE_HARD = re.compile(
+    r"\b(?:докаж\w*|вывед\w*|выведи|исследуй|оптимизиру\w*|сравни\w*|проанализиру\w*|подробн\w*|"
+    r"пошагов\w*|напиши\s+(?:код|программу|сочинение|эссе|реферат)|алгоритм\w*|"
+    r"prove|derive|analy[sz]e|compare|step[-\s]by[-\s]step|in\s+detail|write\s+(?:code|a\s+program|an?\s+essay))\b",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    tier: str
+    model: str
+    max_tokens: int  # 0 — параметр не передаётся
+    reasons: Tuple[str, ...]
+
+
+def classify(
+    text: str,
+    *,
+    engineering: bool = False,
+    teacher: bool = False,
+    template: str = "default",
+) -> Tuple[str, List[str]]:
+    t = (text or "").strip()
+    n = len(t)
+    formulas = len(_RE_FORMULA.findall(t))
+    reasons: List[str] = [f"len={n}"]
+    if formulas:
+        reasons.append(f"formulas={formulas}")
+
+    if engineering:
+        return "heavy", reasons + ["engineering"]
+    if n >= HEAVY_MIN_CHARS:
+        return "heavy", reasons + ["long"]
+    if _RE_HARD.search(t):
+        return "heavy", reasons + ["hard_kw"]
+    if formulas >= 3:
+        return "heavy", reasons + ["many_formulas"]
+
+    if teacher or template != "default":
+        return "standard", reasons + ["teacher" if teacher else f"template={template}"]
+    if n <= FAST_MAX_CHARS and not formulas and ("\n" not in t):
+        if _RE_SIMPLE.search(t):
+            return "fast", reasons + ["simple_kw"]
+        if n <= FAST_MAX_CHARS // 2:
+            return "fast", reasons + ["short"]
+    return "standard", reasons
+
+
+def _cap(tier: str, plan: Optional[str]) -> str:
+    limit = PLAN_MAX_TIER.get((plan or "free").lower(), "standard")
+    if limit in TIERS and TIERS.index(tier) > TIERS.index(limit):
+        return limit
+    return tier
+
+
+def decide(
+    text: str,
+    *,
+    plan: Optional[str] = None,
+    engineering: bool = False,
+    teacher: bool = False,
+    template: str = "default",
+) -> Route:
+    if not ROUTING_ENABLED:
+        # Как до маршрутизации: базовая модель и никакого лимита на ответ
+        return Route("standard", _BASE_MODEL, 0, ("disabled",))
+    tier, reasons = classify(text, engineering=engineering, teacher=teacher, template=template)
+    capped = _cap(tier, plan)
+    if capped != tier:
+        reasons.append(f"cap:{plan}")
+    row = ROUTING_TABLE[capped]
+    metrics.inc(f"routing.tier.{capped}")
+    return Route(capped, str(row["model"]), int(row["max_tokens"]), tuple(reasons))
+
+
+def report(route: Route, plan: Optional[str], ttft: Optional[float], total: float, chars: int) -> None:
+    metrics.observe(f"routing.{route.tier}.total_sec", total)
+    if ttft is not None:
+        metrics.observe(f"routing.{route.tier}.ttft_sec", ttft)
+    # Одна строка на запрос: по ней удобно подбирать пороги
+    log.info(
+        "route tier=%s model=%s plan=%s reasons=%s ttft=%s total=%.2fs out_chars=%s",
+        route.tier,
+        route.model,
+        plan or "-",
+        ",".join(route.reasons),
+        f"{ttft:.2f}s" if ttft is not None else "-",
+        total,
+        chars,
+    )
@@ -123,6 +123,19 @@ async def main():
 
     bot = await _create_bot()
 
+    from db import ensure_indexes
+
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        log.warning("Mongo indexes not ensured: %s", e)
+
+    import pdfpool
+
+    # Процессы рендера PDF поднимаются и прогреваются до первого запроса
+    with contextlib.suppress(Exception):
+        pdfpool.start()
+
     tasks: list[asyncio.Task] = []
     try:
         if _want_polling():
@@ -134,8 +147,19 @@ async def main():
         if not tasks:
             raise RuntimeError("Nothing to run: check MODE/USE_WATA/RUN_WEBHOOK_SERVER")
 
+        # Уведомления об оплате из outbox: их ставит обработчик вебхуков, возможно, в другом процессе
+        import payinbox
+
+        tasks.append(asyncio.create_task(payinbox.run_outbox(bot), name="outbox"))
+
         await _run_until_first_exception(tasks)
     finally:
+        import usage
+
+        with contextlib.suppress(Exception):
+            await usage.shutdown()
+        with contextlib.suppress(Exception):
+            pdfpool.shutdown()
         with contextlib.suppress(Exception):
             await bot.session.close()
 
@@ -3,12 +3,23 @@ from __future__ import annotations
 import os
 import logging
 import re
+import time
 import shutil
+import asyncio
+import contextlib
+import multiprocessing
 from io import BytesIO
-from typing import Optional, Tuple, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Callable, Dict, FrozenSet, Optional, Tuple, Iterable
 
 from openai import AsyncOpenAI
 
+import answerdoc
+import breaker
+import metrics
+import usage
+
 log = logging.getLogger("tts")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -24,6 +35,18 @@ TTS_USE_SSML = os.getenv("TTS_USE_SSML", "true").lower() == "true"
 TTS_SPEED_MIN = float(os.getenv("TTS_SPEED_MIN", "0.85"))
 TTS_SPEED_MAX = float(os.getenv("TTS_SPEED_MAX", "1.25"))
 
+# tts-1/tts-1-hd умеют speed сами — тогда ни SSML, ни перекодирования не нужно
+TTS_NATIVE_SPEED_MODELS = {
+    m.strip() for m in (os.getenv("TTS_NATIVE_SPEED_MODELS") or "tts-1,tts-1-hd").split(",") if m.strip()
+}
+# Стрим от провайдера сразу идёт в stdin ffmpeg (atempo + opus), без полного буфера и pydub
+TTS_STREAM_ENCODE = (os.getenv("TTS_STREAM_ENCODE") or "true").lower() in {"1", "true", "yes", "y"}
+
+# Декодирование/ускорение/перекодирование аудио — CPU-работа на сотни мс; держим её вне event loop
+TTS_POOL_WORKERS = int(os.getenv("TTS_POOL_WORKERS", "2"))
+TTS_POOL_MAX_QUEUE = int(os.getenv("TTS_POOL_MAX_QUEUE", "16"))
+TTS_POOL_TIMEOUT_SEC = float(os.getenv("TTS_POOL_TIMEOUT_SEC", "60"))
+
 if not OPENAI_API_KEY:
     log.warning("OPENAI_API_KEY is empty: TTS will fail without it")
 
@@ -67,112 +90,339 @@ def _ffmpeg_available() -> bool:
     return shutil.which("ffmpeg") is not None
 
 
-_RE_CODEBLOCK = re.compile(r"```.+?```", re.DOTALL)
-_RE_INLINE_CODE = re.compile(r"`([^`]+)`")
-_RE_LATEX_WRAPS = re.compile(r"(\\\[|\\\]|\\\(|\\\))")
-_RE_LATEX_FRAC = re.compile(r"\\frac\s*\{([^{}]+)\}\s*\{([^{}]+)\}", re.IGNORECASE)
-_RE_LATEX_SQRT = re.compile(r"\\sqrt\{([^{}]+)\}", re.IGNORECASE)
 _RE_SPACES = re.compile(r"\s{2,}")
-_RE_TEN_POW = re.compile(r"(\b10)\s*\^\s*\(?\s*(-?\d+)\s*\)?")
-_RE_LETTER_POW = re.compile(r"([a-zA-Zа-яА-Я])\s*\^\s*\(?\s*(\d+)\s*\)?", re.UNICODE)
+_RE_WS = re.compile(r"\s+")
+_RE_PARAGRAPHS = re.compile(r"(?:\n\s*){2,}")
+
+# Определение языка: первый язык по порядку таблицы, чьи символы встречаются в тексте.
+# Один проход set() по тексту; для uz символ-признак (апостроф) ещё подтверждается функцией.
+_RE_UZ_APOS = re.compile(r"[oOgG][’'‘][a-z]")
+# Английские сокращения (who's, don't, we're…) — апостроф не узбекский
+_RE_EN_CONTRACTION = re.compile(r"(?:\w[’'](?:s|t|re|ve|ll)|n[’']t)\b", re.IGNORECASE)
+
+
+def _looks_uzbek(t: str) -> bool:
+    # Буквы oʻ/gʻ узбекской латиницы и знак тутук (ʼ) — однозначный признак
+    if "ʻ" in t or "ʼ" in t:
+        return True
+    # Обычный апостроф: нужно несколько oʻ/gʻ внутри слов и ни одного английского сокращения
+    return len(_RE_UZ_APOS.findall(t)) >= 2 and not _RE_EN_CONTRACTION.search(t)
 
-_RE_MD_HEADER = re.compile(r"^\s{0,3}#{1,6}\s+", re.MULTILINE)
-_RE_MD_BOLD_STAR = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
-_RE_MD_BOLD_UND = re.compile(r"__(.+?)__", re.DOTALL)
-_RE_MD_ITALIC_STAR = re.compile(r"(?<!\w)\*(?!\s)(.+?)(?<!\s)\*(?!\w)", re.DOTALL)
-_RE_MD_ITALIC_UND = re.compile(r"(?<!\w)_(?!\s)(.+?)(?<!\s)_(?!\w)", re.DOTALL)
-_RE_MD_BULLET = re.compile(r"^\s*[-*•]\s+", re.MULTILINE)
 
-_RE_MUL_STAR = re.compile(r"(?<=[0-9A-Za-zА-Яа-я\)\]])\s*\*\s*(?=[0-9A-Za-zА-Яа-я\(\[])")
-_RE_DIV_SLASH = re.compile(r"(?<=[0-9A-Za-zА-Яа-я\)\]])\s*/\s*(?=[0-9A-Za-zА-Яа-я\(\[])")
+_LANG_SIGNS: Tuple[Tuple[str, FrozenSet[str], Optional[Callable[[str], bool]]], ...] = (
+    ("ar", frozenset(map(chr, range(0x0600, 0x0700))), None),
+    ("hi", frozenset(map(chr, range(0x0900, 0x0980))), None),
+    ("kk", frozenset("әғқңөұүһіӘҒҚҢӨҰҮҺІ"), None),
+    ("ru", frozenset(map(chr, range(0x0400, 0x0500))), None),
+    ("uz", frozenset("ʻʼ'’‘"), _looks_uzbek),
+    ("tr", frozenset("ğşıİĞŞ"), None),
+    ("de", frozenset("äöüßÄÖÜ"), None),
+    ("fr", frozenset("éèêëàâîïôùûçœÉÈÊÀÇ"), None),
+    ("es", frozenset("ñ¡¿Ñ"), None),
+)
 
-_ARABIC_RE = re.compile(r"[\u0600-\u06FF]")
-_DEVANAGARI_RE = re.compile(r"[\u0900-\u097F]")
-_CYRILLIC_RE = re.compile(r"[\u0400-\u04FF]")
+_SCRIPT = {"ar": "arab", "hi": "deva", "ru": "cyrl", "kk": "cyrl"}
+_LATIN_SIGNS: FrozenSet[str] = frozenset().union(*(sign for lang, sign, _ in _LANG_SIGNS if lang not in _SCRIPT))
 
 
 def _guess_lang(text: str) -> str:
     t = text or ""
-    if _ARABIC_RE.search(t):
-        return "ar"
-    if _DEVANAGARI_RE.search(t):
-        return "hi"
-    if _CYRILLIC_RE.search(t):
-        return "ru"
-    tl = t.lower()
-    if any(ch in tl for ch in "ğüşöçıİ".lower()):
-        return "tr"
-    if any(ch in tl for ch in "äöüß"):
-        return "de"
-    if any(ch in tl for ch in "éèêëàâîïôùûçœ"):
-        return "fr"
-    if any(ch in tl for ch in "ñ¡¿"):
-        return "es"
+    chars = set(t)
+    for lang, sign, confirm in _LANG_SIGNS:
+        if not chars.isdisjoint(sign) and (confirm is None or confirm(t)):
+            return lang
     return "en"
 
 
-def _strip_markdown(t: str) -> str:
-    t = _RE_MD_HEADER.sub("", t)
-    t = _RE_MD_BULLET.sub("", t)
-    t = _RE_MD_BOLD_STAR.sub(r"\1", t)
-    t = _RE_MD_BOLD_UND.sub(r"\1", t)
-    t = _RE_MD_ITALIC_STAR.sub(r"\1", t)
-    t = _RE_MD_ITALIC_UND.sub(r"\1", t)
-    t = t.replace("**", " ").replace("__", " ")
-    return t
+def _resolve_lang(text: str, hint: Optional[str]) -> str:
+    """Язык интерфейса пользователя берётся, если письменность текста с ним совпадает;
+    иначе (ответ на другом языке по просьбе пользователя) — определяем по тексту.
+
+    В латинице подсказка сильнее догадки только когда догадке не за что зацепиться: вышел «en»
+    по умолчанию и в тексте нет ни одного символа-признака. Найденные ü, ñ, ş и т.п. важнее подсказки."""
+    guessed = _guess_lang(text)
+    hint = (hint or "").lower()
+    if hint not in _SPEECH:
+        return guessed
+    script = _SCRIPT.get(hint, "latn")
+    if script != _SCRIPT.get(guessed, "latn"):
+        return guessed
+    if script != "latn":
+        return hint
+    if guessed == "en" and _LATIN_SIGNS.isdisjoint(text or ""):
+        return hint
+    return guessed
+
+
+# ----------------- Нормализация текста для озвучки -----------------
+# Два прохода вместо полутора десятков: разметку снимает общий разбор ответа (answerdoc),
+# затем математика и единицы — одним regex на язык, собранным из таблицы _SPEECH.
+
+# Обозначения единиц: латиница для всех языков, кириллица — дополнительно для ru/kk.
+# Озвучиваются только после числа («5 м», «10 кН»), иначе «м», «с», «В» путаются с переменными и словами.
+# Составные «кН/м», «кН·м» читаются по шаблонам per/prod; units_one — форма единственного числа
+# там, где units во множественном («kilonewtons per metre», «kilonewton-metres»).
+_UNITS_LATIN = ("kN", "N", "J", "m/s", "km/h", "cm", "mm", "km", "kg", "g", "m", "s",
+                "Pa", "kPa", "MPa", "W", "kW", "V", "A", "Hz", "°C")
+_UNITS_CYR = ("кН", "Н", "Дж", "м/с", "км/ч", "см", "мм", "км", "кг", None, "м", "с",
+              "Па", "кПа", "МПа", "Вт", "кВт", "В", "А", "Гц", "°C")
+
+_SPEECH: Dict[str, Dict[str, Any]] = {
+    "ru": {
+        "mul": "умножить на", "div": "делить на", "eq": "равно", "approx": "примерно равно",
+        "le": "меньше либо равно", "ge": "больше либо равно", "ne": "не равно",
+        "lt": "меньше", "gt": "больше", "pm": "плюс-минус", "minus": "минус",
+        "frac": "({0}) делить на ({1})", "sqrt": "квадратный корень из {0}",
+        "sq": "в квадрате", "cube": "в кубе", "pow": "в степени {0}",
+        "per": "{0} на {1}", "prod": "{0}-{1}",
+        "units": ("килоньютон", "ньютон", "джоуль", "метр в секунду", "километр в час", "сантиметр",
+                  "миллиметр", "километр", "килограмм", "грамм", "метр", "секунда", "паскаль",
+                  "килопаскаль", "мегапаскаль", "ватт", "киловатт", "вольт", "ампер", "герц", "градус Цельсия"),
+    },
+    "kk": {
+        "mul": "көбейту", "div": "бөлу", "eq": "тең", "approx": "шамамен тең",
+        "le": "кіші немесе тең", "ge": "үлкен немесе тең", "ne": "тең емес",
+        "lt": "кіші", "gt": "үлкен", "pm": "плюс-минус", "minus": "минус",
+        "frac": "({0}) бөлу ({1})", "sqrt": "{0} санының квадрат түбірі",
+        "sq": "квадраты", "cube": "кубы", "pow": "{0} дәрежесі",
+        "per": "{0} бөлінген {1}", "prod": "{0}-{1}",
+        "units": ("килоньютон", "ньютон", "джоуль", "метр секундына", "километр сағатына", "сантиметр",
+                  "миллиметр", "километр", "килограмм", "грамм", "метр", "секунд", "паскаль",
+                  "килопаскаль", "мегапаскаль", "ватт", "киловатт", "вольт", "ампер", "герц", "Цельсий градусы"),
+    },
+    "en": {
+        "mul": "times", "div": "divided by", "eq": "equals", "approx": "is approximately",
+        "le": "is less than or equal to", "ge": "is greater than or equal to", "ne": "is not equal to",
+        "lt": "is less than", "gt": "is greater than", "pm": "plus or minus", "minus": "minus",
+        "frac": "({0}) divided by ({1})", "sqrt": "the square root of {0}",
+        "sq": "squared", "cube": "cubed", "pow": "to the power of {0}",
+        "per": "{0} per {1}", "prod": "{0}-{1}",
+        "units": ("kilonewtons", "newtons", "joules", "metres per second", "kilometres per hour", "centimetres",
+                  "millimetres", "kilometres", "kilograms", "grams", "metres", "seconds", "pascals",
+                  "kilopascals", "megapascals", "watts", "kilowatts", "volts", "amperes", "hertz", "degrees Celsius"),
+        "units_one": ("kilonewton", "newton", "joule", "metre per second", "kilometre per hour", "centimetre",
+                      "millimetre", "kilometre", "kilogram", "gram", "metre", "second", "pascal",
+                      "kilopascal", "megapascal", "watt", "kilowatt", "volt", "ampere", "hertz", "degree Celsius"),
+    },
+    "de": {
+        "mul": "mal", "div": "geteilt durch", "eq": "gleich", "approx": "ungefähr gleich",
+        "le": "kleiner oder gleich", "ge": "größer oder gleich", "ne": "ungleich",
+        "lt": "kleiner als", "gt": "größer als", "pm": "plus minus", "minus": "minus",
+        "frac": "({0}) geteilt durch ({1})", "sqrt": "Wurzel aus {0}",
+        "sq": "zum Quadrat", "cube": "hoch drei", "pow": "hoch {0}",
+        "per": "{0} pro {1}", "prod": "{0}-{1}",
+        "units": ("Kilonewton", "Newton", "Joule", "Meter pro Sekunde", "Kilometer pro Stunde", "Zentimeter",
+                  "Millimeter", "Kilometer", "Kilogramm", "Gramm", "Meter", "Sekunden", "Pascal",
+                  "Kilopascal", "Megapascal", "Watt", "Kilowatt", "Volt", "Ampere", "Hertz", "Grad Celsius"),
+        "units_one": ("Kilonewton", "Newton", "Joule", "Meter pro Sekunde", "Kilometer pro Stunde", "Zentimeter",
+                      "Millimeter", "Kilometer", "Kilogramm", "Gramm", "Meter", "Sekunde", "Pascal",
+                      "Kilopascal", "Megapascal", "Watt", "Kilowatt", "Volt", "Ampere", "Hertz", "Grad Celsius"),
+    },
+    "fr": {
+        "mul": "fois", "div": "divisé par", "eq": "égale", "approx": "environ égal à",
+        "le": "inférieur ou égal à", "ge": "supérieur ou égal à", "ne": "différent de",
+        "lt": "inférieur à", "gt": "supérieur à", "pm": "plus ou moins", "minus": "moins",
+        "frac": "({0}) divisé par ({1})", "sqrt": "racine carrée de {0}",
+        "sq": "au carré", "cube": "au cube", "pow": "puissance {0}",
+        "per": "{0} par {1}", "prod": "{0}-{1}",
+        "units": ("kilonewtons", "newtons", "joules", "mètres par seconde", "kilomètres par heure", "centimètres",
+                  "millimètres", "kilomètres", "kilogrammes", "grammes", "mètres", "secondes", "pascals",
+                  "kilopascals", "mégapascals", "watts", "kilowatts", "volts", "ampères", "hertz", "degrés Celsius"),
+        "units_one": ("kilonewton", "newton", "joule", "mètre par seconde", "kilomètre par heure", "centimètre",
+                      "millimètre", "kilomètre", "kilogramme", "gramme", "mètre", "seconde", "pascal",
+                      "kilopascal", "mégapascal", "watt", "kilowatt", "volt", "ampère", "hertz", "degré Celsius"),
+    },
+    "es": {
+        "mul": "por", "div": "dividido entre", "eq": "igual a", "approx": "aproximadamente igual a",
+        "le": "menor o igual que", "ge": "mayor o igual que", "ne": "distinto de",
+        "lt": "menor que", "gt": "mayor que", "pm": "más menos", "minus": "menos",
+        "frac": "({0}) dividido entre ({1})", "sqrt": "raíz cuadrada de {0}",
+        "sq": "al cuadrado", "cube": "al cubo", "pow": "elevado a {0}",
+        "per": "{0} por {1}", "prod": "{0}-{1}",
+        "units": ("kilonewtons", "newtons", "julios", "metros por segundo", "kilómetros por hora", "centímetros",
+                  "milímetros", "kilómetros", "kilogramos", "gramos", "metros", "segundos", "pascales",
+                  "kilopascales", "megapascales", "vatios", "kilovatios", "voltios", "amperios", "hercios",
+                  "grados Celsius"),
+        "units_one": ("kilonewton", "newton", "julio", "metro por segundo", "kilómetro por hora", "centímetro",
+                      "milímetro", "kilómetro", "kilogramo", "gramo", "metro", "segundo", "pascal",
+                      "kilopascal", "megapascal", "vatio", "kilovatio", "voltio", "amperio", "hercio",
+                      "grado Celsius"),
+    },
+    "tr": {
+        "mul": "çarpı", "div": "bölü", "eq": "eşittir", "approx": "yaklaşık eşittir",
+        "le": "küçük eşittir", "ge": "büyük eşittir", "ne": "eşit değildir",
+        "lt": "küçüktür", "gt": "büyüktür", "pm": "artı eksi", "minus": "eksi",
+        "frac": "({0}) bölü ({1})", "sqrt": "karekök {0}",
+        "sq": "kare", "cube": "küp", "pow": "üssü {0}",
+        "per": "{0} bölü {1}", "prod": "{0} {1}",
+        "units": ("kilonewton", "newton", "joule", "metre bölü saniye", "kilometre bölü saat", "santimetre",
+                  "milimetre", "kilometre", "kilogram", "gram", "metre", "saniye", "pascal",
+                  "kilopascal", "megapascal", "watt", "kilowatt", "volt", "amper", "hertz", "santigrat derece"),
+    },
+    "uz": {
+        "mul": "ko‘paytirish", "div": "bo‘lish", "eq": "teng", "approx": "taxminan teng",
+        "le": "kichik yoki teng", "ge": "katta yoki teng", "ne": "teng emas",
+        "lt": "kichik", "gt": "katta", "pm": "plyus-minus", "minus": "minus",
+        "frac": "({0}) bo‘lish ({1})", "sqrt": "{0} ning kvadrat ildizi",
+        "sq": "kvadrati", "cube": "kubi", "pow": "{0} darajasi",
+        "per": "{0} bo‘lingan {1}", "prod": "{0}-{1}",
+        "units": ("kilonyuton", "nyuton", "joul", "metr sekundiga", "kilometr soatiga", "santimetr",
+                  "millimetr", "kilometr", "kilogramm", "gramm", "metr", "sekund", "paskal",
+                  "kilopaskal", "megapaskal", "vatt", "kilovatt", "volt", "amper", "gers", "gradus Selsiy"),
+    },
+    "ar": {
+        "mul": "ضرب", "div": "قسمة", "eq": "يساوي", "approx": "يساوي تقريبا",
+        "le": "أصغر من أو يساوي", "ge": "أكبر من أو يساوي", "ne": "لا يساوي",
+        "lt": "أصغر من", "gt": "أكبر من", "pm": "زائد أو ناقص", "minus": "سالب",
+        "frac": "({0}) قسمة ({1})", "sqrt": "الجذر التربيعي لـ {0}",
+        "sq": "تربيع", "cube": "تكعيب", "pow": "أس {0}",
+        "per": "{0} لكل {1}", "prod": "{0} {1}",
+        "units": ("كيلونيوتن", "نيوتن", "جول", "متر في الثانية", "كيلومتر في الساعة", "سنتيمتر",
+                  "مليمتر", "كيلومتر", "كيلوغرام", "غرام", "متر", "ثانية", "باسكال",
+                  "كيلوباسكال", "ميغاباسكال", "واط", "كيلوواط", "فولت", "أمبير", "هرتز", "درجة مئوية"),
+    },
+    "hi": {
+        "mul": "गुणा", "div": "भाग", "eq": "बराबर", "approx": "लगभग बराबर",
+        "le": "से कम या बराबर", "ge": "से अधिक या बराबर", "ne": "बराबर नहीं",
+        "lt": "से कम", "gt": "से अधिक", "pm": "धन-ऋण", "minus": "ऋण",
+        "frac": "({0}) भाग ({1})", "sqrt": "{0} का वर्गमूल",
+        "sq": "का वर्ग", "cube": "का घन", "pow": "की घात {0}",
+        "per": "{0} प्रति {1}", "prod": "{0}-{1}",
+        "units": ("किलोन्यूटन", "न्यूटन", "जूल", "मीटर प्रति सेकंड", "किलोमीटर प्रति घंटा", "सेंटीमीटर",
+                  "मिलीमीटर", "किलोमीटर", "किलोग्राम", "ग्राम", "मीटर", "सेकंड", "पास्कल",
+                  "किलोपास्कल", "मेगापास्कल", "वाट", "किलोवाट", "वोल्ट", "एम्पियर", "हर्ट्ज़", "डिग्री सेल्सियस"),
+    },
+}
+
+# Каждая ветка начинается с литерала или якоря, а имя-маркер стоит в конце: так sre отбрасывает
+# неподходящие ветки по первому символу, не заходя в группу. Проверки «слева» — после съеденного символа.
+_MATH_PATTERN = (
+    r"\\(?:"
+    r"frac\s*\{(?P<num>[^{}]+)\}\s*\{(?P<den>[^{}]+)\}(?P<frac>)"
+    r"|sqrt\s*\{(?P<rad>[^{}]+)\}(?P<sqrt>)"
+    r"|leq?\b(?P<le>)|geq?\b(?P<ge>)|neq?\b(?P<ne>)|approx\b(?P<approx>)|pm\b(?P<pm>)"
+    r"|(?:cdot|times)\b(?P<mul>)"
+    r")"
+    r"|√\s*(?:\{(?P<rad2>[^{}]+)\}|\((?P<rad3>[^()]+)\)|(?P<rad4>[\w.,]+))(?P<sqrt_>)"
+    r"|\d(?P<uclose>\)?) ?(?P<usym>{units})(?:(?P<uop>[/·⋅*])(?P<usym2>{units}))?(?![^\W²³]|/)(?P<unit>)"
+    r"|<=(?P<le_>)|>=(?P<ge_>)|!=(?P<ne_>)"
+    r"|[≤≥≠≈±=·×÷²³](?P<sym>)"
+    r"|\*(?:(?<=[\w)\]]\*)|(?<=[\w)\]]\s\*))\s*(?=[\w(\[])(?P<mul_>)"
+    r"|/(?:(?<=[\w)\]]/)|(?<=[\w)\]]\s/))\s*(?=[\w(\[])(?P<div>)"
+    r"|<(?<=\s<)(?=\s)(?P<lt>)|>(?<=\s>)(?=\s)(?P<gt>)"
+    r"|\^\s*[({]?\s*(?P<exp>-?(?:\d+|[A-Za-z]))(?:\s*[)}])?(?: ?(?P<punit>{units})(?![^\W²³]|/))?(?P<pow>)"
+)
+_SYM_KEY = {"≤": "le", "≥": "ge", "≠": "ne", "≈": "approx", "±": "pm", "=": "eq",
+            "·": "mul", "×": "mul", "÷": "div", "²": "sq", "³": "cube"}
+_GROUP_KEY = {"sqrt_": "sqrt", "le_": "le", "ge_": "ge", "ne_": "ne", "mul_": "mul"}
+
+
+class _SpeechRules:
+    """Скомпилированный под один язык проход по математике и единицам."""
+
+    def __init__(self, table: Dict[str, Any], cyrillic: bool) -> None:
+        self.t = table
+        units: Dict[str, str] = {}
+        for sym, spoken in zip(_UNITS_LATIN, table["units"]):
+            units[sym] = spoken
+        if cyrillic:
+            for sym, spoken in zip(_UNITS_CYR, table["units"]):
+                if sym:
+                    units[sym] = spoken
+        self.units = units
+        units_one: Dict[str, str] = dict(units)
+        if "units_one" in table:
+            for sym, spoken in zip(_UNITS_LATIN, table["units_one"]):
+                units_one[sym] = spoken
+        self.units_one = units_one
+        alt = "|".join(re.escape(u) for u in sorted(units, key=len, reverse=True))
+        self.rx = re.compile(_MATH_PATTERN.replace("{units}", alt))
+        # Готовые замены для простых веток — колбэк вызывается на каждое совпадение
+        self.sym = {ch: self._word(key) for ch, key in _SYM_KEY.items()}
+        self.static = {
+            g: self._word(_GROUP_KEY.get(g, g))
+            for g in ("le", "ge", "ne", "approx", "pm", "mul", "le_", "ge_", "ne_", "mul_", "div", "lt", "gt")
+        }
+
+    def _word(self, key: str) -> str:
+        return f" {self.t[key]} "
+
+    def _repl(self, m: "re.Match[str]") -> str:
+        g = m.lastgroup
+        if g == "sym":
+            return self.sym[m.group()]
+        w = self.static.get(g)
+        if w is not None:
+            return w
+        t = self.t
+        if g == "unit":
+            sym2 = m.group("usym2")
+            if sym2 is None:
+                spoken = self.units[m.group("usym")]
+            elif m.group("uop") == "/":
+                spoken = t["per"].format(self.units[m.group("usym")], self.units_one[sym2])
+            else:
+                spoken = t["prod"].format(self.units_one[m.group("usym")], self.units[sym2])
+            return m.group(0)[0] + m.group("uclose") + " " + spoken + " "
+        if g == "frac":
+            return " " + t["frac"].format(self.speak(m.group("num")), self.speak(m.group("den"))) + " "
+        if g in ("sqrt", "sqrt_"):
+            rad = m.group("rad") or m.group("rad2") or m.group("rad3") or m.group("rad4") or ""
+            return " " + t["sqrt"].format(self.speak(rad)) + " "
+        if g == "pow":
+            exp = m.group("exp")
+            if exp == "2":
+                out = self._word("sq")
+            elif exp == "3":
+                out = self._word("cube")
+            else:
+                if exp.startswith("-"):
+                    exp = f"{t['minus']} {exp[1:]}"
+                out = " " + t["pow"].format(exp) + " "
+            unit = m.group("punit")
+            return out + self.units[unit] + " " if unit else out
+        return m.group()
+
+    def speak(self, text: str) -> str:
+        return self.rx.sub(self._repl, text)
+
+
+_RULES: Dict[str, _SpeechRules] = {
+    lang: _SpeechRules(table, cyrillic=lang in {"ru", "kk"}) for lang, table in _SPEECH.items()
+}
 
 
-def _normalize_text(text: str, lang: Optional[str]) -> str:
+def _normalize_text(text: str, lang: Optional[str], plain: bool = False) -> str:
+    """plain=True — текст уже без разметки (answerdoc.plain), повторно не разбираем.
+    lang — язык интерфейса как подсказка, см. _resolve_lang."""
     t = (text or "").strip()
     if not t:
         return ""
-    lg = (lang or _guess_lang(t)).lower()
-
-    t = _RE_CODEBLOCK.sub(" ", t)
-    t = _RE_INLINE_CODE.sub(r"\1", t)
-    t = _RE_LATEX_WRAPS.sub(" ", t)
-    t = _strip_markdown(t)
-
-    if lg == "ru":
-        t = _RE_LATEX_FRAC.sub(r"(\1) делить на (\2)", t)
-        t = _RE_LATEX_SQRT.sub(r"квадратный корень из \1", t)
-
-        t = t.replace("·", " умножить на ")
-        t = _RE_MUL_STAR.sub(" умножить на ", t)
-
-        t = _RE_DIV_SLASH.sub(" делить на ", t)
-        t = t.replace("=", " равно ")
-        t = t.replace("≈", " примерно равно ").replace("≤", " меньше либо равно ")
-        t = t.replace("≥", " больше либо равно ").replace("≠", " не равно ")
-
-        t = re.sub(r"\bкН\b", " килоНьютон ", t, flags=re.IGNORECASE)
-        t = re.sub(r"\bН\b", " Ньютон ", t)
-        t = re.sub(r"\bДж\b", " Джоуль ", t)
-        t = re.sub(r"\bм/с\b", " метр в секунду ", t, flags=re.IGNORECASE)
-        t = re.sub(r"\bсм\b", " сантиметр ", t, flags=re.IGNORECASE)
-    else:
-        t = _RE_LATEX_FRAC.sub(r"(\1) / (\2)", t)
-        t = _RE_LATEX_SQRT.sub(r"sqrt(\1)", t)
+    lg = _resolve_lang(t, lang)
+    rules = _RULES.get(lg) or _RULES["en"]
 
-    t = _RE_TEN_POW.sub(r"\1^(\2)", t)
-    t = _RE_LETTER_POW.sub(r"\1^(\2)", t)
+    if not plain:
+        t = answerdoc.plain(answerdoc.parse(t))
+    t = rules.speak(t)
     t = t.replace("\\", " ")
 
     return _RE_SPACES.sub(" ", t).strip()
 
 
+_RE_SENT_BOUNDARY = re.compile(
+    r"(?<!\bт\.д)(?<!\bт\.п)(?<!\bи\.т\.д)(?<!\bсм)(?<!\bрис)(?<!\be\.g)(?<!\bi\.e)\.(\s+|$)|[!?](\s+|$)",
+    re.IGNORECASE,
+)
+
+
 def _chunk_sentences(text: str) -> list[str]:
-    t = re.sub(r"\s+", " ", text or "").strip()
+    t = _RE_WS.sub(" ", text or "").strip()
     if not t:
         return []
 
-    boundary = re.compile(
-        r"(?<!\bт\.д)(?<!\bт\.п)(?<!\bи\.т\.д)(?<!\bсм)(?<!\bрис)(?<!\be\.g)(?<!\bi\.e)\.(\s+|$)|[!?](\s+|$)",
-        re.IGNORECASE,
-    )
     out: list[str] = []
     start = 0
-    for m in boundary.finditer(t):
+    for m in _RE_SENT_BOUNDARY.finditer(t):
         s = t[start:m.end()].strip()
         if s:
             out.append(s)
@@ -183,6 +433,65 @@ def _chunk_sentences(text: str) -> list[str]:
     return out or [t]
 
 
+class SpeechSegmenter:
+    """Режет живой поток дельт LLM на куски для TTS: первый — короткий, дальше по абзацам до max_chars."""
+
+    def __init__(self, first_chars: int = 400, max_chars: int = 2500, min_chars: int = 600) -> None:
+        self.first_chars = first_chars
+        self.max_chars = max_chars
+        self.min_chars = min(min_chars, max_chars)
+        self._buf = ""
+        self._emitted = 0
+
+    def feed(self, delta: str) -> list[str]:
+        self._buf += delta or ""
+        out: list[str] = []
+        while True:
+            cut = self._cut_point()
+            if cut is None:
+                return out
+            piece, self._buf = self._buf[:cut].strip(), self._buf[cut:]
+            if piece:
+                out.append(piece)
+                self._emitted += 1
+
+    def flush(self) -> list[str]:
+        piece, self._buf = self._buf.strip(), ""
+        return [piece] if piece else []
+
+    def _cut_point(self) -> Optional[int]:
+        buf = self._buf
+        # Не режем внутри блока кода — нормализатор выкидывает его только целиком
+        if buf.count("```") % 2:
+            return None
+        first = self._emitted == 0
+        target = self.first_chars if first else self.max_chars
+        minimum = 1 if first else self.min_chars
+        if len(buf.strip()) < minimum:
+            return None
+
+        para = buf.rfind("\n\n", 0, target)
+        if para >= minimum:
+            return para + 2
+        if len(buf) < target:
+            return None
+
+        # Последняя граница предложения в пределах target; "$" в конце буфера не граница — текст ещё идёт
+        last = None
+        for m in _RE_SENT_BOUNDARY.finditer(buf, 0, target):
+            if (m.group(1) or m.group(2)) and m.end() >= minimum:
+                last = m.end()
+        if last is not None:
+            return last
+        for m in _RE_SENT_BOUNDARY.finditer(buf, target):
+            if m.group(1) or m.group(2):
+                return m.end()
+        if len(buf) >= 2 * target:
+            space = buf.rfind(" ", 0, target)
+            return space + 1 if space > 0 else target
+        return None
+
+
 def _wrap_ssml(sentences: Iterable[str], speed: Optional[float]) -> str:
     rate = ""
     if speed and abs(speed - 1.0) > 1e-3:
@@ -254,6 +563,105 @@ def _export_ogg_opus(seg) -> bytes:
     return buf.getvalue()
 
 
+def _postprocess_sync(
+    raw: bytes, ext: str, fmt_final: str, speed: Optional[float], ssml_used: bool
+) -> Tuple[bytes, str, str, float]:
+    """Выполняется в процессе пула; последним элементом возвращает собственное время работы."""
+    t0 = time.perf_counter()
+    try:
+        seg = _load_segment(raw, fmt_hint=ext)
+    except Exception:
+        return raw, _mime_for_ext(ext), ext, time.perf_counter() - t0
+
+    seg = _maybe_speed_segment(seg, speed, already_applied=ssml_used)
+
+    buf = BytesIO()
+    if fmt_final in {"ogg", "opus"}:
+        try:
+            return _export_ogg_opus(seg), "audio/ogg", "ogg", time.perf_counter() - t0
+        except Exception:
+            seg.export(buf, format="wav")
+            return buf.getvalue(), "audio/wav", "wav", time.perf_counter() - t0
+
+    if fmt_final == "mp3":
+        seg.export(buf, format="mp3", bitrate="128k")
+        return buf.getvalue(), "audio/mpeg", "mp3", time.perf_counter() - t0
+
+    seg.export(buf, format="wav")
+    return buf.getvalue(), "audio/wav", "wav", time.perf_counter() - t0
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_sem: Optional[asyncio.Semaphore] = None
+_pool_depth = 0
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: форкать процесс с живым event loop и сетевыми потоками небезопасно
+        _pool = ProcessPoolExecutor(max_workers=TTS_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _discard(pool: ProcessPoolExecutor, terminate: bool = False) -> None:
+    # Как в pdfpool: сбрасываем глобальный пул, только если это всё ещё он, новый поднимет _get_pool
+    global _pool
+    if _pool is pool:
+        _pool = None
+    if terminate:
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _postprocess(
+    raw: bytes, ext: str, fmt_final: str, speed: Optional[float], ssml_used: bool
+) -> Tuple[bytes, str, str]:
+    global _pool_sem, _pool_depth
+    if _pool_sem is None:
+        _pool_sem = asyncio.Semaphore(TTS_POOL_MAX_QUEUE)
+    t0 = time.monotonic()
+    _pool_depth += 1
+    metrics.gauge("tts.pool.depth", _pool_depth)
+    try:
+        async with _pool_sem:
+            pool = _get_pool()
+            fut = asyncio.get_running_loop().run_in_executor(
+                pool, _postprocess_sync, raw, ext, fmt_final, speed, ssml_used
+            )
+            try:
+                data, mime, out_ext, work = await asyncio.wait_for(fut, TTS_POOL_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                metrics.inc("tts.pool.timeout")
+                log.warning("TTS postprocess timed out after %.0fs, recycling pool", TTS_POOL_TIMEOUT_SEC)
+                # Зависшая задача держит воркер — отменить её по одному нельзя, пересоздаём пул
+                _discard(pool, terminate=True)
+                return raw, _mime_for_ext(ext), ext
+            except BrokenProcessPool:
+                log.warning("TTS process pool broken, recreating")
+                metrics.inc("tts.pool.broken")
+                _discard(pool)
+                return raw, _mime_for_ext(ext), ext
+            except asyncio.CancelledError:
+                # Задачу отменил _discard из-за чужого таймаута, а не вызывающий — отдаём сырой звук
+                task = asyncio.current_task()
+                if fut.cancelled() and task is not None and not task.cancelling():
+                    metrics.inc("tts.pool.recycled")
+                    return raw, _mime_for_ext(ext), ext
+                raise
+    except Exception as e:
+        log.warning("TTS postprocess failed: %s", e)
+        metrics.inc("tts.pool.failed")
+        return raw, _mime_for_ext(ext), ext
+    finally:
+        _pool_depth -= 1
+        metrics.gauge("tts.pool.depth", _pool_depth)
+    metrics.observe("tts.pool.job_sec", work)
+    metrics.observe("tts.pool.wait_sec", max(0.0, time.monotonic() - t0 - work))
+    return data, mime, out_ext
+
+
 def _response_format_from_fmt(fmt: str) -> str:
     f = (fmt or "").lower()
     if f in {"ogg", "opus"}:
@@ -265,6 +673,55 @@ def _response_format_from_fmt(fmt: str) -> str:
     return "opus"
 
 
+async def _ffmpeg_encode_stream(
+    chunks: AsyncIterator[bytes], target: str, tempo: Optional[float]
+) -> Optional[bytes]:
+    """Кормит ffmpeg байтами стрима по мере прихода; None — если сломался сам кодировщик."""
+    args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0"]
+    if tempo:
+        args += ["-filter:a", f"atempo={tempo:.3f}"]
+    if target == "mp3":
+        args += ["-c:a", "libmp3lame", "-b:a", "128k", "-f", "mp3"]
+    else:
+        args += ["-ac", "1", "-ar", "48000", "-c:a", "libopus", "-b:a", "40k",
+                 "-vbr", "on", "-compression_level", "10", "-f", "ogg"]
+    args.append("pipe:1")
+
+    t0 = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def pump() -> None:
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg уже упал — код возврата ниже это покажет
+        finally:
+            proc.stdin.close()
+
+    try:
+        out, err, _ = await asyncio.wait_for(
+            asyncio.gather(proc.stdout.read(), proc.stderr.read(), pump()), TTS_POOL_TIMEOUT_SEC
+        )
+        rc = await proc.wait()
+    except BaseException:
+        with contextlib.suppress(ProcessLookupError):
+            proc.kill()
+        raise
+    if rc != 0 or not out:
+        log.warning("ffmpeg stream encode failed (rc=%s): %s", rc, err.decode("utf-8", "ignore")[-300:])
+        metrics.inc("tts.ffmpeg.failed")
+        return None
+    metrics.observe("tts.ffmpeg.sec", time.monotonic() - t0)
+    return out
+
+
 async def tts_bytes(
     text: str,
     voice: str | None = None,
@@ -272,85 +729,99 @@ async def tts_bytes(
     model: str | None = None,
     speed: Optional[float] = None,
     lang: Optional[str] = None,
+    plain: bool = False,
+    meta: Optional[Dict[str, str]] = None,
 ) -> Tuple[bytes, str, str]:
-    t = _normalize_text(text, lang)
+    """meta["model"] получает модель, которая на самом деле синтезировала звук (после отказов — запасная)."""
+    t = _normalize_text(text, lang, plain)
     if not t:
         raise ValueError("tts: empty text")
 
     sents = _chunk_sentences(t)
     voice_final = _pick_voice(voice or TTS_DEFAULT_VOICE)
     fmt_final = (fmt or TTS_DEFAULT_FORMAT).lower()
+    target = "ogg" if fmt_final in {"ogg", "opus"} else fmt_final
     model_final = model or OPENAI_TTS_MODEL
     speed_final = _clamp_speed(speed)
 
     response_format = _response_format_from_fmt(fmt_final)
+    ext = "ogg" if response_format == "opus" else response_format
     client = _client_lazy()
+    plain = "\n\n".join(sents)
+
+    async def synthesize(m: str, ssml: bool, retry: bool = False, pipe: bool = True) -> Tuple[bytes, str, str]:
+        native = bool(speed_final) and m in TTS_NATIVE_SPEED_MODELS
+        ssml = ssml and bool(speed_final) and not native
+        tempo = speed_final if (speed_final and not native and not ssml) else None
+        extra = {"speed": speed_final} if native else {}
+        need = target in {"ogg", "mp3", "wav"} and (target != ext or bool(tempo))
+        piped = pipe and need and target in {"ogg", "mp3"} and TTS_STREAM_ENCODE and _ffmpeg_available()
+        p = _wrap_ssml(sents, speed_final) if ssml else plain
+        async with breaker.guard("tts", retry=retry):
+            async with client.audio.speech.with_streaming_response.create(
+                model=m,
+                voice=voice_final,
+                input=p,
+                response_format=response_format,
+                **extra,
+            ) as resp:
+                if piped:
+                    data = await _ffmpeg_encode_stream(resp.iter_bytes(), target, tempo)
+                else:
+                    buf = BytesIO()
+                    async for chunk in resp.iter_bytes():
+                        buf.write(chunk)
+                    data = buf.getvalue()
+            usage.record(m, chars=len(p), feature="tts")
+        if meta is not None:
+            meta["model"] = m
+        if native:
+            metrics.inc("tts.native_speed")
+        if piped and data is None:
+            # Исходник уже прочитан в ffmpeg — повторяем синтез по буферизованному пути.
+            # Сбой локального кодировщика, а не провайдера: бюджет повторов не тратим,
+            # иначе при пустом бюджете пользователь получил бы «сервис перегружен»
+            return await synthesize(m, ssml, retry=False, pipe=False)
+        if piped:
+            return data, _mime_for_ext(target), target
+        if not need:
+            return data, _mime_for_ext(ext), ext
+        return await _postprocess(data, ext, target, tempo, False)
 
-    ssml_used = False
-    payload: str
-    if TTS_USE_SSML and speed_final:
-        payload = _wrap_ssml(sents, speed_final)
-        ssml_used = True
-    else:
-        payload = "\n\n".join(sents)
-
-    async def synthesize(m: str, p: str) -> bytes:
-        async with client.audio.speech.with_streaming_response.create(
-            model=m,
-            voice=voice_final,
-            input=p,
-            response_format=response_format,
-        ) as resp:
-            buf = BytesIO()
-            async for chunk in resp.iter_bytes():
-                buf.write(chunk)
-            return buf.getvalue()
-
-    raw: bytes
     try:
-        raw = await synthesize(model_final, payload)
+        return await synthesize(model_final, TTS_USE_SSML)
+    except breaker.BreakerOpen:
+        raise
     except Exception as e1:
         try:
-            raw = await synthesize(model_final, "\n\n".join(sents))
-            ssml_used = False
+            return await synthesize(model_final, False, retry=True)
+        except breaker.BreakerOpen:
+            raise
         except Exception as e2:
             log.warning("TTS primary failed: %s | retry failed: %s | fallback: %s", e1, e2, OPENAI_TTS_FALLBACK)
-            raw = await synthesize(OPENAI_TTS_FALLBACK, "\n\n".join(sents))
-            ssml_used = False
-
-    ext = "ogg" if response_format == "opus" else response_format
-    mime = _mime_for_ext(ext)
-
-    need_postprocess = (fmt_final in {"ogg", "opus", "mp3", "wav"} and (fmt_final != ext or (speed_final and not ssml_used)))
-    if not need_postprocess:
-        return raw, mime, ext
-
-    try:
-        seg = _load_segment(raw, fmt_hint=ext)
-    except Exception:
-        return raw, mime, ext
+            return await synthesize(OPENAI_TTS_FALLBACK, False, retry=True)
 
-    seg = _maybe_speed_segment(seg, speed_final, already_applied=ssml_used)
 
-    if fmt_final in {"ogg", "opus"}:
-        if ext == "ogg" and not (speed_final and not ssml_used):
-            return raw, "audio/ogg", "ogg"
-        try:
-            ogg = _export_ogg_opus(seg)
-            return ogg, "audio/ogg", "ogg"
-        except Exception:
-            buf = BytesIO()
-            seg.export(buf, format="wav")
-            return buf.getvalue(), "audio/wav", "wav"
-
-    if fmt_final == "mp3":
-        buf = BytesIO()
-        seg.export(buf, format="mp3", bitrate="128k")
-        return buf.getvalue(), "audio/mpeg", "mp3"
-
-    buf = BytesIO()
-    seg.export(buf, format="wav")
-    return buf.getvalue(), "audio/wav", "wav"
+def voice_cache_parts(
+    text: str,
+    voice: str | None = None,
+    speed: Optional[float] = None,
+    lang: Optional[str] = None,
+    fmt: str = "ogg",
+    plain: bool = False,
+    model: str | None = None,
+) -> Tuple[str, str, Optional[float], str, str]:
+    """Всё, от чего зависит результат синтеза, — из этого строится ключ кэша готовых голосовых.
+
+    model — модель, которой синтезирован звук; по умолчанию основная.
+    """
+    return (
+        _normalize_text(text, lang, plain),
+        _pick_voice(voice or TTS_DEFAULT_VOICE),
+        _clamp_speed(speed),
+        model or OPENAI_TTS_MODEL,
+        fmt,
+    )
 
 
 async def tts_voice_ogg(
@@ -358,8 +829,10 @@ async def tts_voice_ogg(
     voice: str | None = None,
     speed: Optional[float] = None,
     lang: Optional[str] = None,
+    plain: bool = False,
+    meta: Optional[Dict[str, str]] = None,
 ) -> BytesIO:
-    audio, _, ext = await tts_bytes(text, voice=voice, fmt="ogg", speed=speed, lang=lang)
+    audio, _, ext = await tts_bytes(text, voice=voice, fmt="ogg", speed=speed, lang=lang, plain=plain, meta=meta)
     bio = BytesIO(audio)
     bio.name = f"voice.{ext}"
     bio.seek(0)
@@ -380,14 +853,32 @@ async def tts_audio_file(
     return bio, mime
 
 
-def split_for_tts(text: str, max_chars: int = 2800) -> list[str]:
+def _split_head(chunk: str, limit: int) -> list[str]:
+    head = ""
+    sents = _chunk_sentences(chunk)
+    for i, s in enumerate(sents):
+        if head and len(head) + len(s) + 1 > limit:
+            return [head, " ".join(sents[i:])]
+        head = (head + " " + s).strip()
+    return [chunk]
+
+
+def split_for_tts(text: str, max_chars: int = 2800, first_max_chars: Optional[int] = None) -> list[str]:
+    """first_max_chars — короткий первый кусок: первое голосовое приходит быстрее, остальные догоняют."""
+    out = _split_for_tts(text, max_chars)
+    if out and first_max_chars and len(out[0]) > first_max_chars:
+        out[:1] = _split_head(out[0], first_max_chars)
+    return out
+
+
+def _split_for_tts(text: str, max_chars: int) -> list[str]:
     t = " ".join((text or "").split()).strip()
     if not t:
         return []
     if len(t) <= max_chars:
         return [t]
 
-    parts = re.split(r"(?:\n\s*){2,}", t)
+    parts = _RE_PARAGRAPHS.split(t)
     out: list[str] = []
     cur = ""
 
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import os
+import json
+import asyncio
+import logging
+import contextvars
+import datetime as dt
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger("usage")
+
+USAGE_ENABLED = (os.getenv("USAGE_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+USAGE_FLUSH_SEC = float(os.getenv("USAGE_FLUSH_SEC", "30"))
+USAGE_FLUSH_BATCH = int(os.getenv("USAGE_FLUSH_BATCH", "500"))
+
+# Цены за 1M токенов (input, output) по моделям; для TTS — цена за 1M символов во втором поле.
+# Пример: USAGE_PRICES='{"gpt-5.1": [1.25, 10], "gpt-4o-mini-tts": [0, 15]}'
+try:
+    USAGE_PRICES: Dict[str, List[float]] = json.loads(os.getenv("USAGE_PRICES") or "{}")
+except Exception:
+    USAGE_PRICES = {}
+
+_ctx: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("usage_ctx", default={})
+
+BucketKey = Tuple[dt.datetime, int, str, str, str]
+_buckets: Dict[BucketKey, Dict[str, int]] = {}
+_flusher: Optional[asyncio.Task] = None
+
+
+def bind(chat_id: int, plan: str, feature: str) -> None:
+    _ctx.set({"chat_id": int(chat_id), "plan": str(plan), "feature": str(feature)})
+
+
+def current_plan() -> Optional[str]:
+    return _ctx.get().get("plan")
+
+
+def _hour(now: dt.datetime) -> dt.datetime:
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+def record(
+    model: str,
+    prompt_tokens: int = 0,
+    completion_tokens: int = 0,
+    *,
+    chars: int = 0,
+    feature: Optional[str] = None,
+) -> None:
+    if not USAGE_ENABLED:
+        return
+    ctx = _ctx.get()
+    feat = feature or ctx.get("feature") or "unknown"
+    key: BucketKey = (
+        _hour(dt.datetime.now(dt.timezone.utc)),
+        int(ctx.get("chat_id") or 0),
+        str(ctx.get("plan") or "unknown"),
+        str(model or "unknown"),
+        feat,
+    )
+    b = _buckets.get(key)
+    if b is None:
+        b = _buckets[key] = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "chars": 0}
+    b["calls"] += 1
+    b["prompt_tokens"] += int(prompt_tokens or 0)
+    b["completion_tokens"] += int(completion_tokens or 0)
+    b["chars"] += int(chars or 0)
+    metrics.inc(f"usage.tokens.{feat}", int(prompt_tokens or 0) + int(completion_tokens or 0))
+    _ensure_flusher()
+    if len(_buckets) >= USAGE_FLUSH_BATCH:
+        asyncio.get_running_loop().create_task(flush())
+
+
+def record_openai(model: str, usage_obj: Any, *, feature: Optional[str] = None) -> None:
+    if usage_obj is None:
+        return
+    record(
+        model,
+        getattr(usage_obj, "prompt_tokens", 0) or 0,
+        getattr(usage_obj, "completion_tokens", 0) or 0,
+        feature=feature,
+    )
+
+
+def _ensure_flusher() -> None:
+    global _flusher
+    if _flusher is not None and not _flusher.done():
+        return
+    try:
+        _flusher = asyncio.get_running_loop().create_task(_flush_loop())
+    except RuntimeError:
+        _flusher = None
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SEC)
+        await flush()
+
+
+async def shutdown() -> None:
+    """Останавливает фоновый флашер и дописывает незакрытые часовые бакеты — иначе они теряются при рестарте."""
+    global _flusher
+    task, _flusher = _flusher, None
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+    await flush()
+
+
+async def flush() -> None:
+    global _buckets
+    if not _buckets:
+        return
+    pending, _buckets = _buckets, {}
+    docs = [
+        {"bucket": hour, "chat_id": chat_id, "plan": plan, "model": model, "feature": feature, **counts}
+        for (hour, chat_id, plan, model, feature), counts in pending.items()
+    ]
+    from db import usage_insert_many
+
+    try:
+        await usage_insert_many(docs)
+        metrics.inc("usage.flushed_docs", len(docs))
+    except Exception as e:
+        log.warning("usage flush failed (%s docs): %s", len(docs), e)
+        for (key, counts) in pending.items():
+            b = _buckets.setdefault(key, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "chars": 0})
+            for k, v in counts.items():
+                b[k] += v
+
+
+def cost_of(model: str, prompt_tokens: int, completion_tokens: int, chars: int) -> float:
+    price = USAGE_PRICES.get(model)
+    if not price:
+        return 0.0
+    p_in = float(price[0]) if len(price) > 0 else 0.0
+    p_out = float(price[1]) if len(price) > 1 else 0.0
+    if chars and not (prompt_tokens or completion_tokens):
+        return chars * p_out / 1_000_000
+    return (prompt_tokens * p_in + completion_tokens * p_out) / 1_000_000
+
+
+async def plan_cost_report(days: int = 7) -> str:
+    from db import usage_aggregate_daily, usage_distinct_chats
+
+    rows = await usage_aggregate_daily(days)
+    chats = await usage_distinct_chats(days)
+    if not rows:
+        return "Нет данных об использовании за выбранный период."
+    per_day: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for r in rows:
+        day = r["day"]
+        plan = r["plan"]
+        agg = per_day.setdefault(day, {}).setdefault(plan, {"tokens": 0, "cost": 0.0, "chats": 0})
+        agg["tokens"] += int(r["prompt_tokens"]) + int(r["completion_tokens"])
+        agg["cost"] += cost_of(r["model"], int(r["prompt_tokens"]), int(r["completion_tokens"]), int(r["chars"]))
+        agg["chats"] = chats.get((day, plan), 0)
+    lines = [f"📊 Стоимость по планам за {days} дн. (цены из USAGE_PRICES, $)"]
+    for day in sorted(per_day, reverse=True):
+        lines.append(f"\n{day}")
+        for plan, agg in sorted(per_day[day].items()):
+            per_chat = agg["cost"] / agg["chats"] if agg["chats"] else 0.0
+            lines.append(
+                f"  {plan.upper():<7} токены: {int(agg['tokens']):,} | ${agg['cost']:.2f} | чатов: {agg['chats']} | ${per_chat:.4f}/чат"
+            )
+    return "\n".join(lines)
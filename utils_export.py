@@ -1,19 +1,22 @@
 import io
 import os
-import re
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, timezone
-from typing import Optional, List, Iterable
+from typing import Optional, List, Iterable, Iterator, Tuple, Dict
 
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.enums import TA_LEFT
 from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.pdfmetrics import registerFontFamily
 from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem, PageBreak, Table
 from reportlab.lib.units import mm
 from xml.sax.saxutils import escape as _xml_escape
 
+import answerdoc
+
 
 FONT_REGULAR = "DejaVuSans.ttf"
 FONT_BOLD = "DejaVuSans-Bold.ttf"
@@ -70,6 +73,8 @@ def _ensure_fonts(extra_dirs: Optional[Iterable[str]] = None) -> None:
         )
     pdfmetrics.registerFont(TTFont("DejaVu", reg))
     pdfmetrics.registerFont(TTFont("DejaVu-Bold", bold))
+    # Курсивного начертания нет — <i> остаётся прямым, <b> берёт DejaVu-Bold
+    registerFontFamily("DejaVu", normal="DejaVu", bold="DejaVu-Bold", italic="DejaVu", boldItalic="DejaVu-Bold")
     _fonts_ready = True
 
 
@@ -82,7 +87,9 @@ def _header_footer(canvas, doc, title: str) -> None:
     canvas.restoreState()
 
 
+@lru_cache(maxsize=8)
 def _styles(cfg: PdfConfig):
+    # Стили зависят только от cfg: в рабочем процессе собираются один раз
     styles = getSampleStyleSheet()
 
     if "BodyDejaVu" not in styles:
@@ -136,72 +143,86 @@ def _styles(cfg: PdfConfig):
             )
         )
 
+    if "SectionDejaVu" not in styles:
+        styles.add(
+            ParagraphStyle(
+                name="SectionDejaVu",
+                fontName="DejaVu-Bold",
+                fontSize=14,
+                leading=18,
+                spaceBefore=10,
+                spaceAfter=2,
+                alignment=TA_LEFT,
+                keepWithNext=1,
+            )
+        )
+
+    if "CodeDejaVu" not in styles:
+        styles.add(
+            ParagraphStyle(
+                name="CodeDejaVu",
+                fontName="DejaVu",
+                fontSize=cfg.base_font_size - 1.5,
+                leading=cfg.base_leading - 2,
+                alignment=TA_LEFT,
+                leftIndent=4 * mm,
+                backColor="#f3f3f3",
+                borderPadding=(2, 3, 2, 3),
+            )
+        )
+
     return styles
 
 
-_RE_MD_HEADER = re.compile(r"^\s{0,3}#{1,6}\s+", re.MULTILINE)
-_RE_MD_BOLD_STAR = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
-_RE_MD_BOLD_UND = re.compile(r"__(.+?)__", re.DOTALL)
-_RE_MD_ITALIC_STAR = re.compile(r"(?<!\w)\*(?!\s)(.+?)(?<!\s)\*(?!\w)", re.DOTALL)
-_RE_MD_ITALIC_UND = re.compile(r"(?<!\w)_(?!\s)(.+?)(?<!\s)_(?!\w)", re.DOTALL)
-_RE_MD_INLINE_CODE = re.compile(r"`([^`]+)`")
-_RE_SPACES = re.compile(r"[ \t]{2,}")
-_RE_EMPTY_LINES = re.compile(r"\n{3,}")
-
-
-def _normalize_for_pdf(text: str) -> str:
-    t = (text or "").replace("\r\n", "\n").replace("\r", "\n")
-    t = _RE_MD_HEADER.sub("", t)
-    t = _RE_MD_BOLD_STAR.sub(r"\1", t)
-    t = _RE_MD_BOLD_UND.sub(r"\1", t)
-    t = _RE_MD_ITALIC_STAR.sub(r"\1", t)
-    t = _RE_MD_ITALIC_UND.sub(r"\1", t)
-    t = _RE_MD_INLINE_CODE.sub(r"\1", t)
-    t = t.replace("\u00a0", " ")
-    t = _RE_SPACES.sub(" ", t)
-    t = _RE_EMPTY_LINES.sub("\n\n", t)
-    return t.strip()
-
-
-def _split_blocks(text: str) -> List[str]:
-    if not text:
-        return []
-    return [b.strip() for b in text.split("\n\n") if b.strip()]
-
-
-def _is_bullet_line(line: str) -> bool:
-    s = (line or "").strip()
-    return s.startswith(("- ", "• ", "— ", "* "))
-
-
-def _strip_bullet_prefix(line: str) -> str:
-    s = (line or "").strip()
-    for pref in ("- ", "• ", "— ", "* "):
-        if s.startswith(pref):
-            return s[len(pref):].strip()
-    return s
-
-
-def _is_heading(block: str) -> bool:
-    s = (block or "").strip()
-    if not s:
-        return False
-    if len(s) > 90:
-        return False
-    if "\n" in s:
-        return False
-    if s.endswith(":"):
-        return True
-    words = s.split()
-    if 1 <= len(words) <= 8 and sum(1 for ch in s if ch.isalpha() and ch.upper() == ch) >= max(3, len(s) // 6):
-        return True
-    return False
+def warm(extra_font_dirs: Optional[Iterable[str]] = None) -> None:
+    """Регистрирует шрифты и собирает стили заранее — вызывается при старте процесса пула."""
+    _ensure_fonts(extra_dirs=extra_font_dirs)
+    _styles(PdfConfig())
 
 
 def _p(text: str) -> str:
     return _xml_escape(text or "").replace("\n", "<br/>")
 
 
+_PDF_TAGS = {"b": ("<b>", "</b>"), "i": ("<i>", "</i>")}
+
+
+def _p_inlines(inl: List[answerdoc.Inline]) -> str:
+    parts: List[str] = []
+    for kind, s in inl:
+        tag = _PDF_TAGS.get(kind)
+        parts.append(f"{tag[0]}{_p(s)}{tag[1]}" if tag else _p(s))
+    return "".join(parts)
+
+
+def _answer_flowables(parsed: answerdoc.Doc, styles) -> list:
+    out: list = []
+    for b in parsed:
+        kind = b[0]
+        if kind == "h":
+            out.append(Paragraph(_p_inlines(b[2]), styles["H2DejaVu"]))
+        elif kind == "p":
+            out.append(Paragraph(_p_inlines(b[1]), styles["BodyDejaVu"]))
+        elif kind in ("ul", "ol"):
+            items = [ListItem(Paragraph(_p_inlines(it), styles["BodyDejaVu"])) for it in b[1]]
+            out.append(
+                ListFlowable(
+                    items,
+                    bulletType="1" if kind == "ol" else "bullet",
+                    leftIndent=10 * mm,
+                    bulletFontName="DejaVu",
+                    bulletFontSize=10,
+                    bulletDedent=3 * mm,
+                )
+            )
+        elif kind == "code":
+            out.append(Paragraph(_p(b[2]).replace("  ", "&nbsp; "), styles["CodeDejaVu"]))
+        else:
+            out.append(Paragraph(_p(b[1]), styles["CodeDejaVu"]))
+        out.append(Spacer(1, 3 * mm))
+    return out
+
+
 def pdf_from_answer_text(
     answer: str,
     title: str = "Разбор задачи",
@@ -210,8 +231,20 @@ def pdf_from_answer_text(
     cfg: Optional[PdfConfig] = None,
     extra_font_dirs: Optional[Iterable[str]] = None,
 ) -> io.BytesIO:
-    cleaned = _normalize_for_pdf(answer or "")
-    if not cleaned:
+    return pdf_from_answer_doc(
+        answerdoc.parse(answer), title=title, author=author, cfg=cfg, extra_font_dirs=extra_font_dirs
+    )
+
+
+def pdf_from_answer_doc(
+    parsed: answerdoc.Doc,
+    title: str = "Разбор задачи",
+    author: str = "Учебный помощник",
+    *,
+    cfg: Optional[PdfConfig] = None,
+    extra_font_dirs: Optional[Iterable[str]] = None,
+) -> io.BytesIO:
+    if not parsed:
         raise ValueError("Пустой текст для экспорта")
 
     cfg = cfg or PdfConfig()
@@ -236,36 +269,7 @@ def pdf_from_answer_text(
     story.append(Paragraph(_p(title), styles["TitleDejaVu"]))
     story.append(Paragraph(_p(f"{author} • {now}"), styles["MetaDejaVu"]))
     story.append(Spacer(1, 4 * mm))
-
-    for block in _split_blocks(cleaned):
-        lines = [ln.rstrip() for ln in block.split("\n") if ln.strip()]
-
-        if lines and all(_is_bullet_line(ln) for ln in lines) and len(lines) >= 2:
-            items = []
-            for ln in lines:
-                txt = _strip_bullet_prefix(ln)
-                if txt:
-                    items.append(ListItem(Paragraph(_p(txt), styles["BodyDejaVu"])))
-            if items:
-                story.append(
-                    ListFlowable(
-                        items,
-                        bulletType="bullet",
-                        leftIndent=10 * mm,
-                        bulletFontName="DejaVu",
-                        bulletFontSize=10,
-                        bulletDedent=3 * mm,
-                    )
-                )
-                story.append(Spacer(1, 3 * mm))
-                continue
-
-        text_block = "\n".join(lines) if lines else block
-        if _is_heading(text_block):
-            story.append(Paragraph(_p(text_block.rstrip(":")), styles["H2DejaVu"]))
-        else:
-            story.append(Paragraph(_p(text_block), styles["BodyDejaVu"]))
-        story.append(Spacer(1, 3 * mm))
+    story.extend(_answer_flowables(parsed, styles))
 
     def _on_page(canvas, d):
         _header_footer(canvas, d, title=title)
@@ -273,3 +277,117 @@ def pdf_from_answer_text(
     doc.build(story, onFirstPage=_on_page, onLaterPages=_on_page)
     buf.seek(0)
     return buf
+
+
+# ---------- Потоковый экспорт многих записей ----------
+
+class _LazyStory(list):
+    """Story для doc.build, который дочитывает flowables из итератора, когда отрисованы предыдущие.
+
+    build() снимает элементы с начала списка и крутится, пока len() > 0, поэтому в памяти
+    живёт только текущая пачка, а уже свёрстанные страницы лежат в канве сжатыми.
+    """
+
+    def __init__(self, source: Iterator[list]):
+        super().__init__()
+        self._source = source
+
+    def __len__(self) -> int:
+        while not list.__len__(self):
+            batch = next(self._source, None)
+            if batch is None:
+                return 0
+            self.extend(batch)
+        return list.__len__(self)
+
+
+class _StreamDoc(SimpleDocTemplate):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.toc: List[Tuple[str, int]] = []
+
+    def afterFlowable(self, flowable) -> None:
+        title = getattr(flowable, "toc_title", None)
+        if title is None:
+            return
+        key = f"s{len(self.toc)}"
+        self.canv.bookmarkPage(key)
+        self.canv.addOutlineEntry(title[:80], key, level=0)
+        self.toc.append((title, self.page))
+
+
+def _toc_flowables(doc: _StreamDoc, styles) -> list:
+    rows = [[Paragraph(_p(t), styles["BodyDejaVu"]), str(page)] for t, page in doc.toc]
+    table = Table(
+        rows,
+        colWidths=[doc.width - 16 * mm, 16 * mm],
+        style=[
+            ("FONT", (1, 0), (1, -1), "DejaVu", 10),
+            ("ALIGN", (1, 0), (1, -1), "RIGHT"),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ],
+    )
+    return [PageBreak(), Paragraph("Содержание", styles["TitleDejaVu"]), Spacer(1, 2 * mm), table]
+
+
+def pdf_stream_to_file(
+    path: str,
+    entries: Iterator[Tuple[str, str, str]],
+    title: str = "Экспорт",
+    author: str = "Учебный помощник",
+    *,
+    cfg: Optional[PdfConfig] = None,
+    extra_font_dirs: Optional[Iterable[str]] = None,
+    batch_entries: int = 20,
+) -> Dict[str, int]:
+    """Пишет записи (заголовок, подпись, текст) в PDF-файл по мере чтения итератора.
+
+    Сборка однопроходная, поэтому содержание с номерами страниц добавляется в конец документа;
+    для навигации по разделам там же есть закладки PDF.
+    """
+    cfg = cfg or PdfConfig()
+    _ensure_fonts(extra_dirs=extra_font_dirs)
+    styles = _styles(cfg)
+
+    doc = _StreamDoc(
+        path,
+        pagesize=cfg.pagesize,
+        leftMargin=cfg.left_margin_mm * mm,
+        rightMargin=cfg.right_margin_mm * mm,
+        topMargin=cfg.top_margin_mm * mm,
+        bottomMargin=cfg.bottom_margin_mm * mm,
+        title=title,
+        author=author,
+    )
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+    def _story() -> Iterator[list]:
+        yield [
+            Paragraph(_p(title), styles["TitleDejaVu"]),
+            Paragraph(_p(f"{author} • {now} • содержание в конце документа"), styles["MetaDejaVu"]),
+            Spacer(1, 4 * mm),
+        ]
+        chunk: list = []
+        n = 0
+        for heading, meta, text in entries:
+            head = Paragraph(_p(heading), styles["SectionDejaVu"])
+            head.toc_title = heading
+            chunk.append(head)
+            if meta:
+                chunk.append(Paragraph(_p(meta), styles["MetaDejaVu"]))
+            chunk.extend(_answer_flowables(answerdoc.parse(text), styles))
+            n += 1
+            if n % batch_entries == 0:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        # Сюда генератор доходит, когда всё выше уже отрисовано, — номера страниц известны
+        if doc.toc:
+            yield _toc_flowables(doc, styles)
+
+    def _on_page(canvas, d):
+        _header_footer(canvas, d, title=title)
+
+    doc.build(_LazyStory(_story()), onFirstPage=_on_page, onLaterPages=_on_page)
+    return {"pages": doc.canv.getPageNumber() - 1, "entries": len(doc.toc)}
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import os
+import hashlib
+import logging
+from io import BytesIO
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+log = logging.getLogger("visioncache")
+
+VISION_CACHE_ENABLED = (os.getenv("VISION_CACHE_ENABLED") or "true").lower() in {"1", "true", "yes", "y"}
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "3000"))
+# Содержимое сверяется по копии не меньше этого размера: на превью ~90 px бланки одного шаблона могут совпасть
+VISION_CACHE_HASH_MIN_PX = int(os.getenv("VISION_CACHE_HASH_MIN_PX", "320"))
+
+
+def content_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+@dataclass
+class Probe:
+    scope: str
+    unique_id: str
+    digest: Optional[bytes] = None
+
+
+@dataclass
+class _Entry:
+    scope: str
+    unique_id: str
+    digest: Optional[bytes]
+    answer: str
+    transcript: str
+
+
+# Кэш только точный: по file_unique_id и по байтам копии. Перцептивный хэш здесь не годится —
+# разные задачи на одном бланке отличаются парой цифр, и близкий хэш отдал бы чужой разбор
+_entries: "OrderedDict[int, _Entry]" = OrderedDict()
+_by_uid: Dict[Tuple[str, str], int] = {}
+_by_digest: Dict[Tuple[str, bytes], int] = {}
+_next_id = 0
+
+
+def _touch(eid: int) -> _Entry:
+    _entries.move_to_end(eid)
+    return _entries[eid]
+
+
+def _evict() -> None:
+    while len(_entries) > VISION_CACHE_MAX_ENTRIES:
+        eid, e = _entries.popitem(last=False)
+        _by_uid.pop((e.scope, e.unique_id), None)
+        if e.digest is not None and _by_digest.get((e.scope, e.digest)) == eid:
+            _by_digest.pop((e.scope, e.digest), None)
+        metrics.inc("visioncache.evicted")
+
+
+def _hash_size(photos: List[Any]) -> Any:
+    # Самая маленькая копия, у которой меньшая сторона не меньше VISION_CACHE_HASH_MIN_PX
+    for ph in photos:
+        if min(ph.width, ph.height) >= VISION_CACHE_HASH_MIN_PX:
+            return ph
+    return photos[-1]
+
+
+async def probe(bot: Any, photos: List[Any], scope: str) -> Tuple[Optional[Tuple[str, str]], Probe]:
+    """Ищет готовый разбор для фото: сначала по file_unique_id, потом по содержимому копии ≥ VISION_CACHE_HASH_MIN_PX."""
+    largest = photos[-1]
+    p = Probe(scope=scope, unique_id=largest.file_unique_id)
+    if not VISION_CACHE_ENABLED:
+        return None, p
+
+    eid = _by_uid.get((scope, p.unique_id))
+    if eid is not None:
+        metrics.inc("visioncache.hit.exact")
+        e = _touch(eid)
+        return (e.answer, e.transcript), p
+
+    try:
+        size = _hash_size(photos)
+        file = await bot.get_file(size.file_id)
+        buf = BytesIO()
+        await bot.download_file(file.file_path, buf)
+        p.digest = content_digest(buf.getvalue())
+    except Exception as e:
+        log.warning("photo digest failed: %s", e)
+    if p.digest is not None:
+        eid = _by_digest.get((scope, p.digest))
+        if eid is not None:
+            metrics.inc("visioncache.hit.digest")
+            e = _touch(eid)
+            return (e.answer, e.transcript), p
+
+    metrics.inc("visioncache.miss")
+    return None, p
+
+
+def remember(p: Probe, answer: str, transcript: str = "") -> None:
+    global _next_id
+    if not VISION_CACHE_ENABLED or not (answer or "").strip():
+        return
+    key = (p.scope, p.unique_id)
+    if key in _by_uid:
+        return
+    eid = _next_id
+    _next_id += 1
+    _entries[eid] = _Entry(p.scope, p.unique_id, p.digest, answer, transcript)
+    _by_uid[key] = eid
+    if p.digest is not None:
+        _by_digest[(p.scope, p.digest)] = eid
+    _evict()
+    metrics.gauge("visioncache.entries", len(_entries))
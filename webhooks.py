@@ -1,6 +1,10 @@
 import os
 import json
 import base64
+import asyncio
+import hashlib
+import logging
+import contextlib
 import datetime as dt
 from typing import Any, Dict, Optional, Tuple
 
@@ -17,11 +21,36 @@ from db import (
     set_subscription,
 )
 
+import metrics
+import breaker
+import loadctl
+import payinbox
+
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 
-app = FastAPI()
+log = logging.getLogger("webhooks")
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # Фоновый обработчик webhook_inbox живёт столько же, сколько приложение
+    task = asyncio.create_task(payinbox.run_inbox(), name="payinbox") if PAYINBOX_CONSUMER else None
+    try:
+        yield
+    finally:
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+        import usage
+
+        with contextlib.suppress(Exception):
+            await usage.shutdown()
+
+
+app = FastAPI(lifespan=_lifespan)
 
 NOTIFY_ON_PAYMENT = (os.getenv("NOTIFY_ON_PAYMENT") or "true").lower() == "true"
 DEBUG_WATA_WEBHOOK = (os.getenv("DEBUG_WATA_WEBHOOK") or "true").lower() in {"1", "true", "yes", "y"}
@@ -31,6 +60,10 @@ WATA_VERIFY_SIGNATURE = (os.getenv("WATA_VERIFY_SIGNATURE") or "true").lower() i
 WATA_PUBLIC_KEY_TTL_MIN = int(os.getenv("WATA_PUBLIC_KEY_TTL_MIN", "60"))
 WATA_TIMEOUT_SEC = float(os.getenv("WATA_TIMEOUT_SEC", "60"))
 
+STATUS_TOKEN = (os.getenv("STATUS_TOKEN") or "").strip()
+# Обработчик входящих платежей в этом процессе; можно выключить, если он запущен отдельно
+PAYINBOX_CONSUMER = (os.getenv("PAYINBOX_CONSUMER") or "true").lower() in {"1", "true", "yes", "y"}
+
 LITE_PRICE = float(os.getenv("WATA_LITE_PRICE") or os.getenv("LITE_PRICE") or "200")
 PRO_PRICE = float(os.getenv("WATA_PRO_PRICE") or os.getenv("PRO_PRICE") or "300")
 
@@ -222,6 +255,13 @@ async def health() -> Dict[str, Any]:
     return {"ok": True, "ts": _now_utc().isoformat()}
 
 
+@app.get("/status")
+async def status(request: Request) -> Dict[str, Any]:
+    if STATUS_TOKEN and request.query_params.get("token") != STATUS_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return {"ok": True, "ts": _now_utc().isoformat(), **breaker.snapshot(), "load": loadctl.snapshot(), "metrics": metrics.snapshot()}
+
+
 @app.get("/payment/success")
 async def payment_success() -> HTMLResponse:
     return HTMLResponse("<h2>✅ Оплата успешна</h2><p>Вернитесь в Telegram-бот — доступ активируется автоматически.</p>")
@@ -263,7 +303,24 @@ async def wata_webhook(request: Request) -> JSONResponse:
 
     # RSA verify
     await _wata_verify_signature(request, raw_body)
+    if not payload:
+        raise HTTPException(status_code=400, detail="Empty or non-JSON payload")
+
+    # Ключ идемпотентности: повторная доставка того же статуса транзакции — дубль
+    ref = payload.get("transactionId") or payload.get("id") or payload.get("paymentLinkId") or payload.get("orderId")
+    ref = str(ref) if ref else hashlib.blake2b(raw_body, digest_size=16).hexdigest()
+    key = f"wata:{ref}:{_wata_status(payload) or 'unknown'}"
+    try:
+        new = await payinbox.accept(key, "wata", payload)
+    except Exception as e:
+        # Событие не сохранено — пусть провайдер повторит
+        log.warning("webhook inbox write failed: %s", e)
+        raise HTTPException(status_code=503, detail="Temporarily unavailable")
+    return JSONResponse({"ok": True, "received": True, "duplicate": not new})
 
+
+async def apply_wata_event(payload: Dict[str, Any]) -> None:
+    """Применяет событие WATA из webhook_inbox. Повторный вызов безопасен: оплата помечается processed."""
     order_id = payload.get("orderId")
     transaction_id = payload.get("transactionId")
     wata_id = payload.get("id")
@@ -293,21 +350,21 @@ async def wata_webhook(request: Request) -> JSONResponse:
 
     if not chat_id:
         await mark_payment_status(pay_key, status="bad_payload", external_id=str(order_id) if order_id else None, raw=payload)
-        raise HTTPException(status_code=400, detail="chat_id is missing (orderId)")
+        raise payinbox.Reject("chat_id is missing (orderId)")
 
     if plan not in {"lite", "pro"}:
         await mark_payment_status(pay_key, status="bad_payload", external_id=str(order_id) if order_id else None, raw=payload)
-        raise HTTPException(status_code=400, detail="plan is missing (lite/pro)")
+        raise payinbox.Reject("plan is missing (lite/pro)")
 
     # Declined
     if _wata_is_declined(payload):
         await mark_payment_status(pay_key, status="declined", external_id=str(order_id) if order_id else None, raw=payload)
-        return JSONResponse({"ok": True, "received": True, "paid": False, "declined": True})
+        return
 
     # Not paid / other statuses
     if not _wata_is_paid(payload):
         await mark_payment_status(pay_key, status="not_paid", external_id=str(order_id) if order_id else None, raw=payload)
-        return JSONResponse({"ok": True, "received": True, "paid": False})
+        return
 
     await grant_paid_access(
         chat_id=int(chat_id),
@@ -321,12 +378,5 @@ async def wata_webhook(request: Request) -> JSONResponse:
     )
 
     if NOTIFY_ON_PAYMENT:
-        bot = getattr(app.state, "bot", None)
-        if bot:
-            try:
-                txt = "✅ Оплата получена. Подписка LITE активирована на 30 дней." if plan == "lite" else "✅ Оплата получена. Подписка PRO активирована на 30 дней."
-                await bot.send_message(int(chat_id), txt)
-            except Exception:
-                pass
-
-    return JSONResponse({"ok": True, "paid": True})
\ No newline at end of file
+        txt = "✅ Оплата получена. Подписка LITE активирована на 30 дней." if plan == "lite" else "✅ Оплата получена. Подписка PRO активирована на 30 дней."
+        await payinbox.notify(f"paid:{pay_key}", int(chat_id), txt)